@@ -25,8 +25,12 @@
 
 import apt_pkg
 import errno
+import json
 import os
+import queue
 import sys
+import threading
+from typing import Optional
 
 from daklib.dbconn import DBConn
 from daklib import daklog
@@ -35,6 +39,8 @@ from daklib.config import Config
 Options = None
 Logger = None
 
+_log_lock = threading.Lock()
+
 ################################################################################
 ################################################################################
 ################################################################################
@@ -43,6 +49,8 @@ Logger = None
 def usage(exit_code=0):
     print("""Usage: dak archive-dedup-pool [OPTION]...
   -h, --help                show this help and exit.
+  -n, --no-action           only report how many bytes could be reclaimed
+  -a, --all                 check all groups, even those known to be linked
   -V, --version             display the version number and exit
 """)
     sys.exit(exit_code)
@@ -50,7 +58,76 @@ def usage(exit_code=0):
 ################################################################################
 
 
-def dedup_one(size, reference, *filenames):
+class InodeIndex:
+    """
+    Remember the inode of pool files (by file id) after they were
+    deduplicated, so later runs can skip groups known to be linked
+    without calling stat() on them.
+
+    A file that is removed and added to the pool again gets a new id,
+    so the index cannot hide it.
+    """
+
+    _format = 2
+
+    def __init__(self):
+        #: file id -> (st_dev, st_ino)
+        self.inodes = {}
+        self.seen = set()
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "InodeIndex":
+        index = cls()
+        if path is None:
+            return index
+        try:
+            with open(path, 'r') as fh:
+                data = json.load(fh)
+            if data.get('format') == cls._format:
+                index.inodes = {file_id: (dev, ino) for file_id, dev, ino in data['inodes']}
+        except (OSError, ValueError, TypeError, AttributeError):
+            pass
+        return index
+
+    def save(self, path: str) -> None:
+        """Store the index, dropping files that are no longer in a group"""
+        inodes = {file_id: inode for file_id, inode in self.inodes.items() if file_id in self.seen}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.new.%d" % (path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump({'format': self._format,
+                       'inodes': [[file_id, dev, ino] for file_id, (dev, ino) in inodes.items()]},
+                      fh, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    def is_linked(self, file_ids) -> bool:
+        self.seen.update(file_ids)
+        inodes = set(self.inodes.get(file_id) for file_id in file_ids)
+        return len(inodes) == 1 and None not in inodes
+
+    def set_linked(self, file_ids, inode) -> None:
+        for file_id in file_ids:
+            self.inodes[file_id] = inode
+
+
+def inode_index_path() -> Optional[str]:
+    """Where the inode index is stored (None if not configured)"""
+    cache_dir = Config().get('Dir::Cache')
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, 'archive-dedup-pool')
+
+################################################################################
+
+
+def dedup_one(size, reference, *filenames, no_action=False):
+    """
+    Replace `filenames` by hard links to `reference`.
+
+    Returns the inode of `reference` if all files are linked to it
+    afterwards (None otherwise) and the number of bytes reclaimed (or
+    that could be reclaimed with `no_action`).
+    """
     stat_reference = os.stat(reference)
 
     # safety net
@@ -58,11 +135,14 @@ def dedup_one(size, reference, *filenames):
         raise RuntimeError('Size of {} does not match database: {} != {}'.format(
             reference, size, stat_reference.st_size))
 
+    inode = (stat_reference.st_dev, stat_reference.st_ino)
+    other_inodes = set()
+
     for filename in filenames:
         stat_filename = os.stat(filename)
 
         # if file is already a hard-linked, ignore
-        if stat_reference == stat_filename:
+        if os.path.samestat(stat_reference, stat_filename):
             continue
 
         # safety net
@@ -70,10 +150,15 @@ def dedup_one(size, reference, *filenames):
             raise RuntimeError('Size of {} does not match database: {} != {}'.format(
                 filename, size, stat_filename.st_size))
 
+        other_inodes.add((stat_filename.st_dev, stat_filename.st_ino))
+        if no_action:
+            continue
+
         tempfile = filename + '.new'
         os.link(reference, tempfile)
         try:
-            Logger.log(["deduplicate", filename, reference])
+            with _log_lock:
+                Logger.log(["deduplicate", filename, reference])
             os.rename(tempfile, filename)
         finally:
             try:
@@ -82,36 +167,119 @@ def dedup_one(size, reference, *filenames):
                 if e.errno != errno.ENOENT:
                     raise
 
+    if no_action and other_inodes:
+        inode = None
+    return inode, size * len(other_inodes)
+
+
+class FilesystemWorker:
+    """
+    Deduplicate the groups of files on one filesystem in a thread of its
+    own, taking them from a bounded queue as they are read from the
+    database.
+    """
+
+    def __init__(self, index, index_lock, no_action=False, maxsize=1000):
+        self.index = index
+        self.index_lock = index_lock
+        self.no_action = no_action
+        self.queue = queue.Queue(maxsize)
+        self.groups = 0
+        self.reclaimed = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        while (group := self.queue.get()) is not None:
+            # after an error, only drain the queue so the reader does not block
+            if self.error is not None:
+                continue
+            size, file_ids, filenames = group
+            try:
+                inode, reclaimed = dedup_one(size, *filenames, no_action=self.no_action)
+            except Exception as e:
+                self.error = e
+                continue
+            if inode is not None:
+                with self.index_lock:
+                    self.index.set_linked(file_ids, inode)
+            self.groups += 1
+            self.reclaimed += reclaimed
+
+    def put(self, size, file_ids, filenames):
+        self.queue.put((size, file_ids, filenames))
+
+    def close(self):
+        """Wait for the queued groups to be done"""
+        self.queue.put(None)
+        self.thread.join()
+
 ################################################################################
 
 
-def dedup(session):
-    results = session.execute("""
-SELECT DISTINCT *
-    FROM (
-        SELECT
-            f.size,
-            array_agg(a.path || '/pool/' || c.name || '/' || f.filename) OVER (
-                -- we aggregate all files with the same size, sha256sum and archive
-                PARTITION BY f.size, f.sha256sum, a.id
-                -- the oldest should be first
-                ORDER by f.created
-                -- we always want to see all rows
-                ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
-            )
-            AS filenames
-            FROM
-                files AS f INNER JOIN
-                files_archive_map AS fa ON f.id = fa.file_id INNER JOIN
-                component c ON fa.component_id = c.id INNER JOIN
-                archive a ON fa.archive_id = a.id
-    ) AS f
+def candidates(session):
+    """
+    Stream (size, archive path, file ids, filenames) of files with the
+    same content in an archive, the oldest first.
+    """
+    connection = session.connection().execution_options(stream_results=True)
+    return connection.execute("""
+SELECT
+    f.size,
+    a.path AS archive_path,
+    array_agg(f.id ORDER BY f.created, f.id) AS file_ids,
+    array_agg(a.path || '/pool/' || c.name || '/' || f.filename ORDER BY f.created, f.id) AS filenames
+    FROM
+        files AS f INNER JOIN
+        files_archive_map AS fa ON f.id = fa.file_id INNER JOIN
+        component c ON fa.component_id = c.id INNER JOIN
+        archive a ON fa.archive_id = a.id
+    -- we aggregate all files with the same size, sha256sum and archive
+    GROUP BY f.size, f.sha256sum, a.id, a.path
     -- we only care about entries with more than one filename
-    WHERE array_length(filenames, 1) > 1
+    HAVING count(*) > 1
     """)
 
-    for i in results:
-        dedup_one(i['size'], *i['filenames'])
+
+def dedup(session, no_action=False, index=None):
+    if index is None:
+        index = InodeIndex()
+
+    # Link operations on one filesystem are done one after another, but
+    # different filesystems are worked on in parallel.  Groups are handed
+    # to the workers as they are read, so memory use does not grow with
+    # the number of groups.
+    index_lock = threading.Lock()
+    devices = {}
+    workers = {}
+    skipped = 0
+    try:
+        for i in candidates(session):
+            with index_lock:
+                linked = index.is_linked(i['file_ids'])
+            if linked:
+                skipped += 1
+                continue
+            archive_path = i['archive_path']
+            if archive_path not in devices:
+                # the pool may be on another filesystem than the archive root
+                devices[archive_path] = os.stat(os.path.join(archive_path, 'pool')).st_dev
+            device = devices[archive_path]
+            if device not in workers:
+                workers[device] = FilesystemWorker(index, index_lock, no_action)
+            workers[device].put(i['size'], i['file_ids'], i['filenames'])
+    finally:
+        for worker in workers.values():
+            worker.close()
+
+    for worker in workers.values():
+        if worker.error is not None:
+            raise worker.error
+
+    if no_action:
+        print("{} bytes can be reclaimed in {} groups ({} groups known to be linked).".format(
+            sum(w.reclaimed for w in workers.values()), sum(w.groups for w in workers.values()), skipped))
 
 ################################################################################
 
@@ -122,11 +290,13 @@ def main():
     cnf = Config()
     session = DBConn().session()
 
-    Arguments = [('h', "help", "Archive-Dedup-Pool::Options::Help")]
+    Arguments = [('h', "help", "Archive-Dedup-Pool::Options::Help"),
+                 ('n', "no-action", "Archive-Dedup-Pool::Options::No-Action"),
+                 ('a', "all", "Archive-Dedup-Pool::Options::All")]
 
     apt_pkg.parse_commandline(cnf.Cnf, Arguments, sys.argv)
 
-    for i in ["help"]:
+    for i in ["help", "no-action", "all"]:
         key = "Archive-Dedup-Pool::Options::%s" % i
         if key not in cnf:
             cnf[key] = ""
@@ -136,11 +306,20 @@ def main():
     if Options["Help"]:
         usage()
 
-    Logger = daklog.Logger("archive-dedup-pool")
+    no_action = bool(Options["No-Action"])
+    if not no_action:
+        Logger = daklog.Logger("archive-dedup-pool")
+
+    index_path = inode_index_path()
+    index = InodeIndex() if Options["All"] else InodeIndex.load(index_path)
+
+    dedup(session, no_action=no_action, index=index)
 
-    dedup(session)
+    if index_path is not None:
+        index.save(index_path)
 
-    Logger.close()
+    if Logger:
+        Logger.close()
 
 ################################################################################
 
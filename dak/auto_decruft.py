@@ -44,7 +44,7 @@ from daklib.config import Config
 from daklib.dbconn import *
 from daklib import utils
 from daklib.cruft import *
-from daklib.rm import remove, ReverseDependencyChecker
+from daklib.rm import remove, RemovalSimulator, ReverseDependencyChecker
 
 ################################################################################
 
@@ -194,7 +194,6 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
     pkg_arch2groups = defaultdict(set)
     group_order = []
     groups = {}
-    full_removal_request = []
     group_generator = chain(
         compute_sourceless_groups(suite_id, session),
         compute_nbs_groups(suite_id, suite_name, session)
@@ -218,10 +217,6 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
                 print("N: Merging group %s" % (group_name))
             groups[group_name] = merge_group(groups[group_name], group)
 
-    for group_name in group_order:
-        removal_request = groups[group_name]["removal_request"]
-        full_removal_request.extend(removal_request.items())
-
     if not groups:
         if debug:
             print("N: Found no candidates")
@@ -241,7 +236,14 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
     if debug:
         print("N: Computing initial breakage...")
 
-    breakage = rdc.check_reverse_depends(full_removal_request)
+    # The simulator keeps track of the breakage as groups are dropped
+    # from the removal, so only the packages of dropped groups are
+    # checked again.
+    simulator = RemovalSimulator(rdc)
+    for group_name in group_order:
+        simulator.remove_group(group_name, groups[group_name]["removal_request"])
+
+    breakage = simulator.breakage()
     while breakage:
         by_breakers = [(len(breakage[x]), x, breakage[x]) for x in breakage]
         by_breakers.sort(reverse=True)
@@ -252,6 +254,10 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
                 bname = "%s/%s" % breaker
                 broken_str = ", ".join("%s/%s" % b for b in sorted(broken))
                 print("N:    * %s => %s" % (bname, broken_str))
+            print("N: - breakage by group:")
+            for group_name, cost in sorted(simulator.group_costs().items(), key=lambda x: (-x[1], x[0])):
+                if cost:
+                    print("N:    * %s: %d" % (group_name, cost))
 
         averted_breakage = set()
 
@@ -280,6 +286,7 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
             for group_name in guilty_groups:
                 if group_name in groups:
                     del groups[group_name]
+                    simulator.restore_group(group_name)
 
         if not groups:
             if debug:
@@ -289,12 +296,9 @@ def auto_decruft_suite(suite_name: str, suite_id: int, session, dryrun: bool, de
         if debug:
             print("N: Now considering to remove: %s" % str(", ".join(sorted(groups.keys()))))
 
-        # Rebuild the removal request with the remaining groups and off
-        # we go to (not) break the world once more time
-        full_removal_request = []
-        for group_info in groups.values():
-            full_removal_request.extend(group_info["removal_request"].items())
-        breakage = rdc.check_reverse_depends(full_removal_request)
+        # Off we go to (not) break the world once more time with the
+        # remaining groups
+        breakage = simulator.breakage()
 
     if debug:
         print("N: Removal looks good")
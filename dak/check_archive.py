@@ -31,13 +31,17 @@
 ################################################################################
 
 import errno
+import json
 import os
 import stat
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
+
 import apt_pkg
 import apt_inst
 
+from daklib.dakapt import DakHashes
 from daklib.dbconn import *
 from daklib import utils
 from daklib.config import Config
@@ -60,6 +64,10 @@ def usage(exit_code=0):
 Run various sanity checks of the archive and/or database.
 
   -h, --help                show this help and exit.
+  -j, --jobs=N              checksums: number of files to check in parallel
+  -t, --time-limit=MINUTES  checksums: stop after this time; the next run
+                            continues with the files not verified longest
+  -r, --report=FILE         checksums: append mismatches to FILE as JSON lines
 
 The following MODEs are available:
 
@@ -272,43 +280,116 @@ def check_source_in_one_dir():
 ################################################################################
 
 
-def check_checksums():
+def _checksum_pool_file(filename: str):
     """
-    Validate all files
+    Return (size, md5sum, sha1sum, sha256sum) of `filename`, reading it
+    only once, and an error message if it could not be read.
     """
-    print("Getting file information from database...")
-    q = DBConn().session().query(PoolFile)
-
-    print("Checking file checksums & sizes...")
-    for f in q:
-        filename = f.fullpath
-
-        try:
-            fi = open(filename)
-        except:
-            utils.warn("can't open '%s'." % (filename))
-            continue
+    try:
+        with open(filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            hashes = DakHashes(fh)
+            return (size, hashes.md5, hashes.sha1, hashes.sha256), None
+    except OSError as e:
+        return None, str(e)
+
+
+_checksums_batch_query = """
+    SELECT DISTINCT ON (f.id)
+           f.id, archive.path, component.name, f.filename,
+           f.size, f.md5sum, f.sha1sum, f.sha256sum
+      FROM files f
+      LEFT JOIN files_archive_map af ON af.file_id = f.id
+      LEFT JOIN archive ON archive.id = af.archive_id
+      LEFT JOIN component ON component.id = af.component_id
+     WHERE f.id = ANY(:file_ids)
+     ORDER BY f.id, archive.tainted DESC
+"""
 
-        size = os.stat(filename)[stat.ST_SIZE]
-        if size != f.filesize:
-            utils.warn("**WARNING** size mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, size, f.filesize))
 
-        md5sum = apt_pkg.md5sum(fi)
-        if md5sum != f.md5sum:
-            utils.warn("**WARNING** md5sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, md5sum, f.md5sum))
+def check_checksums(jobs=None, time_limit=None, report=None):
+    """
+    Validate all files
 
-        fi.seek(0)
-        sha1sum = apt_pkg.sha1sum(fi)
-        if sha1sum != f.sha1sum:
-            utils.warn("**WARNING** sha1sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha1sum, f.sha1sum))
+    Files are checked in parallel, least recently verified first.  The
+    time of the check is stored after each batch, so with a `time_limit`
+    (in seconds) a large pool can be verified over several runs.
+    Mismatches are also appended to the file `report` as JSON lines.
+    Files not in any archive are reported and recorded as failed.
+    """
+    session = DBConn().session()
+    deadline = time.time() + time_limit if time_limit else None
+    batch_size = 256
 
-        fi.seek(0)
-        sha256sum = apt_pkg.sha256sum(fi)
-        if sha256sum != f.sha256sum:
-            utils.warn("**WARNING** sha256sum mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (filename, sha256sum, f.sha256sum))
-        fi.close()
+    print("Getting file information from database...")
+    file_ids = [file_id for file_id, in session.execute("""
+        SELECT f.id
+          FROM files f
+          LEFT JOIN files_verified v ON v.file_id = f.id
+         ORDER BY v.verified NULLS FIRST, f.id
+    """)]
+
+    def mismatch(entry, message):
+        utils.warn(message)
+        if report_fh is not None:
+            report_fh.write(json.dumps(entry, sort_keys=True) + "\n")
+            report_fh.flush()
 
-    print("Done.")
+    print("Checking file checksums & sizes...")
+    checked = failed = 0
+    report_fh = open(report, 'a') if report else None
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for start in range(0, len(file_ids), batch_size):
+                if deadline is not None and time.time() >= deadline:
+                    print("Time limit reached.")
+                    break
+
+                rows = session.execute(_checksums_batch_query,
+                                       {'file_ids': file_ids[start:start + batch_size]}).fetchall()
+                filenames = [os.path.join(row.path, 'pool', row.name, row.filename)
+                             for row in rows if row.path is not None]
+                results = zip(filenames, executor.map(_checksum_pool_file, filenames, chunksize=8))
+
+                verified_ids = []
+                verified_ok = []
+                for row in rows:
+                    ok = True
+                    if row.path is None:
+                        ok = False
+                        mismatch({'id': row.id, 'filename': row.filename, 'error': 'not in any archive'},
+                                 "'%s' (id %d) is not in any archive" % (row.filename, row.id))
+                    else:
+                        filename, (current, error) = next(results)
+                        if error is not None:
+                            ok = False
+                            mismatch({'id': row.id, 'filename': filename, 'error': error},
+                                     "can't open '%s': %s" % (filename, error))
+                        else:
+                            for field, expected, value in zip(('size', 'md5sum', 'sha1sum', 'sha256sum'),
+                                                              (row.size, row.md5sum, row.sha1sum, row.sha256sum),
+                                                              current):
+                                if value != expected:
+                                    ok = False
+                                    mismatch({'id': row.id, 'filename': filename, 'field': field,
+                                              'expected': expected, 'current': value},
+                                             "**WARNING** %s mismatch for '%s' ('%s' [current] vs. '%s' [db])." % (field, filename, value, expected))
+                    verified_ids.append(row.id)
+                    verified_ok.append(ok)
+                    failed += not ok
+
+                session.execute("""
+                    INSERT INTO files_verified (file_id, ok)
+                    SELECT * FROM unnest(CAST(:file_ids AS INTEGER[]), CAST(:ok AS BOOLEAN[]))
+                    ON CONFLICT (file_id) DO UPDATE SET verified = CURRENT_TIMESTAMP, ok = EXCLUDED.ok
+                """, {'file_ids': verified_ids, 'ok': verified_ok})
+                session.commit()
+                checked += len(verified_ids)
+    finally:
+        if report_fh is not None:
+            report_fh.close()
+
+    print("Done: checked %d of %d files, %d failed." % (checked, len(file_ids), failed))
 
 ################################################################################
 #
@@ -549,7 +630,10 @@ def main():
 
     cnf = Config()
 
-    Arguments = [('h', "help", "Check-Archive::Options::Help")]
+    Arguments = [('h', "help", "Check-Archive::Options::Help"),
+                 ('j', "jobs", "Check-Archive::Options::Jobs", "HasArg"),
+                 ('t', "time-limit", "Check-Archive::Options::Time-Limit", "HasArg"),
+                 ('r', "report", "Check-Archive::Options::Report", "HasArg")]
     for i in ["help"]:
         key = "Check-Archive::Options::%s" % i
         if key not in cnf:
@@ -573,7 +657,10 @@ def main():
     DBConn()
 
     if mode == "checksums":
-        check_checksums()
+        time_limit = Options.find_i("Time-Limit") * 60 if "Time-Limit" in Options else None
+        check_checksums(jobs=Options.find_i("Jobs") or None,
+                        time_limit=time_limit,
+                        report=Options.get("Report"))
     elif mode == "files":
         check_files()
     elif mode == "dsc-syntax":
@@ -83,6 +83,9 @@ OPTIONS for generate
 OPTIONS for scan-source and scan-binary
      -l, --limit=NUMBER
         maximum number of packages to scan
+
+     -b, --batch-size=NUMBER
+        number of packages handed to a worker at a time (default: 100)
 """)
     sys.exit(exit_code)
 
@@ -97,23 +100,25 @@ def write_all(cnf, archive_names=[], suite_names=[], component_names=[], force=N
 ################################################################################
 
 
-def binary_scan_all(cnf, limit):
+def binary_scan_all(cnf, limit, batch_size):
     Logger = daklog.Logger('contents scan-binary')
-    result = BinaryContentsScanner.scan_all(limit)
+    result = BinaryContentsScanner.scan_all(limit, batch_size)
     processed = '%(processed)d packages processed' % result
     remaining = '%(remaining)d packages remaining' % result
-    Logger.log([processed, remaining])
+    rate = '%(rate).1f packages/s' % result
+    Logger.log([processed, remaining, rate])
     Logger.close()
 
 ################################################################################
 
 
-def source_scan_all(cnf, limit):
+def source_scan_all(cnf, limit, batch_size):
     Logger = daklog.Logger('contents scan-source')
-    result = SourceContentsScanner.scan_all(limit)
+    result = SourceContentsScanner.scan_all(limit, batch_size)
     processed = '%(processed)d packages processed' % result
     remaining = '%(remaining)d packages remaining' % result
-    Logger.log([processed, remaining])
+    rate = '%(rate).1f packages/s' % result
+    Logger.log([processed, remaining, rate])
     Logger.close()
 
 ################################################################################
@@ -125,12 +130,14 @@ def main():
     cnf['Contents::Options::Suite'] = ''
     cnf['Contents::Options::Component'] = ''
     cnf['Contents::Options::Limit'] = ''
+    cnf['Contents::Options::BatchSize'] = ''
     cnf['Contents::Options::Force'] = ''
     arguments = [('h', "help",      'Contents::Options::Help'),
                  ('a', 'archive',   'Contents::Options::Archive',   'HasArg'),
                  ('s', "suite",     'Contents::Options::Suite',     "HasArg"),
                  ('c', "component", 'Contents::Options::Component', "HasArg"),
                  ('l', "limit",     'Contents::Options::Limit',     "HasArg"),
+                 ('b', "batch-size", 'Contents::Options::BatchSize', "HasArg"),
                  ('f', "force",     'Contents::Options::Force'),
                 ]
     args = apt_pkg.parse_commandline(cnf.Cnf, arguments, sys.argv)
@@ -143,12 +150,16 @@ def main():
     if len(options['Limit']) > 0:
         limit = int(options['Limit'])
 
+    batch_size = 100
+    if len(options['BatchSize']) > 0:
+        batch_size = int(options['BatchSize'])
+
     if args[0] == 'scan-source':
-        source_scan_all(cnf, limit)
+        source_scan_all(cnf, limit, batch_size)
         return
 
     if args[0] == 'scan-binary':
-        binary_scan_all(cnf, limit)
+        binary_scan_all(cnf, limit, batch_size)
         return
 
     archive_names = utils.split_args(options['Archive'])
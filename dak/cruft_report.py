@@ -50,8 +50,6 @@ from daklib.cruft import *
 
 ################################################################################
 
-no_longer_in_suite = {} # Really should be static to add_nbs, but I'm lazy
-
 source_binaries = {}
 source_versions = {}
 
@@ -95,18 +93,10 @@ def print_cmd(s, indent=4):
 ################################################################################
 
 
-def add_nbs(nbs_d, source, version, package, suite_id, session):
+def add_nbs(nbs_d, source, version, package, relations):
     # Ensure the package is still in the suite (someone may have already removed it)
-    if package in no_longer_in_suite:
+    if not relations.has_package(package):
         return
-    else:
-        q = session.execute("""SELECT b.id FROM binaries b, bin_associations ba
-                                WHERE ba.bin = b.id AND ba.suite = :suite_id
-                                  AND b.package = :package LIMIT 1""", {'suite_id': suite_id,
-                                                                         'package': package})
-        if not q.fetchall():
-            no_longer_in_suite[package] = ""
-            return
 
     nbs_d[source][version].add(package)
 
@@ -115,7 +105,7 @@ def add_nbs(nbs_d, source, version, package, suite_id, session):
 # Check for packages built on architectures they shouldn't be.
 
 
-def do_anais(architecture, binaries_list, source, session):
+def do_anais(architecture, binaries_list, source, relations):
     if architecture == "any" or architecture == "all":
         return ""
 
@@ -125,12 +115,7 @@ def do_anais(architecture, binaries_list, source, session):
     for arch in architecture.split():
         architectures[arch.strip()] = ""
     for binary in binaries_list:
-        q = session.execute("""SELECT a.arch_string, b.version
-                                FROM binaries b, bin_associations ba, architecture a
-                               WHERE ba.suite = :suiteid AND ba.bin = b.id
-                                 AND b.architecture = a.id AND b.package = :package""",
-                             {'suiteid': suite_id, 'package': binary})
-        ql = q.fetchall()
+        ql = relations.versions(binary)
         versions = []
         for arch, version in ql:
             if arch in architectures:
@@ -402,35 +387,42 @@ SELECT ss.src, ss.source, ss.version,
     return session.execute(query, args)
 
 
-def source_bin(source, session):
-    """returns binaries built by source for all or no suite grouped and
-    ordered by package name"""
+def source_bin(sources, session):
+    """returns binaries built by each of sources for all or no suite as
+    a dict mapping the source to package names ordered by package name"""
 
     query = """
-SELECT b.package
+SELECT sas.source, b.package
     FROM binaries b
     JOIN src_associations_src sas ON b.source = sas.src
-    WHERE sas.source = :source
-    GROUP BY b.package
-    ORDER BY b.package"""
-    args = {'source': source}
-    return session.execute(query, args)
+    WHERE sas.source = ANY(:sources)
+    GROUP BY sas.source, b.package
+    ORDER BY sas.source, b.package"""
+    args = {'sources': list(sources)}
+    result = defaultdict(list)
+    for source, package in session.execute(query, args):
+        result[source].append(package)
+    return result
 
 
-def newest_source_bab(suite_name, package, session):
-    """returns newest source that builds binary package in suite grouped
-    and sorted by source and package name"""
+def newest_source_bab(suite_name, packages, session):
+    """returns newest source that builds each of the binary packages in
+    suite as a dict mapping the package to (source, version) tuples
+    sorted by source name"""
 
     query = """
-SELECT sas.source, MAX(sas.version) AS srcver
+SELECT bab.package, sas.source, MAX(sas.version) AS srcver
     FROM src_associations_src sas
     JOIN bin_associations_binaries bab ON sas.src = bab.source
     JOIN suite s on s.id = bab.suite
-    WHERE s.suite_name = :suite_name AND bab.package = :package
+    WHERE s.suite_name = :suite_name AND bab.package = ANY(:packages)
         GROUP BY sas.source, bab.package
         ORDER BY sas.source, bab.package"""
-    args = {'suite_name': suite_name, 'package': package}
-    return session.execute(query, args)
+    args = {'suite_name': suite_name, 'packages': list(packages)}
+    result = defaultdict(list)
+    for package, source, srcver in session.execute(query, args):
+        result[package].append((source, srcver))
+    return result
 
 
 def report_obsolete_source(suite_name, session):
@@ -440,15 +432,16 @@ def report_obsolete_source(suite_name, session):
     print_info("""Obsolete source packages in suite %s
 ----------------------------------%s\n""" %
         (suite_name, '-' * len(suite_name)))
-    for os_row in rows.fetchall():
+    os_rows = rows.fetchall()
+    built = source_bin(set(os_row[1] for os_row in os_rows), session)
+    newest = newest_source_bab(suite_name, set(p for ps in built.values() for p in ps), session)
+    for os_row in os_rows:
         (src, old_source, version, install_date) = os_row
         print_info(" * obsolete source %s version %s installed at %s" %
             (old_source, version, install_date))
-        for sb_row in source_bin(old_source, session):
-            (package, ) = sb_row
+        for package in built[old_source]:
             print_info("   - has built binary %s" % package)
-            for nsb_row in newest_source_bab(suite_name, package, session):
-                (new_source, srcver) = nsb_row
+            for new_source, srcver in newest[package]:
                 print_info("     currently built by source %s version %s" %
                     (new_source, srcver))
         print_info("   - suggested command:")
@@ -456,20 +449,6 @@ def report_obsolete_source(suite_name, session):
         print_cmd("dak rm -s %s %s %s\n" % (suite_name, rm_opts, old_source))
 
 
-def get_suite_binaries(suite, session):
-    # Initalize a large hash table of all binary packages
-    binaries = {}
-
-    print_info("Getting a list of binary packages in %s..." % suite.suite_name)
-    q = session.execute("""SELECT distinct b.package
-                             FROM binaries b, bin_associations ba
-                            WHERE ba.suite = :suiteid AND ba.bin = b.id""",
-                           {'suiteid': suite.suite_id})
-    for i in q.fetchall():
-        binaries[i[0]] = ""
-
-    return binaries
-
 ################################################################################
 
 
@@ -606,7 +585,6 @@ def main():
     bin_pkgs = {}
     src_pkgs = {}
     bin2source = {}
-    bins_in_suite = {}
     nbs = defaultdict(lambda: defaultdict(set))
     source_versions = {}
 
@@ -635,8 +613,12 @@ def main():
 
     bin_not_built = defaultdict(set)
 
-    if "bnb" in checks:
-        bins_in_suite = get_suite_binaries(suite, session)
+    # The remaining checks look up binary packages of the suite one by
+    # one; load them all at once.
+    relations = None
+    if any(check in checks for check in ("bnb", "anais", "bms", "dubious nbs")):
+        print_info("Getting a list of binary packages in %s..." % suite.suite_name)
+        relations = SuiteRelations(suite_id, session)
 
     # Checks based on the Sources files
     components = [c.component_name for c in suite.components]
@@ -654,11 +636,11 @@ def main():
                 if "bnb" in checks:
                     # Check for binaries not built on any architecture.
                     for binary in binaries_list:
-                        if binary not in bins_in_suite:
+                        if not relations.has_package(binary):
                             bin_not_built[source].add(binary)
 
                 if "anais" in checks:
-                    anais_output += do_anais(architecture, binaries_list, source, session)
+                    anais_output += do_anais(architecture, binaries_list, source, relations)
 
                 # build indices for checking "no source" later
                 source_index = component + '/' + source
@@ -716,12 +698,13 @@ def main():
     # Distinguish dubious (version numbers match) and 'real' NBS (they don't)
     dubious_nbs = defaultdict(lambda: defaultdict(set))
     version_sort_key = functools.cmp_to_key(apt_pkg.version_compare)
-    for source in nbs:
-        for package in nbs[source]:
-            latest_version = max(nbs[source][package], key=version_sort_key)
-            source_version = source_versions.get(source, "0")
-            if apt_pkg.version_compare(latest_version, source_version) == 0:
-                add_nbs(dubious_nbs, source, latest_version, package, suite_id, session)
+    if "dubious nbs" in checks:
+        for source in nbs:
+            for package in nbs[source]:
+                latest_version = max(nbs[source][package], key=version_sort_key)
+                source_version = source_versions.get(source, "0")
+                if apt_pkg.version_compare(latest_version, source_version) == 0:
+                    add_nbs(dubious_nbs, source, latest_version, package, relations)
 
     if "nviu" in checks:
         do_newer_version('unstable', 'experimental', 'NVIU', session)
@@ -748,7 +731,7 @@ def main():
         print_info()
 
     if "bms" in checks:
-        report_multiple_source(suite)
+        report_multiple_source(suite, relations)
 
     if "anais" in checks:
         print_info("Architecture Not Allowed In Source")
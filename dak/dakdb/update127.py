@@ -0,0 +1,90 @@
+"""
+Add cache for the metadata part of Packages stanzas
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+
+statements = [
+"""
+CREATE TABLE binaries_stanza_cache (
+  bin_id INTEGER NOT NULL REFERENCES binaries(id) ON DELETE CASCADE,
+  long_description BOOLEAN NOT NULL,
+  stanza TEXT,
+  PRIMARY KEY (bin_id, long_description)
+)
+""",
+"""
+COMMENT ON TABLE binaries_stanza_cache
+  IS 'Rendered binaries_metadata part of Packages stanzas (everything but the override and file fields)'
+""",
+"""
+CREATE OR REPLACE FUNCTION trigger_binaries_stanza_cache_invalidate() RETURNS TRIGGER
+  LANGUAGE plpgsql
+  SET search_path = public, pg_temp
+AS $$
+BEGIN
+  CASE TG_TABLE_NAME
+    WHEN 'binaries_metadata' THEN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM binaries_stanza_cache WHERE bin_id = OLD.bin_id;
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        DELETE FROM binaries_stanza_cache WHERE bin_id = NEW.bin_id;
+      END IF;
+    WHEN 'metadata_keys' THEN
+      DELETE FROM binaries_stanza_cache;
+    ELSE RAISE EXCEPTION 'trigger called for invalid table (%)', TG_TABLE_NAME;
+  END CASE;
+  RETURN NULL;
+END;
+$$
+""",
+"""
+CREATE TRIGGER binaries_stanza_cache_invalidate
+  AFTER INSERT OR UPDATE OR DELETE ON binaries_metadata
+  FOR EACH ROW EXECUTE PROCEDURE trigger_binaries_stanza_cache_invalidate()
+""",
+"""
+CREATE TRIGGER binaries_stanza_cache_invalidate
+  AFTER UPDATE OR DELETE ON metadata_keys
+  FOR EACH STATEMENT EXECUTE PROCEDURE trigger_binaries_stanza_cache_invalidate()
+""",
+]
+
+################################################################################
+
+
+def do_update(self):
+    print(__doc__)
+    try:
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '127' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 127, rollback issued. Error message: {0}'.format(msg))
@@ -0,0 +1,64 @@
+"""
+Add cache for the hashes of files listed in Release files
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+
+statements = [
+"""
+CREATE TABLE release_hash_cache (
+  suite_id INTEGER NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+  path TEXT NOT NULL,
+  inode BIGINT NOT NULL,
+  size BIGINT NOT NULL,
+  mtime_ns BIGINT NOT NULL,
+  len BIGINT NOT NULL,
+  md5sum TEXT NOT NULL,
+  sha1 TEXT NOT NULL,
+  sha256 TEXT NOT NULL,
+  PRIMARY KEY (suite_id, path)
+)
+""",
+"""
+COMMENT ON TABLE release_hash_cache
+  IS 'Length and hashes of files listed in Release files, valid as long as the file read to compute them (identified by inode, size and mtime) is unchanged'
+""",
+]
+
+################################################################################
+
+
+def do_update(self):
+    print(__doc__)
+    try:
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '128' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 128, rollback issued. Error message: {0}'.format(msg))
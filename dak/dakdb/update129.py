@@ -0,0 +1,81 @@
+"""
+Add a per-suite index of binary contents
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+
+statements = [
+"""
+CREATE TABLE suite_contents_binaries (
+  suite_id INTEGER NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+  architecture_id INTEGER NOT NULL REFERENCES architecture(id) ON DELETE CASCADE,
+  type TEXT NOT NULL,
+  binary_id INTEGER NOT NULL REFERENCES binaries(id) ON DELETE CASCADE,
+  PRIMARY KEY (suite_id, architecture_id, type, binary_id)
+)
+""",
+"""
+COMMENT ON TABLE suite_contents_binaries
+  IS 'Binaries whose contents are included in suite_contents for a Contents-$arch file'
+""",
+"""
+CREATE TABLE suite_contents (
+  suite_id INTEGER NOT NULL,
+  architecture_id INTEGER NOT NULL,
+  type TEXT NOT NULL,
+  binary_id INTEGER NOT NULL,
+  package TEXT NOT NULL,
+  file TEXT NOT NULL,
+  FOREIGN KEY (suite_id, architecture_id, type, binary_id)
+    REFERENCES suite_contents_binaries (suite_id, architecture_id, type, binary_id) ON DELETE CASCADE
+)
+""",
+"""
+COMMENT ON TABLE suite_contents
+  IS 'Contents of the newest version of each binary package in a suite, per Contents-$arch file'
+""",
+"""
+CREATE INDEX suite_contents_file ON suite_contents (suite_id, architecture_id, type, file)
+""",
+"""
+CREATE INDEX suite_contents_binary ON suite_contents (binary_id)
+""",
+]
+
+################################################################################
+
+
+def do_update(self):
+    print(__doc__)
+    try:
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '129' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 129, rollback issued. Error message: {0}'.format(msg))
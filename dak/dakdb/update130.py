@@ -0,0 +1,124 @@
+"""
+Queue association changes for incremental domination
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+
+statements = [
+"""
+CREATE TABLE dominate_state (
+  suite_id INTEGER PRIMARY KEY REFERENCES suite(id) ON DELETE CASCADE,
+  dominated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+)
+""",
+"""
+COMMENT ON TABLE dominate_state
+  IS 'Suites that were completely dominated; association changes in them are queued in dominate_queue'
+""",
+"""
+CREATE TABLE dominate_queue (
+  id SERIAL PRIMARY KEY,
+  suite_id INTEGER NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+  source TEXT NOT NULL,
+  package TEXT
+)
+""",
+"""
+COMMENT ON TABLE dominate_queue
+  IS 'Source (and for binaries, package) names whose associations changed since the suite was last dominated'
+""",
+"""
+CREATE INDEX dominate_queue_suite_id ON dominate_queue (suite_id)
+""",
+"""
+CREATE OR REPLACE FUNCTION trigger_dominate_queue() RETURNS TRIGGER
+  LANGUAGE plpgsql
+  SET search_path = public, pg_temp
+AS $$
+BEGIN
+  CASE TG_TABLE_NAME
+    WHEN 'bin_associations' THEN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO dominate_queue (suite_id, source, package)
+          SELECT OLD.suite, source.source, binaries.package
+            FROM binaries JOIN source ON source.id = binaries.source
+           WHERE binaries.id = OLD.bin
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = OLD.suite);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO dominate_queue (suite_id, source, package)
+          SELECT NEW.suite, source.source, binaries.package
+            FROM binaries JOIN source ON source.id = binaries.source
+           WHERE binaries.id = NEW.bin
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = NEW.suite);
+      END IF;
+    WHEN 'src_associations' THEN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO dominate_queue (suite_id, source)
+          SELECT OLD.suite, source.source
+            FROM source
+           WHERE source.id = OLD.source
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = OLD.suite);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO dominate_queue (suite_id, source)
+          SELECT NEW.suite, source.source
+            FROM source
+           WHERE source.id = NEW.source
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = NEW.suite);
+      END IF;
+    ELSE RAISE EXCEPTION 'trigger called for invalid table (%)', TG_TABLE_NAME;
+  END CASE;
+  RETURN NULL;
+END;
+$$
+""",
+"""
+CREATE TRIGGER dominate_queue
+  AFTER INSERT OR UPDATE OR DELETE ON bin_associations
+  FOR EACH ROW EXECUTE PROCEDURE trigger_dominate_queue()
+""",
+"""
+CREATE TRIGGER dominate_queue
+  AFTER INSERT OR UPDATE OR DELETE ON src_associations
+  FOR EACH ROW EXECUTE PROCEDURE trigger_dominate_queue()
+""",
+]
+
+################################################################################
+
+
+def do_update(self):
+    print(__doc__)
+    try:
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '130' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 130, rollback issued. Error message: {0}'.format(msg))
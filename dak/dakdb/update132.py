@@ -0,0 +1,94 @@
+"""
+Do not queue the associations removed by dominate itself
+
+@contact: Debian FTP Master <ftpmaster@debian.org>
+@license: GNU General Public License version 2 or later
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+################################################################################
+
+import psycopg2
+from daklib.dak_exceptions import DBUpdateError
+
+statements = [
+"""
+CREATE OR REPLACE FUNCTION trigger_dominate_queue() RETURNS TRIGGER
+  LANGUAGE plpgsql
+  SET search_path = public, pg_temp
+AS $$
+BEGIN
+  -- dominate only removes associations whose removal does not change
+  -- what else is dominated
+  IF TG_OP = 'DELETE' AND current_setting('dak.skip_dominate_queue', true) = 'true' THEN
+    RETURN NULL;
+  END IF;
+  CASE TG_TABLE_NAME
+    WHEN 'bin_associations' THEN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO dominate_queue (suite_id, source, package)
+          SELECT OLD.suite, source.source, binaries.package
+            FROM binaries JOIN source ON source.id = binaries.source
+           WHERE binaries.id = OLD.bin
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = OLD.suite);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO dominate_queue (suite_id, source, package)
+          SELECT NEW.suite, source.source, binaries.package
+            FROM binaries JOIN source ON source.id = binaries.source
+           WHERE binaries.id = NEW.bin
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = NEW.suite);
+      END IF;
+    WHEN 'src_associations' THEN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO dominate_queue (suite_id, source)
+          SELECT OLD.suite, source.source
+            FROM source
+           WHERE source.id = OLD.source
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = OLD.suite);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO dominate_queue (suite_id, source)
+          SELECT NEW.suite, source.source
+            FROM source
+           WHERE source.id = NEW.source
+             AND EXISTS (SELECT 1 FROM dominate_state WHERE suite_id = NEW.suite);
+      END IF;
+    ELSE RAISE EXCEPTION 'trigger called for invalid table (%)', TG_TABLE_NAME;
+  END CASE;
+  RETURN NULL;
+END;
+$$
+""",
+]
+
+################################################################################
+
+
+def do_update(self):
+    print(__doc__)
+    try:
+        c = self.db.cursor()
+
+        for stmt in statements:
+            c.execute(stmt)
+
+        c.execute("UPDATE config SET value = '132' WHERE name = 'db_revision'")
+        self.db.commit()
+
+    except psycopg2.ProgrammingError as msg:
+        self.db.rollback()
+        raise DBUpdateError('Unable to apply sick update 132, rollback issued. Error message: {0}'.format(msg))
@@ -36,7 +36,21 @@ Options = None
 Logger = None
 
 
-def retrieve_associations(suites, session):
+def retrieve_associations(suites, session, sources=None, packages=None):
+    """
+    Find associations obsoleted by newer versions in `suites`.
+
+    If `sources` and `packages` are given, only source packages with a
+    name in `sources` and binary packages with a name in `packages` are
+    considered.  The two sets must be closed as returned by
+    :func:`affected_packages` for the result to be meaningful.
+    """
+    if sources is None:
+        source_filter = binary_filter = ''
+    else:
+        source_filter = 'AND source.source = ANY(:sources)'
+        binary_filter = 'AND binaries.package = ANY(:packages)'
+
     return session.execute(text('''
 WITH
   -- Provide (source, suite) tuple of all source packages to remain
@@ -58,6 +72,7 @@ WITH
             INNER JOIN src_associations ON
               src_associations.source = source.id
               AND src_associations.suite = ANY(:suite_ids)
+              {source_filter}
         ) AS source_ranked
       WHERE
         version_rank = 1
@@ -98,6 +113,7 @@ WITH
             INNER JOIN bin_associations ON
               bin_associations.bin = binaries.id
               AND bin_associations.suite = ANY(:suite_ids)
+              {binary_filter}
             INNER JOIN architecture ON architecture.id = binaries.architecture
         ) AS source_rank
       WHERE
@@ -123,6 +139,7 @@ WITH
         INNER JOIN src_associations ON
           src_associations.source = source.id
           AND src_associations.suite = ANY(:suite_ids)
+          {source_filter}
         INNER join suite ON suite.id = src_associations.suite
         LEFT JOIN remain_binaries ON
           remain_binaries.source_id = source.id
@@ -150,6 +167,7 @@ WITH
         INNER JOIN bin_associations ON
           bin_associations.bin = binaries.id
           AND bin_associations.suite = ANY(:suite_ids)
+          {binary_filter}
         INNER JOIN architecture ON architecture.id = binaries.architecture
         INNER join suite ON suite.id = bin_associations.suite
         LEFT JOIN remain_binaries ON
@@ -177,6 +195,7 @@ WITH
         INNER JOIN bin_associations ON
           bin_associations.bin = binaries.id
           AND bin_associations.suite = ANY(:suite_ids)
+          {binary_filter}
         INNER JOIN architecture ON architecture.id = binaries.architecture
         INNER join suite ON suite.id = bin_associations.suite
         LEFT JOIN remain_binaries ON
@@ -206,11 +225,159 @@ SELECT
     dominate_binaries_all
   ORDER BY
     source_package, source_version, package, version, arch, suite
-''').params(
+'''.format(source_filter=source_filter, binary_filter=binary_filter)).params(
     suite_ids=[s.suite_id for s in suites],
+    sources=sorted(sources or ()),
+    packages=sorted(packages or ()),
 ))
 
 
+def queued_changes(suites, session):
+    """
+    Return the association changes queued for `suites` since they were
+    last dominated, and the ids of all queued entries.
+
+    The changes map the id of every completely dominated suite to a
+    (source names, binary package names) tuple.  Suites missing from it
+    have to be looked at in full.
+    """
+    suite_ids = [s.suite_id for s in suites]
+    changes = {suite_id: (set(), set()) for suite_id, in session.execute(text('''
+        SELECT suite_id FROM dominate_state WHERE suite_id = ANY(:suite_ids)
+    ''').params(suite_ids=suite_ids))}
+
+    queue_ids = []
+    for queue_id, suite_id, source, package in session.execute(text('''
+        SELECT id, suite_id, source, package
+          FROM dominate_queue
+         WHERE suite_id = ANY(:suite_ids)
+    ''').params(suite_ids=suite_ids)):
+        queue_ids.append(queue_id)
+        if suite_id not in changes:
+            continue
+        sources, packages = changes[suite_id]
+        sources.add(source)
+        if package is not None:
+            packages.add(package)
+
+    return changes, queue_ids
+
+
+def affected_packages(suites, sources, packages, session):
+    """
+    Extend changed source and binary package names to all packages
+    whose domination can depend on them.
+
+    Binaries are ranked per package name, but keep their source and
+    (for arch-any binaries) the arch-all binaries of their source.  So
+    all binaries built from a source in `sources` and the sources of all
+    binaries in `packages` have to be looked at as well, up to a fixed
+    point.
+    """
+    suite_ids = [s.suite_id for s in suites]
+    sources, packages = set(sources), set(packages)
+    new_sources, new_packages = set(sources), set(packages)
+
+    while new_sources or new_packages:
+        found = set(package for package, in session.execute(text('''
+            SELECT DISTINCT binaries.package
+              FROM binaries
+              JOIN source ON source.id = binaries.source
+              JOIN bin_associations ON bin_associations.bin = binaries.id
+             WHERE bin_associations.suite = ANY(:suite_ids)
+               AND source.source = ANY(:sources)
+        ''').params(suite_ids=suite_ids, sources=sorted(new_sources))))
+        new_packages |= found - packages
+        packages |= found
+
+        found = set(source for source, in session.execute(text('''
+            SELECT DISTINCT source.source
+              FROM binaries
+              JOIN source ON source.id = binaries.source
+              JOIN bin_associations ON bin_associations.bin = binaries.id
+             WHERE bin_associations.suite = ANY(:suite_ids)
+               AND binaries.package = ANY(:packages)
+        ''').params(suite_ids=suite_ids, packages=sorted(new_packages))))
+        new_sources = found - sources
+        new_packages = set()
+        sources |= found
+
+    return sources, packages
+
+
+def retrieve_associations_incremental(suites, changes, session):
+    """
+    Like :func:`retrieve_associations`, but only look at packages whose
+    associations changed since their suite was last dominated.
+
+    `changes` is the first element returned by :func:`queued_changes`.
+    """
+    full = [s for s in suites if s.suite_id not in changes]
+    assocs = list(retrieve_associations(full, session)) if full else []
+
+    for suite in suites:
+        if suite.suite_id not in changes:
+            continue
+        sources, packages = changes[suite.suite_id]
+        if not sources:
+            continue
+        sources, packages = affected_packages([suite], sources, packages, session)
+        assocs.extend(retrieve_associations([suite], session, sources, packages))
+
+    return assocs
+
+
+def verify_associations(assocs, suites, session):
+    """
+    Compare the result of an incremental run with the full query and
+    abort if they differ.
+    """
+    expected = set(tuple(a) for a in retrieve_associations(suites, session))
+    got = set(tuple(a) for a in assocs)
+    if expected == got:
+        return
+
+    headers = ('source package', 'source version', 'package', 'version', 'arch', 'suite', 'id')
+    if expected - got:
+        print("Missed by incremental domination:")
+        print(tabulate(sorted(expected - got), headers, tablefmt="orgtbl"))
+    if got - expected:
+        print("Only found by incremental domination:")
+        print(tabulate(sorted(got - expected), headers, tablefmt="orgtbl"))
+    utils.fubar("incremental domination differs from full domination")
+
+
+def update_dominate_state(suites, queue_ids, session):
+    """
+    Record that `suites` are completely dominated and drop the queued
+    changes that were looked at.
+    """
+    session.execute(text('''
+        DELETE FROM dominate_queue WHERE id = ANY(:queue_ids)
+    ''').params(queue_ids=queue_ids))
+    session.execute(text('''
+        INSERT INTO dominate_state (suite_id)
+        SELECT unnest(CAST(:suite_ids AS INTEGER[]))
+        ON CONFLICT (suite_id) DO UPDATE SET dominated = CURRENT_TIMESTAMP
+    ''').params(suite_ids=[s.suite_id for s in suites]))
+
+
+def prune_dominate_state(suites, session):
+    """
+    Forget the state and queued changes of suites other than `suites`.
+
+    Changes are queued for every suite dominated once, so they would
+    pile up for suites that are not dominated anymore.
+    """
+    session.execute(text('''
+        DELETE FROM dominate_state WHERE suite_id != ALL(:suite_ids)
+    ''').params(suite_ids=[s.suite_id for s in suites]))
+    session.execute(text('''
+        DELETE FROM dominate_queue
+         WHERE NOT EXISTS (SELECT 1 FROM dominate_state WHERE dominate_state.suite_id = dominate_queue.suite_id)
+    '''))
+
+
 def delete_associations_table(table, ids, session):
     result = session.execute(text('''
         DELETE
@@ -235,8 +402,12 @@ def delete_associations(assocs, session):
         else:
             ids_bin.add(e.assoc_id)
 
+    # removing dominated associations does not change what else is
+    # dominated, so keep the trigger from queueing them
+    session.execute(text("SELECT set_config('dak.skip_dominate_queue', 'true', true)"))
     delete_associations_table('bin_associations', ids_bin, session)
     delete_associations_table('src_associations', ids_src, session)
+    session.execute(text("SELECT set_config('dak.skip_dominate_queue', '', true)"))
 
 
 def usage():
@@ -247,6 +418,10 @@ Remove obsolete source and binary associations from suites.
     -h, --help                 show this help and exit
     -n, --no-action            don't commit changes
     -f, --force                also clean up untouchable suites
+    -i, --incremental          only look at packages whose associations
+                               changed since the last run
+    -V, --verify               with --incremental, compare the result with
+                               a full run and abort if they differ
 
 SUITE can be comma (or space) separated list, e.g.
     --suite=testing,unstable""")
@@ -259,10 +434,14 @@ def main():
     Arguments = [('h', "help",      "Obsolete::Options::Help"),
                  ('s', "suite",     "Obsolete::Options::Suite", "HasArg"),
                  ('n', "no-action", "Obsolete::Options::No-Action"),
-                 ('f', "force",     "Obsolete::Options::Force")]
+                 ('f', "force",     "Obsolete::Options::Force"),
+                 ('i', "incremental", "Obsolete::Options::Incremental"),
+                 ('V', "verify",    "Obsolete::Options::Verify")]
     cnf['Obsolete::Options::Help'] = ''
     cnf['Obsolete::Options::No-Action'] = ''
     cnf['Obsolete::Options::Force'] = ''
+    cnf['Obsolete::Options::Incremental'] = ''
+    cnf['Obsolete::Options::Verify'] = ''
     apt_pkg.parse_commandline(cnf.Cnf, Arguments, sys.argv)
     Options = cnf.subtree("Obsolete::Options")
     if Options['Help']:
@@ -276,13 +455,20 @@ def main():
             .query(Suite)
             .order_by(Suite.suite_name)
             .filter(~exists().where(Suite.suite_id == PolicyQueue.suite_id)))
-    if 'Suite' in Options:
-        suites_query = suites_query.filter(Suite.suite_name.in_(utils.split_args(Options['Suite'])))
     if not Options['Force']:
         suites_query = suites_query.filter_by(untouchable=False)
+    all_suites = suites_query.all()
+    if 'Suite' in Options:
+        suites_query = suites_query.filter(Suite.suite_name.in_(utils.split_args(Options['Suite'])))
     suites = suites_query.all()
 
-    assocs = list(retrieve_associations(suites, session))
+    changes, queue_ids = queued_changes(suites, session)
+    if Options['Incremental']:
+        assocs = retrieve_associations_incremental(suites, changes, session)
+        if Options['Verify']:
+            verify_associations(assocs, suites, session)
+    else:
+        assocs = list(retrieve_associations(suites, session))
 
     if Options['No-Action']:
         headers = ('source package', 'source version', 'package', 'version', 'arch', 'suite', 'id')
@@ -291,6 +477,8 @@ def main():
 
     else:
         delete_associations(assocs, session)
+        update_dominate_state(suites, queue_ids, session)
+        prune_dominate_state(all_suites, session)
         session.commit()
 
     if Logger:
@@ -45,18 +45,19 @@ to stdout. Those functions can be used in multithreaded parts of dak.
 import errno
 import hashlib
 import html
+import marshal
 import os
 import re
 import sys
 import apt_pkg
 import shutil
 import subprocess
-import tarfile
 import tempfile
 import threading
 
 from daklib import utils
 from daklib.config import Config
+from daklib.deb import format_members, scan_deb
 from daklib.dbconn import DBConn, get_component_by_package_suite
 from daklib.gpg import SignedFile
 from daklib.regexes import re_version, re_spacestrip, \
@@ -75,6 +76,76 @@ package_relations = {}           #: Store relations of packages for later output
 # default is to not output html.
 use_html = False
 
+#: ArtifactCache for the expensive sections, if any
+artifact_cache = None
+
+#: suite -> DependsIndex used to colour dependencies
+depends_indices = {}
+
+################################################################################
+
+
+class ArtifactCache:
+    """
+    Store sections of the output by the sha256sum of the file they were
+    generated from, so they are only computed once for every file.
+
+    Sections are stored with marshal, which only handles plain values
+    (str, bytes, tuples, ...), so a tampered cache cannot run code.  The
+    cache is best-effort: a section that cannot be stored is just
+    computed again next time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sha256, key):
+        return os.path.join(self.directory, sha256[:2], sha256, key)
+
+    def get(self, sha256, key, compute):
+        path = self._path(sha256, key)
+        try:
+            with open(path, 'rb') as fh:
+                return marshal.load(fh)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        value = compute()
+        tmp_path = "%s.new.%d" % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as fh:
+                marshal.dump(value, fh)
+            os.rename(tmp_path, path)
+        except OSError as e:
+            utils.warn("[examine-package] Cannot cache {0}: {1}".format(path, e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        return value
+
+    def prune(self, keep):
+        """Remove the sections of all files whose sha256sum is not in keep"""
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            for sha256 in os.listdir(prefix_path):
+                if sha256 not in keep:
+                    shutil.rmtree(os.path.join(prefix_path, sha256))
+
+
+def cached(sha256, key, compute):
+    """
+    Return compute(), taken from the artifact cache if there is one and
+    the sha256sum of the file it is computed from is known.
+    """
+    if artifact_cache is None or sha256 is None:
+        return compute()
+    mode = 'html' if use_html else 'text'
+    return artifact_cache.get(sha256, '{0}.{1}'.format(key, mode), compute)
+
 ################################################################################
 
 
@@ -244,7 +315,7 @@ def split_depends(d_str):
     return depends_tree
 
 
-def read_control(filename):
+def read_control(filename, control_data=None):
     recommends = []
     predepends = []
     depends = []
@@ -253,8 +324,9 @@ def read_control(filename):
     arch = ''
 
     try:
-        extracts = utils.deb_extract_control(filename)
-        control = apt_pkg.TagSection(extracts)
+        if control_data is None:
+            control_data = utils.deb_extract_control(filename)
+        control = apt_pkg.TagSection(control_data)
     except:
         print(formatted_text("can't parse control info"))
         raise
@@ -367,12 +439,37 @@ def get_provides(suite):
     return provides
 
 
+def depends_suite_list(suite):
+    if suite == 'experimental':
+        return ['experimental', 'unstable']
+    return [suite]
+
+
+class DependsIndex:
+    """
+    Components of the newest binary packages and the provided virtual
+    packages of a suite, so create_depends_string needs no queries.
+
+    Build it before forking workers to share it with them.
+    """
+
+    def __init__(self, suite, session):
+        self.components = dict(session.execute("""
+            SELECT DISTINCT ON (b.package) b.package, c.name
+              FROM binaries b
+              JOIN bin_associations ba ON ba.bin = b.id
+              JOIN suite s ON s.id = ba.suite
+              JOIN files_archive_map af ON af.file_id = b.file
+              JOIN component c ON c.id = af.component_id
+             WHERE s.suite_name = ANY(:suite_list)
+             ORDER BY b.package, b.version DESC""", {'suite_list': depends_suite_list(suite)}).fetchall())
+        self.provides = get_provides(suite)
+
+
 def create_depends_string(suite, depends_tree, session=None):
     result = ""
-    if suite == 'experimental':
-        suite_list = ['experimental', 'unstable']
-    else:
-        suite_list = [suite]
+    suite_list = depends_suite_list(suite)
+    index = depends_indices.get(suite)
 
     provides = set()
     comma_count = 1
@@ -385,8 +482,11 @@ def create_depends_string(suite, depends_tree, session=None):
                 result += " | "
             # doesn't do version lookup yet.
 
-            component = get_component_by_package_suite(d['name'], suite_list,
-                session=session)
+            if index is not None:
+                component = index.components.get(d['name'])
+            else:
+                component = get_component_by_package_suite(d['name'], suite_list,
+                    session=session)
             if component is not None:
                 adepends = d['name']
                 if d['version'] != '':
@@ -403,7 +503,7 @@ def create_depends_string(suite, depends_tree, session=None):
                 if d['version'] != '':
                     adepends += " (%s)" % (d['version'])
                 if not provides:
-                    provides = get_provides(suite)
+                    provides = index.provides if index is not None else get_provides(suite)
                 if d['name'] in provides:
                     result += colour_output(adepends, "provides")
                 else:
@@ -434,8 +534,8 @@ def output_package_relations():
     return result
 
 
-def output_deb_info(suite, filename, packagename, session=None):
-    (control, control_keys, section, predepends, depends, recommends, arch, maintainer) = read_control(filename)
+def output_deb_info(suite, filename, packagename, session=None, control_data=None):
+    (control, control_keys, section, predepends, depends, recommends, arch, maintainer) = read_control(filename, control_data)
 
     if control == '':
         return formatted_text("no control info")
@@ -509,34 +609,32 @@ def do_lintian(filename):
         return (colour_output("Running lintian failed: %s" % (e), "error"))
 
 
-def extract_one_file_from_deb(deb_filename, match):
-    with tempfile.TemporaryFile() as tmpfh:
-        dpkg_cmd = ('dpkg-deb', '--fsys-tarfile', deb_filename)
-        subprocess.check_call(dpkg_cmd, stdout=tmpfh)
+re_copyright = re.compile(r"\./usr(/share)?/doc/(?P<package>[^/]+)/copyright")
+
 
-        tmpfh.seek(0)
-        with tarfile.open(fileobj=tmpfh, mode="r") as tar:
-            matched_member = None
-            for member in tar:
-                if member.isfile() and match.match(member.name):
-                    matched_member = member
-                    break
+def extract_one_file_from_deb(deb_filename, match):
+    contents = scan_deb(deb_filename, select=match.match)
+    return next(iter(contents.files.items()), (None, None))
 
-            if not matched_member:
-                return None, None
 
-            fh = tar.extractfile(matched_member)
-            matched_data = fh.read()
-            fh.close()
+def read_deb(deb_filename):
+    """
+    Read a binary package once for everything shown about it.
 
-            return matched_member.name, matched_data
+    Returns the control file, the formatted contents listing and the
+    (path, data) of the copyright file.
+    """
+    contents = scan_deb(deb_filename, select=re_copyright.match)
+    cright = next(iter(contents.files.items()), (None, None))
+    return contents.control, formatted_text(format_members(contents.members)), cright
 
 
-def get_copyright(deb_filename):
+def get_copyright(deb_filename, cright_file=None):
     global printed
 
-    re_copyright = re.compile(r"\./usr(/share)?/doc/(?P<package>[^/]+)/copyright")
-    cright_path, cright = extract_one_file_from_deb(deb_filename, re_copyright)
+    if cright_file is None:
+        cright_file = extract_one_file_from_deb(deb_filename, re_copyright)
+    cright_path, cright = cright_file
 
     if not cright_path:
         return formatted_text("WARNING: No copyright found, please check package manually.")
@@ -582,21 +680,35 @@ def get_readme_source(dsc_filename):
     return res
 
 
-def check_dsc(suite, dsc_filename, session=None):
+def check_dsc(suite, dsc_filename, session=None, sha256=None):
+    """
+    With `sha256`, the sha256sum of the .dsc, the lintian output and
+    README.source are taken from the artifact cache.
+    """
     dsc = read_changes_or_dsc(suite, dsc_filename, session)
     dsc_basename = os.path.basename(dsc_filename)
+    lintian_version = get_lintian_version()
     cdsc = foldable_output(dsc_filename, "dsc", dsc, norow=True) + \
            "\n" + \
            foldable_output("lintian {} check for {}".format(
-                get_lintian_version(), dsc_basename),
-               "source-lintian", do_lintian(dsc_filename)) + \
+                lintian_version, dsc_basename),
+               "source-lintian", cached(sha256, 'lintian-' + lintian_version,
+                                        lambda: do_lintian(dsc_filename))) + \
            "\n" + \
            foldable_output("README.source for %s" % dsc_basename,
-               "source-readmesource", get_readme_source(dsc_filename))
+               "source-readmesource", cached(sha256, 'readme-source',
+                                             lambda: get_readme_source(dsc_filename)))
     return cdsc
 
 
-def check_deb(suite, deb_filename, session=None):
+def check_deb(suite, deb_filename, session=None, sha256=None):
+    """
+    The package is read once for the control file, contents and
+    copyright file.  With `sha256`, the sha256sum of the package, these
+    and the lintian output are taken from the artifact cache.  The
+    control file is always rendered as its relations depend on the
+    archive.
+    """
     filename = os.path.basename(deb_filename)
     packagename = filename.split('_')[0]
 
@@ -605,26 +717,30 @@ def check_deb(suite, deb_filename, session=None):
     else:
         is_a_udeb = 0
 
+    control, listing, cright_file = cached(sha256, 'deb', lambda: read_deb(deb_filename))
+
     result = foldable_output("control file for %s" % (filename), "binary-%s-control" % packagename,
-        output_deb_info(suite, deb_filename, packagename, session), norow=True) + "\n"
+        output_deb_info(suite, deb_filename, packagename, session, control), norow=True) + "\n"
 
     if is_a_udeb:
         result += foldable_output("skipping lintian check for udeb",
             "binary-%s-lintian" % packagename, "") + "\n"
     else:
+        lintian_version = get_lintian_version()
         result += foldable_output("lintian {} check for {}".format(
-                                  get_lintian_version(), filename),
-            "binary-%s-lintian" % packagename, do_lintian(deb_filename)) + "\n"
+                                  lintian_version, filename),
+            "binary-%s-lintian" % packagename,
+            cached(sha256, 'lintian-' + lintian_version, lambda: do_lintian(deb_filename))) + "\n"
 
     result += foldable_output("contents of %s" % (filename), "binary-%s-contents" % packagename,
-                              do_command(["dpkg", "-c", deb_filename])) + "\n"
+                              listing) + "\n"
 
     if is_a_udeb:
         result += foldable_output("skipping copyright for udeb",
             "binary-%s-copyright" % packagename, "") + "\n"
     else:
         result += foldable_output("copyright of %s" % (filename),
-            "binary-%s-copyright" % packagename, get_copyright(deb_filename)) + "\n"
+            "binary-%s-copyright" % packagename, get_copyright(deb_filename, cright_file)) + "\n"
 
     return result
 
@@ -32,9 +32,11 @@
 ################################################################################
 
 import asyncio
+import concurrent.futures
 import errno
 import os
 import re
+import shutil
 import sys
 import time
 import traceback
@@ -43,6 +45,7 @@ import apt_pkg
 
 from daklib import utils, pdiff
 from daklib.dbconn import Archive, Component, DBConn, Suite, get_suite, get_suite_architectures
+from daklib.filewriter import read_hash_manifest, staging_path
 from daklib.pdiff import PDiffIndex
 
 re_includeinpdiff = re.compile(r"(Translation-[a-zA-Z_]+\.(?:bz2|xz))")
@@ -110,7 +113,62 @@ async def smartlink(f, t):
         raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), f)
 
 
-async def genchanges(Options, outdir, oldfile, origfile, maxdiffs=56, merged_pdiffs=False):
+def staged_index(staging_dir, origfile, origext):
+    """Find the uncompressed copy of origfile left by the index writers
+
+    Returns its path and size/hashes, or (None, None) unless there is a
+    copy in staging_dir belonging to the current (compressed) origfile.
+    """
+    if not staging_dir or not origext:
+        return None, None
+    path = staging_path(staging_dir, origfile)
+    content = read_hash_manifest(staging_dir, origfile, path)
+    if content is None or read_hash_manifest(staging_dir, origfile, origfile + origext) != content:
+        return None, None
+    return path, pdiff.PDiffHashes(content['len'], content['sha1'], content['sha256'])
+
+
+def store_copy(path, stored_path):
+    """Keep path as the stored copy at stored_path
+
+    The copy is a hard link, unless TempDir is on another filesystem.
+    """
+    try:
+        os.link(path, stored_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(path, stored_path)
+
+
+def read_stored_stat(oldfile):
+    """Return the stat_key() recorded for the stored copy of oldfile
+
+    It is kept next to the stored copy rather than in the public Index.
+    """
+    try:
+        with open(oldfile + ".stat") as fh:
+            return tuple(int(x) for x in fh.read().split())
+    except (OSError, ValueError):
+        return None
+
+
+def write_stored_stat(oldfile, stored_path):
+    tmp_path = "%s.stat.new" % oldfile
+    with open(tmp_path, "w") as fh:
+        fh.write(" ".join(str(x) for x in pdiff.stat_key(os.stat(stored_path))) + "\n")
+    os.rename(tmp_path, oldfile + ".stat")
+
+
+def forget_stored_stat(oldfile):
+    try:
+        os.unlink(oldfile + ".stat")
+    except FileNotFoundError:
+        pass
+
+
+async def genchanges(Options, outdir, oldfile, origfile, maxdiffs=56, merged_pdiffs=False, executor=None,
+                     staging_dir=None):
     if "NoAct" in Options:
         print("Not acting on: od: %s, oldf: %s, origf: %s, md: %s" % (outdir, oldfile, origfile, maxdiffs))
         return
@@ -128,9 +186,19 @@ async def genchanges(Options, outdir, oldfile, origfile, maxdiffs=56, merged_pdi
     if not origstat:
         print("%s: doesn't exist" % (origfile))
         return
-    # orig file with the (new) compression extension in case it changed
-    old_full_path = oldfile + origext
-    resolved_orig_path = os.path.realpath(origfile + origext)
+
+    # If the writer left an uncompressed copy of origfile, use it instead
+    # of decompressing origfile, and keep it as the stored copy so it does
+    # not need to be decompressed next time either.
+    staged_path, newsizehashes = staged_index(staging_dir, origfile, origext)
+    if staged_path is not None:
+        old_full_path = oldfile
+        resolved_orig_path = staged_path
+        origstat = os.stat(staged_path)
+    else:
+        # orig file with the (new) compression extension in case it changed
+        old_full_path = oldfile + origext
+        resolved_orig_path = os.path.realpath(origfile + origext)
 
     if not oldstat:
         print("%s: initial run" % origfile)
@@ -138,36 +206,48 @@ async def genchanges(Options, outdir, oldfile, origfile, maxdiffs=56, merged_pdi
         # in a previous run.
         if os.path.islink(old_full_path):
             os.unlink(old_full_path)
-        os.link(resolved_orig_path, old_full_path)
+        # an existing Index does not describe the new stored copy
+        forget_stored_stat(oldfile)
+        store_copy(resolved_orig_path, old_full_path)
         return
 
     if oldstat[1:3] == origstat[1:3]:
         return
 
-    upd = PDiffIndex(outdir, int(maxdiffs), merged_pdiffs)
+    upd = PDiffIndex(outdir, int(maxdiffs), merged_pdiffs, executor)
 
     if "CanonicalPath" in Options:
         upd.can_path = Options["CanonicalPath"]
 
-    # generate_and_add_patch_file needs an uncompressed file
-    # The `newfile` variable is our uncompressed copy of 'oldfile` thanks to
-    # smartlink
-    newfile = oldfile + ".new"
-    if os.path.exists(newfile):
-        os.unlink(newfile)
+    # The Index records the hashes of the stored copy; no need to read it
+    # again just to compute them.
+    oldsizehashes = upd.current_hashes(read_stored_stat(oldfile), oldstat)
+
+    if staged_path is not None:
+        await upd.generate_and_add_patch_file(oldfile, staged_path, patchname, oldsizehashes, newsizehashes)
+    else:
+        # generate_and_add_patch_file needs an uncompressed file
+        # The `newfile` variable is our uncompressed copy of 'oldfile` thanks to
+        # smartlink
+        newfile = oldfile + ".new"
+        if os.path.exists(newfile):
+            os.unlink(newfile)
 
-    await smartlink(origfile, newfile)
+        await smartlink(origfile, newfile)
 
-    try:
-        await upd.generate_and_add_patch_file(oldfile, newfile, patchname)
-    finally:
-        os.unlink(newfile)
+        try:
+            await upd.generate_and_add_patch_file(oldfile, newfile, patchname, oldsizehashes)
+        finally:
+            os.unlink(newfile)
 
     upd.prune_patch_history()
 
     for obsolete_patch in upd.find_obsolete_patches():
         tryunlink(obsolete_patch)
 
+    # The new Index describes the new stored copy; forget the stat of
+    # the old one until it is replaced.
+    forget_stored_stat(oldfile)
     upd.update_index()
 
     if oldfile + oldext != old_full_path and os.path.islink(old_full_path):
@@ -176,7 +256,8 @@ async def genchanges(Options, outdir, oldfile, origfile, maxdiffs=56, merged_pdi
         os.unlink(old_full_path)
 
     os.unlink(oldfile + oldext)
-    os.link(resolved_orig_path, old_full_path)
+    store_copy(resolved_orig_path, old_full_path)
+    write_stored_stat(oldfile, old_full_path)
 
 
 def main():
@@ -213,6 +294,12 @@ def main():
 
     session = DBConn().session()
     pending_tasks = []
+    # Patches are computed in-process; use a pool of processes so that
+    # max_parallel of them can be computed at the same time.
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_parallel)
+    # uncompressed copies of the indices left by generate-packages-sources2
+    # and contents
+    staging_dir = Cnf.get("Dir::IndexStaging")
 
     if not suites:
         query = session.query(Suite.suite_name)
@@ -263,7 +350,7 @@ def main():
                         (fname, fext) = os.path.splitext(entry)
                         processfile = os.path.join(workpath, fname)
                         storename = "%s/%s_%s_%s" % (Options["TempDir"], suite, component, fname)
-                        coroutine = genchanges(Options, processfile + ".diff", storename, processfile, maxdiffs, merged_pdiffs)
+                        coroutine = genchanges(Options, processfile + ".diff", storename, processfile, maxdiffs, merged_pdiffs, executor, staging_dir)
                         pending_tasks.append(coroutine)
         os.chdir(cwd)
 
@@ -284,15 +371,18 @@ def main():
                 file = "%s/%s/Contents-%s" % (tree, component, architecture)
 
                 storename = "%s/%s_%s_contents_%s" % (Options["TempDir"], suite, component, architecture)
-                coroutine = genchanges(Options, file + ".diff", storename, file, maxcontents, merged_pdiffs)
+                coroutine = genchanges(Options, file + ".diff", storename, file, maxcontents, merged_pdiffs, executor, staging_dir)
                 pending_tasks.append(coroutine)
 
                 file = "%s/%s/%s/%s" % (tree, component, longarch, packages)
                 storename = "%s/%s_%s_%s" % (Options["TempDir"], suite, component, architecture)
-                coroutine = genchanges(Options, file + ".diff", storename, file, maxsuite, merged_pdiffs)
+                coroutine = genchanges(Options, file + ".diff", storename, file, maxsuite, merged_pdiffs, executor, staging_dir)
                 pending_tasks.append(coroutine)
 
-    asyncio.run(process_pdiff_tasks(pending_tasks, max_parallel))
+    try:
+        asyncio.run(process_pdiff_tasks(pending_tasks, max_parallel))
+    finally:
+        executor.shutdown()
 
 
 async def process_pdiff_tasks(pending_coroutines, limit):
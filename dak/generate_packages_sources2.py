@@ -31,6 +31,8 @@ Generate Packages/Sources files
 from typing import NoReturn
 
 import apt_pkg
+import hashlib
+import os.path
 import sys
 
 
@@ -43,6 +45,8 @@ Generate the Packages/Sources files
                                Default: All suites not marked 'untouchable'
   -f, --force                  Allow processing of untouchable suites
                                CAREFUL: Only to be used at point release time!
+  -i, --incremental            only regenerate indices whose content changed
+                               since they were last generated
   -h, --help                   show this help and exit
 
 SUITE can be a space separated list, e.g.
@@ -53,6 +57,42 @@ SUITE can be a space separated list, e.g.
 #############################################################################
 
 
+def _index_fingerprint(session, query: str, params: dict, *extra) -> str:
+    """
+    Combine the result of a (cheap) fingerprint query with extra settings
+    influencing the output into a single fingerprint.
+    """
+    (db_fingerprint,) = session.execute(query, params).fetchone()
+    h = hashlib.sha256()
+    h.update(repr((db_fingerprint,) + extra).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _index_is_current(session, suite_id: int, writer, fingerprint: str) -> bool:
+    """
+    Check if the index written by `writer` was last generated from a
+    database state with the given fingerprint and all of its outputs
+    still exist.
+    """
+    r = session.execute(
+        "SELECT fingerprint FROM index_state WHERE suite_id = :suite AND path = :path",
+        {'suite': suite_id, 'path': writer.path}).fetchone()
+    if r is None or r[0] != fingerprint:
+        return False
+    return all(os.path.exists(path) for path in writer.output_paths())
+
+
+def _record_index_state(session, suite_id: int, writer, fingerprint: str) -> None:
+    session.execute(
+        """INSERT INTO index_state (suite_id, path, fingerprint) VALUES (:suite, :path, :fingerprint)
+           ON CONFLICT (suite_id, path) DO UPDATE
+             SET fingerprint = EXCLUDED.fingerprint, generated = CURRENT_TIMESTAMP""",
+        {'suite': suite_id, 'path': writer.path, 'fingerprint': fingerprint})
+    session.commit()
+
+#############################################################################
+
+
 # Here be dragons.
 _sources_query = R"""
 SELECT
@@ -108,8 +148,30 @@ s.source, s.version
 """
 
 
-def generate_sources(suite_id: int, component_id: int):
+_sources_fingerprint_query = R"""
+SELECT
+  MD5(COALESCE(STRING_AGG(
+    s.id || ':' || f.id || ':' || src_associations_full.extra_source
+        || ':' || COALESCE(o.section, 0) || ':' || COALESCE(o.priority, 0),
+    ',' ORDER BY s.id), ''))
+FROM
+source s
+JOIN src_associations_full ON src_associations_full.suite = :suite AND s.id = src_associations_full.source
+JOIN files f ON s.file=f.id
+JOIN files_archive_map fam
+  ON fam.file_id = f.id
+     AND fam.archive_id = (SELECT archive_id FROM suite WHERE id = :suite)
+     AND fam.component_id = :component
+LEFT JOIN override o ON o.package = s.source
+                     AND o.suite = :overridesuite
+                     AND o.component = :component
+                     AND o.type = :dsc_type
+"""
+
+
+def generate_sources(suite_id: int, component_id: int, incremental: bool = False):
     global _sources_query
+    from daklib.config import Config
     from daklib.filewriter import SourcesFileWriter
     from daklib.dbconn import Component, DBConn, OverrideType, Suite
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
@@ -125,23 +187,34 @@ def generate_sources(suite_id: int, component_id: int):
     writer_args = {
             'archive': suite.archive.path,
             'suite': suite.suite_name,
-            'component': component.component_name
+            'component': component.component_name,
+            'compression_threads': Config().find_i('Dinstall::CompressionThreads', 0) or None,
+            'staging_dir': Config().get('Dir::IndexStaging'),
     }
     if suite.indices_compression is not None:
         writer_args['compression'] = suite.indices_compression
     writer = SourcesFileWriter(**writer_args)
+
+    params = {"suite": suite_id, "component": component_id, "component_name": component.component_name, "dsc_type": dsc_type, "overridesuite": overridesuite_id}
+    fingerprint = _index_fingerprint(session, _sources_fingerprint_query, params,
+                                     component.component_name, sorted(suite.checksums), writer.compression)
+
+    message = ["generate sources", suite.suite_name, component.component_name]
+    if incremental and _index_is_current(session, suite_id, writer, fingerprint):
+        session.rollback()
+        return (PROC_STATUS_SUCCESS, message + ["unchanged"])
+
     output = writer.open()
 
     # run query and write Sources
-    r = session.execute(_sources_query, {"suite": suite_id, "component": component_id, "component_name": component.component_name, "dsc_type": dsc_type, "overridesuite": overridesuite_id})
+    r = session.execute(_sources_query, params)
     for (stanza,) in r:
         print(stanza, file=output)
         print("", file=output)
 
     writer.close()
 
-    message = ["generate sources", suite.suite_name, component.component_name]
-    session.rollback()
+    _record_index_state(session, suite_id, writer, fingerprint)
     return (PROC_STATUS_SUCCESS, message)
 
 #############################################################################
@@ -171,9 +244,11 @@ WITH
       (SELECT value FROM binaries_metadata
         WHERE bin_id = b.id
           AND key_id = (SELECT key_id FROM metadata_keys WHERE key = 'Section'))
-       AS fallback_section
+       AS fallback_section,
+      sc.stanza AS stanza
     FROM
       binaries b
+      JOIN binaries_stanza_cache sc ON sc.bin_id = b.id AND sc.long_description = :long_description
       JOIN bin_associations ba ON b.id = ba.bin
       JOIN files f ON f.id = b.file
       JOIN files_archive_map fam ON f.id = fam.file_id AND fam.archive_id = :archive_id
@@ -185,22 +260,7 @@ WITH
   )
 
 SELECT
-  (SELECT
-     STRING_AGG(key || E'\: ' || value, E'\n' ORDER BY ordering, key)
-   FROM
-     (SELECT key, ordering,
-        CASE WHEN :include_long_description = 'false' AND key = 'Description'
-          THEN SUBSTRING(value FROM E'\\A[^\n]*')
-          ELSE value
-        END AS value
-      FROM
-        binaries_metadata bm
-        JOIN metadata_keys mk ON mk.key_id = bm.key_id
-      WHERE
-        bm.bin_id = tmp.binary_id
-        AND key != ALL (:metadata_skip)
-     ) AS metadata
-  )
+  tmp.stanza
   || COALESCE(E'\n' || (SELECT
      STRING_AGG(key || E'\: ' || value, E'\n' ORDER BY key)
    FROM external_overrides eo
@@ -239,8 +299,71 @@ ORDER BY tmp.source, tmp.package, tmp.version
 """
 
 
-def generate_packages(suite_id: int, component_id: int, architecture_id: int, type_name: str):
+# The binaries_metadata part of a stanza never changes once a binary has
+# been imported; it is rendered once and kept in binaries_stanza_cache.
+_packages_stanza_cache_query = R"""
+INSERT INTO binaries_stanza_cache (bin_id, long_description, stanza)
+SELECT
+  b.id,
+  :long_description,
+  (SELECT
+     STRING_AGG(key || E'\: ' || value, E'\n' ORDER BY ordering, key)
+   FROM
+     (SELECT key, ordering,
+        CASE WHEN :include_long_description = 'false' AND key = 'Description'
+          THEN SUBSTRING(value FROM E'\\A[^\n]*')
+          ELSE value
+        END AS value
+      FROM
+        binaries_metadata bm
+        JOIN metadata_keys mk ON mk.key_id = bm.key_id
+      WHERE
+        bm.bin_id = b.id
+        AND key != ALL (:metadata_skip)
+     ) AS metadata
+  )
+FROM
+  binaries b
+  JOIN bin_associations ba ON b.id = ba.bin
+  JOIN files_archive_map fam ON b.file = fam.file_id AND fam.archive_id = :archive_id
+WHERE
+  (b.architecture = :arch_all OR b.architecture = :arch) AND b.type = :type_name
+  AND ba.suite = :suite
+  AND fam.component_id = :component
+  AND NOT EXISTS (SELECT 1 FROM binaries_stanza_cache sc WHERE sc.bin_id = b.id AND sc.long_description = :long_description)
+ORDER BY b.id
+ON CONFLICT DO NOTHING
+"""
+
+
+_packages_fingerprint_query = R"""
+SELECT
+  MD5(COALESCE(STRING_AGG(
+    b.id || ':' || f.id || ':' || COALESCE(o.section, 0) || ':' || COALESCE(o.priority, 0),
+    ',' ORDER BY b.id), ''))
+  || ':' ||
+  (SELECT MD5(COALESCE(STRING_AGG(eo.package || ':' || eo.key || ':' || eo.value, E'\n' ORDER BY eo.package, eo.key), ''))
+     FROM external_overrides eo
+    WHERE eo.suite = :overridesuite AND eo.component = :component)
+FROM
+  binaries b
+  JOIN bin_associations ba ON b.id = ba.bin
+  JOIN files f ON f.id = b.file
+  JOIN files_archive_map fam ON f.id = fam.file_id AND fam.archive_id = :archive_id
+  LEFT JOIN override o ON o.package = b.package
+                      AND o.type = :type_id
+                      AND o.suite = :overridesuite
+                      AND o.component = :component
+WHERE
+  (b.architecture = :arch_all OR b.architecture = :arch) AND b.type = :type_name
+  AND ba.suite = :suite
+  AND fam.component_id = :component
+"""
+
+
+def generate_packages(suite_id: int, component_id: int, architecture_id: int, type_name: str, incremental: bool = False):
     global _packages_query
+    from daklib.config import Config
     from daklib.filewriter import PackagesFileWriter
     from daklib.dbconn import Architecture, Component, DBConn, OverrideType, Suite
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
@@ -269,26 +392,44 @@ def generate_packages(suite_id: int, component_id: int, architecture_id: int, ty
             'suite': suite.suite_name,
             'component': component.component_name,
             'architecture': architecture.arch_string,
-            'debtype': type_name
+            'debtype': type_name,
+            'compression_threads': Config().find_i('Dinstall::CompressionThreads', 0) or None,
+            'staging_dir': Config().get('Dir::IndexStaging'),
     }
     if suite.indices_compression is not None:
         writer_args['compression'] = suite.indices_compression
     writer = PackagesFileWriter(**writer_args)
-    output = writer.open()
 
-    r = session.execute(_packages_query, {"archive_id": suite.archive.archive_id,
+    params = {"archive_id": suite.archive.archive_id,
         "suite": suite_id, "component": component_id, 'component_name': component.component_name,
         "arch": architecture_id, "type_id": type_id, "type_name": type_name, "arch_all": arch_all_id,
         "overridesuite": overridesuite_id, "metadata_skip": metadata_skip,
-        "include_long_description": 'true' if include_long_description else 'false'})
+        "include_long_description": 'true' if include_long_description else 'false',
+        "long_description": bool(include_long_description)}
+    fingerprint = _index_fingerprint(session, _packages_fingerprint_query, params,
+                                     component.component_name, sorted(suite.checksums),
+                                     metadata_skip, include_long_description, writer.compression)
+
+    message = ["generate-packages", suite.suite_name, component.component_name, architecture.arch_string]
+    if incremental and _index_is_current(session, suite_id, writer, fingerprint):
+        session.rollback()
+        return (PROC_STATUS_SUCCESS, message + ["unchanged"])
+
+    # Render stanzas of binaries new to this index; committing right away
+    # lets workers for other architectures reuse the arch:all ones.
+    session.execute(_packages_stanza_cache_query, params)
+    session.commit()
+
+    output = writer.open()
+
+    r = session.execute(_packages_query, params)
     for (stanza,) in r:
         print(stanza, file=output)
         print("", file=output)
 
     writer.close()
 
-    message = ["generate-packages", suite.suite_name, component.component_name, architecture.arch_string]
-    session.rollback()
+    _record_index_state(session, suite_id, writer, fingerprint)
     return (PROC_STATUS_SUCCESS, message)
 
 #############################################################################
@@ -326,8 +467,27 @@ ORDER BY MIN(s.source), b.package, bm_description_md5.value
 """
 
 
-def generate_translations(suite_id: int, component_id: int):
+_translations_fingerprint_query = r"""
+WITH
+  override_suite AS
+    (SELECT
+      s.id AS id,
+      COALESCE(os.id, s.id) AS overridesuite_id
+      FROM suite AS s LEFT JOIN suite AS os ON s.overridesuite = os.suite_name)
+
+SELECT
+  MD5(COALESCE(STRING_AGG(b.id::text, ',' ORDER BY b.id), ''))
+FROM binaries b
+  JOIN bin_associations ba ON b.id = ba.bin
+  JOIN override_suite os ON os.id = ba.suite
+  JOIN override o ON b.package = o.package AND o.suite = os.overridesuite_id AND o.type = (SELECT id FROM override_type WHERE type = 'deb')
+WHERE ba.suite = :suite AND o.component = :component
+"""
+
+
+def generate_translations(suite_id: int, component_id: int, incremental: bool = False):
     global _translations_query
+    from daklib.config import Config
     from daklib.filewriter import TranslationFileWriter
     from daklib.dbconn import DBConn, Suite, Component
     from daklib.dakmultiprocessing import PROC_STATUS_SUCCESS
@@ -341,20 +501,30 @@ def generate_translations(suite_id: int, component_id: int):
             'suite': suite.suite_name,
             'component': component.component_name,
             'language': 'en',
+            'compression_threads': Config().find_i('Dinstall::CompressionThreads', 0) or None,
+            'staging_dir': Config().get('Dir::IndexStaging'),
     }
     if suite.i18n_compression is not None:
         writer_args['compression'] = suite.i18n_compression
     writer = TranslationFileWriter(**writer_args)
+
+    params = {"suite": suite_id, "component": component_id}
+    fingerprint = _index_fingerprint(session, _translations_fingerprint_query, params, writer.compression)
+
+    message = ["generate-translations", suite.suite_name, component.component_name]
+    if incremental and _index_is_current(session, suite_id, writer, fingerprint):
+        session.rollback()
+        return (PROC_STATUS_SUCCESS, message + ["unchanged"])
+
     output = writer.open()
 
-    r = session.execute(_translations_query, {"suite": suite_id, "component": component_id})
+    r = session.execute(_translations_query, params)
     for (stanza,) in r:
         print(stanza, file=output)
 
     writer.close()
 
-    message = ["generate-translations", suite.suite_name, component.component_name]
-    session.rollback()
+    _record_index_state(session, suite_id, writer, fingerprint)
     return (PROC_STATUS_SUCCESS, message)
 
 #############################################################################
@@ -370,6 +540,7 @@ def main():
                  ('a', 'archive', 'Generate-Packages-Sources::Options::Archive', 'HasArg'),
                  ('s', "suite", "Generate-Packages-Sources::Options::Suite", 'HasArg'),
                  ('f', "force", "Generate-Packages-Sources::Options::Force"),
+                 ('i', "incremental", "Generate-Packages-Sources::Options::Incremental"),
                  ('o', 'option', '', 'ArbItem')]
 
     apt_pkg.parse_commandline(cnf.Cnf, Arguments, sys.argv)
@@ -411,6 +582,7 @@ def main():
         suites = query.all()
 
     force = "Force" in Options and Options["Force"]
+    incremental = "Incremental" in Options and Options["Incremental"]
 
     def parse_results(message):
         # Split out into (code, msg)
@@ -432,14 +604,14 @@ def main():
             import daklib.utils
             daklib.utils.fubar("Refusing to touch %s (untouchable and not forced)" % s.suite_name)
         for c in component_ids:
-            pool.apply_async(generate_sources, [s.suite_id, c], callback=parse_results)
+            pool.apply_async(generate_sources, [s.suite_id, c, incremental], callback=parse_results)
             if not s.include_long_description:
-                pool.apply_async(generate_translations, [s.suite_id, c], callback=parse_results)
+                pool.apply_async(generate_translations, [s.suite_id, c, incremental], callback=parse_results)
             for a in s.architectures:
                 if a == 'source':
                     continue
-                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'deb'], callback=parse_results)
-                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'udeb'], callback=parse_results)
+                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'deb', incremental], callback=parse_results)
+                pool.apply_async(generate_packages, [s.suite_id, c, a.arch_id, 'udeb', incremental], callback=parse_results)
 
     pool.close()
     pool.join()
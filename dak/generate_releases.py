@@ -37,8 +37,13 @@ import time
 import gzip
 import bz2
 import errno
+import hashlib
+import lzma
 import apt_pkg
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
 from sqlalchemy.orm import object_session
 
 import daklib.gpg
@@ -46,6 +51,7 @@ from daklib import utils, daklog
 from daklib.regexes import re_gensubrelease, re_includeinrelease_byhash, re_includeinrelease_plain
 from daklib.dbconn import *
 from daklib.config import Config
+from daklib.filewriter import read_hash_manifest
 from daklib.dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 
 ################################################################################
@@ -106,37 +112,69 @@ def sign_release_dir(suite, dirname):
                 daklib.gpg.sign(stdin, stdout, inline=True, **args)
 
 
-class XzFile:
-    def __init__(self, filename, mode='r'):
-        self.filename = filename
-
-    def read(self):
-        with open(self.filename, 'rb') as stdin:
-            return subprocess.check_output(['xz', '-d'], stdin=stdin)
-
-
-class ZstdFile:
-    def __init__(self, filename, mode='r'):
-        self.filename = filename
-
-    def read(self):
-        with open(self.filename, 'rb') as stdin:
-            return subprocess.check_output(['zstd', '--decompress'], stdin=stdin)
+@contextmanager
+def open_zstd(filename):
+    """
+    Open a zstd compressed file for streaming its uncompressed content.
+    """
+    with open(filename, 'rb') as stdin:
+        process = subprocess.Popen(['zstd', '--decompress', '--stdout'], stdin=stdin, stdout=subprocess.PIPE)
+    with process.stdout as stdout:
+        yield stdout
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
 
 class HashFunc:
-    def __init__(self, release_field, func, db_name):
+    def __init__(self, release_field, hashlib_name, db_name):
         self.release_field = release_field
-        self.func = func
+        self.hashlib_name = hashlib_name
         self.db_name = db_name
 
 
 RELEASE_HASHES = [
-    HashFunc('MD5Sum', apt_pkg.md5sum, 'md5sum'),
-    HashFunc('SHA1', apt_pkg.sha1sum, 'sha1'),
-    HashFunc('SHA256', apt_pkg.sha256sum, 'sha256'),
+    HashFunc('MD5Sum', 'md5', 'md5sum'),
+    HashFunc('SHA1', 'sha1', 'sha1'),
+    HashFunc('SHA256', 'sha256', 'sha256'),
 ]
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_stream(fh, hashes) -> dict:
+    """
+    Compute length and all requested hashes of a file object in a single
+    pass over it, without keeping more than one chunk in memory.
+    """
+    size = 0
+    digests = [(hf, hashlib.new(hf.hashlib_name)) for hf in hashes]
+    while chunk := fh.read(HASH_CHUNK_SIZE):
+        size += len(chunk)
+        for hf, h in digests:
+            h.update(chunk)
+    info = {'len': size}
+    for hf, h in digests:
+        info[hf.release_field] = h.hexdigest()
+    return info
+
+
+def open_binary(filename):
+    return open(filename, 'rb')
+
+
+def hash_from_manifest(filename, output, hashes) -> Optional[dict]:
+    """
+    Get length and hashes of the uncompressed content of filename from the
+    hash manifest written by the BaseFileWriter that generated output.
+    """
+    content = read_hash_manifest(Config().get('Dir::IndexStaging'), filename, output)
+    if content is None:
+        return None
+    info = {'len': content['len']}
+    for hf in hashes:
+        info[hf.release_field] = content[hf.hashlib_name]
+    return info
+
 
 class ReleaseWriter:
     def __init__(self, suite):
@@ -230,6 +268,57 @@ class ReleaseWriter:
 
         session.commit()
 
+    def _load_hash_cache(self, session):
+        query = """
+            SELECT path, inode, size, mtime_ns, len, md5sum, sha1, sha256
+            FROM release_hash_cache WHERE suite_id = :id"""
+        cache = {}
+        for path, inode, size, mtime_ns, length, md5sum, sha1, sha256 in session.execute(query, {'id': self.suite.suite_id}):
+            info = {'len': length, 'MD5Sum': md5sum, 'SHA1': sha1, 'SHA256': sha256}
+            cache[path] = ((inode, size, mtime_ns), info)
+        return cache
+
+    def _update_hash_cache(self, session, cache, updated):
+        # Forget files that are gone and remember the ones we had to hash
+        obsolete = [path for path in cache if path not in updated]
+        if obsolete:
+            session.execute("""
+                DELETE FROM release_hash_cache
+                WHERE suite_id = :id AND path = ANY(:p)""",
+                {'id': self.suite.suite_id, 'p': obsolete})
+        changed = [(path, key, info) for path, (key, info) in updated.items() if cache.get(path) != (key, info)]
+        if changed:
+            session.execute("""
+                INSERT INTO release_hash_cache (suite_id, path, inode, size, mtime_ns, len, md5sum, sha1, sha256)
+                VALUES (:id, :path, :inode, :size, :mtime_ns, :len, :md5sum, :sha1, :sha256)
+                ON CONFLICT (suite_id, path) DO UPDATE SET
+                  inode = EXCLUDED.inode, size = EXCLUDED.size, mtime_ns = EXCLUDED.mtime_ns,
+                  len = EXCLUDED.len, md5sum = EXCLUDED.md5sum, sha1 = EXCLUDED.sha1, sha256 = EXCLUDED.sha256""",
+                [{'id': self.suite.suite_id, 'path': path,
+                  'inode': key[0], 'size': key[1], 'mtime_ns': key[2],
+                  'len': info['len'], 'md5sum': info['MD5Sum'], 'sha1': info['SHA1'], 'sha256': info['SHA256']}
+                 for path, key, info in changed])
+        session.commit()
+
+    def _file_info(self, filename, source, opener, cache, updated):
+        """
+        Length and hashes of filename, computed by reading source with
+        opener.  They are taken from the hash cache or the writer's hash
+        manifest if source did not change since.
+        """
+        st = os.stat(source)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = cache.get(filename)
+        if cached is not None and cached[0] == key:
+            info = cached[1]
+        else:
+            info = hash_from_manifest(os.path.join(self.suite_path(), filename), source, RELEASE_HASHES)
+            if info is None:
+                with opener(source) as fd:
+                    info = hash_stream(fd, RELEASE_HASHES)
+        updated[filename] = (key, info)
+        return dict(info)
+
     def _make_byhash_links(self, fileinfo, hashes):
         # Create hardlinks in by-hash directories
         for filename in fileinfo:
@@ -399,6 +488,9 @@ class ReleaseWriter:
 
         uncompnotseen = {}
 
+        # (filename, file to read, opener) of everything we need to hash
+        hash_jobs = []
+
         for dirpath, dirnames, filenames in os.walk(".", followlinks=True, topdown=True):
             # SuiteSuffix deprecation:
             # components on security-master are updates/{main,contrib,non-free}, but
@@ -426,25 +518,19 @@ class ReleaseWriter:
                 else:
                     continue
 
-                with open(filename, 'rb') as fd:
-                    contents = fd.read()
-
                 # If we find a file for which we have a compressed version and
                 # haven't yet seen the uncompressed one, store the possibility
                 # for future use
                 if entry.endswith(".gz") and filename[:-3] not in uncompnotseen:
-                    uncompnotseen[filename[:-3]] = (gzip.GzipFile, filename)
+                    uncompnotseen[filename[:-3]] = (gzip.open, filename)
                 elif entry.endswith(".bz2") and filename[:-4] not in uncompnotseen:
-                    uncompnotseen[filename[:-4]] = (bz2.BZ2File, filename)
+                    uncompnotseen[filename[:-4]] = (bz2.open, filename)
                 elif entry.endswith(".xz") and filename[:-3] not in uncompnotseen:
-                    uncompnotseen[filename[:-3]] = (XzFile, filename)
+                    uncompnotseen[filename[:-3]] = (lzma.open, filename)
                 elif entry.endswith(".zst") and filename[:-3] not in uncompnotseen:
-                    uncompnotseen[filename[:-3]] = (ZstdFile, filename)
-
-                fileinfo[filename]['len'] = len(contents)
+                    uncompnotseen[filename[:-3]] = (open_zstd, filename)
 
-                for hf in hashes:
-                    fileinfo[filename][hf.release_field] = hf.func(contents)
+                hash_jobs.append((filename, filename, open_binary))
 
         for filename, comp in uncompnotseen.items():
             # If we've already seen the uncompressed file, we don't
@@ -452,15 +538,21 @@ class ReleaseWriter:
             if filename in fileinfo:
                 continue
 
+            # File opener is comp[0], filename of compressed file is comp[1]
             fileinfo[filename] = {}
-
-            # File handler is comp[0], filename of compressed file is comp[1]
-            contents = comp[0](comp[1], 'r').read()
-
-            fileinfo[filename]['len'] = len(contents)
-
-            for hf in hashes:
-                fileinfo[filename][hf.release_field] = hf.func(contents)
+            hash_jobs.append((filename, comp[1], comp[0]))
+
+        # Hash files in parallel, largest first so a big file does not end
+        # up being started last.  hashlib and the decompressors release the
+        # GIL, so threads are good enough here.
+        hash_cache = self._load_hash_cache(session)
+        hash_cache_updated = {}
+        hash_jobs.sort(key=lambda job: os.stat(job[1]).st_size, reverse=True)
+        with ThreadPoolExecutor(max_workers=cnf.find_i("Generate-Releases::HashThreads", 4)) as executor:
+            futures = [(filename, executor.submit(self._file_info, filename, source, opener, hash_cache, hash_cache_updated))
+                       for filename, source, opener in hash_jobs]
+            for filename, future in futures:
+                fileinfo[filename].update(future.result())
 
         for field in sorted(h.release_field for h in hashes):
             out.write('%s:\n' % field)
@@ -470,6 +562,7 @@ class ReleaseWriter:
         out.close()
         os.rename(outfile + '.new', outfile)
 
+        self._update_hash_cache(session, hash_cache, hash_cache_updated)
         self._update_hashfile_table(session, fileinfo_byhash, hashes)
         self._make_byhash_links(fileinfo_byhash, hashes)
         self._make_byhash_base_symlink(fileinfo_byhash, hashes)
@@ -525,6 +618,12 @@ def main():
             query = query.join(Suite.archive).filter(Archive.archive_name.in_(archive_names))
         suites = query.all()
 
+    # Start with the suites that take longest (judging by the size of the
+    # files hashed last time), so a big suite does not end up last.
+    suite_sizes = dict(session.execute(
+        "SELECT suite_id, SUM(size) FROM release_hash_cache GROUP BY suite_id").fetchall())
+    suites.sort(key=lambda s: suite_sizes.get(s.suite_id, float('inf')), reverse=True)
+
     for s in suites:
         # Setup a multiprocessing Pool. As many workers as we have CPU cores.
         if s.untouchable and not Options["Force"]:
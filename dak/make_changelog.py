@@ -49,20 +49,26 @@ Generate changelog entry between two suites
 
 ################################################################################
 
+import gzip
 import os
+import re
 import sys
 import apt_pkg
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
-from shutil import rmtree
-from yaml import safe_dump
+from yaml import safe_dump, safe_load, YAMLError
 from daklib.dbconn import *
 from daklib import utils
 from daklib.contents import UnpackedSource
+from daklib.deb import iter_tar, open_tar_member
 from daklib.regexes import re_no_epoch
 
 ################################################################################
 
 filelist = 'filelist.yaml'
+export_names = ('changelog', 'copyright', 'NEWS', 'NEWS.Debian', 'README.Debian')
+tarball_suffixes = ('.tar', '.tar.gz', '.tar.xz', '.tar.bz2', '.tar.zst')
+re_diff_hunk = re.compile(rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
 
 
 def usage(exit_code=0):
@@ -81,7 +87,10 @@ Options:
 
   -e, --export              export interesting files from source packages
   -a, --archive             archive to fetch data from
-  -p, --progress            display progress status""")
+  -p, --progress            display progress status
+  -j, --jobs=N              number of source packages to unpack in parallel
+  -r, --rescan              walk the changelog pool instead of trusting its
+                            file list, removing files not exported anymore""")
 
     sys.exit(exit_code)
 
@@ -169,15 +178,194 @@ def display_changes(uploads, index):
         prev_upload = upload[0]
 
 
-def export_files(session, archive, clpool, progress=False):
+def is_export_name(name):
+    """
+    Tell whether debian/<name> is one of the files exported to the changelog pool.
+    """
+    return '/' not in name and not name.startswith('.') and name.endswith(export_names)
+
+
+def read_debian_tarball(filename, strip):
+    """
+    Returns name -> data of the exported files in the debian/ directory of
+    a tarball whose member names have `strip` leading components to ignore,
+    or None if one of them is not a regular file.
+    """
+    found = {}
+    with open(filename, 'rb') as fh, open_tar_member(filename, fh) as tar:
+        for info in iter_tar(tar):
+            parts = os.path.normpath(info.name).split('/')[strip:]
+            if len(parts) != 2 or parts[0] != 'debian' or not is_export_name(parts[1]):
+                continue
+            if not info.isfile():
+                return None
+            found[parts[1]] = tar.extractfile(info).read()
+    return found
+
+
+def read_debian_diff(filename):
+    """
+    Returns name -> data of the exported files a Debian .diff.gz adds, or
+    None if it modifies one of them.
+    """
+    found = {}
+    name = None
+    lines = None
+    old = new = 0
+    with gzip.open(filename, 'rb') as fh:
+        for line in fh:
+            if old > 0 or new > 0:
+                if line.startswith(b'\\'):
+                    continue
+                if not line.startswith(b'+'):
+                    old -= 1
+                if not line.startswith(b'-'):
+                    new -= 1
+                if lines is not None:
+                    lines.append(line[1:])
+            elif line.startswith(b'\\'):
+                # "\ No newline at end of file" after the last line of a hunk
+                if lines and lines[-1].endswith(b'\n'):
+                    lines[-1] = lines[-1][:-1]
+            elif line.startswith(b'+++ '):
+                path = line[4:].rstrip(b'\n').split(b'\t')[0].decode('utf-8', 'surrogateescape')
+                parts = os.path.normpath(path).split('/')[1:]
+                if len(parts) == 2 and parts[0] == 'debian' and is_export_name(parts[1]):
+                    name = parts[1]
+                else:
+                    name = None
+                lines = None
+            elif (match := re_diff_hunk.match(line)) is not None:
+                old = int(match.group(2) or 1)
+                new = int(match.group(4) or 1)
+                if name is not None:
+                    if old != 0 or name in found:
+                        return None
+                    lines = found[name] = []
+    return {name: b''.join(data) for name, data in found.items()}
+
+
+def read_debian_files(dscfilename):
+    """
+    Returns name -> data of the exported files of a source package, read
+    from its tarballs and diff without unpacking them with dpkg-source, or
+    None if the package has to be unpacked with dpkg-source instead.
+    """
+    dsc = utils.parse_changes(dscfilename, signing_rules=-1, dsc_file=True)
+    files = utils.build_file_list(dsc, is_a_dsc=True)
+    directory = os.path.dirname(dscfilename)
+    tarballs = [f for f in files if f.endswith(tarball_suffixes)]
+    diffs = [f for f in files if f.endswith('.diff.gz')]
+
+    if dsc['format'] == '3.0 (quilt)':
+        debian = [f for f in tarballs if '.debian.tar' in f]
+        if len(debian) == 1:
+            return read_debian_tarball(os.path.join(directory, debian[0]), 0)
+    elif dsc['format'] == '1.0' and len(diffs) == 1:
+        orig = [f for f in tarballs if '.orig.tar' in f]
+        if len(orig) != 1:
+            return None
+        added = read_debian_diff(os.path.join(directory, diffs[0]))
+        if added is None:
+            return None
+        # Files the diff does not touch are shipped in the orig tarball
+        found = read_debian_tarball(os.path.join(directory, orig[0]), 1)
+        if found is None:
+            return None
+        found.update(added)
+        return found
+    elif dsc['format'] in ('1.0', '3.0 (native)') and len(files) == 1 and len(tarballs) == 1:
+        return read_debian_tarball(os.path.join(directory, tarballs[0]), 1)
+    return None
+
+
+def export_source(dscfilename, path, prefix, tmpdir):
+    """
+    Export the interesting files of a source package into `path`, named
+    `prefix` followed by their name in debian/.
+
+    Returns the exported names and whether the package had to be unpacked.
+    """
+    os.makedirs(path, exist_ok=True)
+    found = read_debian_files(dscfilename)
+    if found is not None and 'changelog' in found:
+        for name, data in found.items():
+            filename = os.path.join(path, prefix + name)
+            tmpname = '%s.new.%d' % (filename, os.getpid())
+            with open(tmpname, 'wb') as fh:
+                fh.write(data)
+            os.rename(tmpname, filename)
+        return sorted(found), False
+
+    # Patched upstream files or an unusual source format: let dpkg-source
+    # do the work.
+    unpacked = UnpackedSource(dscfilename, tmpdir)
+    try:
+        names = []
+        for f in sorted(glob(os.path.join(unpacked.get_root_directory(), 'debian', '*'))):
+            name = os.path.basename(f)
+            if not is_export_name(name):
+                continue
+            version = os.path.join(path, prefix + name)
+            if not os.path.exists(version):
+                os.link(f, version)
+            names.append(name)
+        return names, True
+    finally:
+        unpacked.cleanup()
+
+
+def add_export_file(clfiles, source, key, clpath):
+    paths = clfiles.setdefault(source, {}).setdefault(key, [])
+    if clpath not in paths:
+        paths.append(clpath)
+
+
+def scan_export_filelist(clpool):
+    """
+    Build the file list by walking the changelog pool.
+    """
+    clfiles = {}
+    for root, dirs, files in os.walk(clpool):
+        for file in [f for f in files if f != filelist]:
+            clpath = os.path.join(root, file).replace(clpool, '').strip('/')
+            parts = clpath.split('/')
+            if len(parts) != 4:
+                continue
+            source = parts[2]
+            elements = parts[3].split('_')
+            if elements[0] == source:
+                add_export_file(clfiles, source, elements[1], clpath)
+            else:
+                add_export_file(clfiles, source, elements[0], clpath)
+    return clfiles
+
+
+def read_export_filelist(clpool):
+    """
+    Returns the file list written by the previous export, or one built by
+    walking the changelog pool if there is none.
+    """
+    try:
+        with open(os.path.join(clpool, filelist)) as fd:
+            clfiles = safe_load(fd)
+        if isinstance(clfiles, dict):
+            return clfiles
+    except (OSError, YAMLError):
+        pass
+    return scan_export_filelist(clpool)
+
+
+def export_files(session, archive, clpool, progress=False, jobs=None, rescan=False):
     """
     Export interesting files from source packages.
+
+    Only source versions missing from the file list of the previous run,
+    or from the pool with `rescan`, are unpacked; returns the new file list.
     """
     pool = os.path.join(archive.path, 'pool')
 
     sources = {}
-    unpack = {}
-    files = ('changelog', 'copyright', 'NEWS', 'NEWS.Debian', 'README.Debian')
     stats = {'unpack': 0, 'created': 0, 'removed': 0, 'errors': 0, 'files': 0}
     query = """SELECT DISTINCT s.source, su.suite_name AS suite, s.version, c.name || '/' || f.filename AS filename
                FROM source s
@@ -195,78 +383,98 @@ def export_files(session, archive, clpool, progress=False):
             sources[p[0]] = {}
         sources[p[0]][p[1]] = (re_no_epoch.sub('', p[2]), p[3])
 
-    for p in sources.keys():
-        for s in sources[p].keys():
-            path = os.path.join(clpool, '/'.join(sources[p][s][1].split('/')[:-1]))
-            if not os.path.exists(path):
-                os.makedirs(path)
-            if not os.path.exists(os.path.join(path,
-                   '%s_%s_changelog' % (p, sources[p][s][0]))):
-                if os.path.join(pool, sources[p][s][1]) not in unpack:
-                    unpack[os.path.join(pool, sources[p][s][1])] = (path, set())
-                unpack[os.path.join(pool, sources[p][s][1])][1].add(s)
-            else:
-                for file in glob('%s/%s_%s_*' % (path, p, sources[p][s][0])):
-                    link = '%s%s' % (s, file.split('%s_%s'
-                                      % (p, sources[p][s][0]))[1])
-                    try:
-                        os.unlink(os.path.join(path, link))
-                    except OSError:
-                        pass
-                    os.link(os.path.join(path, file), os.path.join(path, link))
-
-    for p in unpack.keys():
-        package = os.path.splitext(os.path.basename(p))[0].split('_')
-        try:
-            unpacked = UnpackedSource(p, clpool)
-            tempdir = unpacked.get_root_directory()
+    if rescan:
+        old_clfiles = scan_export_filelist(clpool)
+    else:
+        old_clfiles = read_export_filelist(clpool)
+
+    # (directory, source, version) -> exported names, for what is in the pool
+    exported = {}
+    missing = set()
+    for source, keys in old_clfiles.items():
+        for key, clpaths in keys.items():
+            prefix = '%s_%s_' % (source, key)
+            for clpath in clpaths:
+                name = os.path.basename(clpath)
+                if not name.startswith(prefix):
+                    continue
+                entry = (os.path.dirname(clpath), source, key)
+                if os.path.isfile(os.path.join(clpool, clpath)):
+                    exported.setdefault(entry, set()).add(name[len(prefix):])
+                else:
+                    missing.add(entry)
+    # Export again what was removed from the pool behind our back
+    for entry in missing:
+        exported.pop(entry, None)
+
+    unpack = {}
+    for p in sources:
+        for version, filename in sources[p].values():
+            key = (os.path.dirname(filename), p, version)
+            if key not in exported:
+                unpack[key] = os.path.join(pool, filename)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(export_source, dsc, os.path.join(clpool, key[0]), '%s_%s_' % key[1:], clpool): key
+                   for key, dsc in unpack.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                names, unpacked = future.result()
+            except Exception as e:
+                print('make-changelog: unable to unpack %s\n%s' % (unpack[key], e))
+                stats['errors'] += 1
+                continue
             stats['unpack'] += 1
+            stats['created'] += len(names)
             if progress:
                 if stats['unpack'] % 100 == 0:
                     print('%d packages unpacked' % stats['unpack'], file=sys.stderr)
                 elif stats['unpack'] % 10 == 0:
                     print('.', end='', file=sys.stderr)
-            for file in files:
-                for f in glob(os.path.join(tempdir, 'debian', '*%s' % file)):
-                    for s in unpack[p][1]:
-                        suite = os.path.join(unpack[p][0], '%s_%s'
-                                % (s, os.path.basename(f)))
-                        version = os.path.join(unpack[p][0], '%s_%s_%s' %
-                                  (package[0], package[1], os.path.basename(f)))
-                        if not os.path.exists(version):
-                            os.link(f, version)
-                            stats['created'] += 1
+            exported[key] = set(names)
+
+    clfiles = {}
+    for p in sorted(sources):
+        for s, (version, filename) in sorted(sources[p].items()):
+            directory = os.path.dirname(filename)
+            for name in sorted(exported.get((directory, p, version), ())):
+                version_path = os.path.join(directory, '%s_%s_%s' % (p, version, name))
+                suite_path = os.path.join(directory, '%s_%s' % (s, name))
+                try:
+                    if not os.path.exists(os.path.join(clpool, suite_path)) or \
+                            not os.path.samefile(os.path.join(clpool, version_path), os.path.join(clpool, suite_path)):
                         try:
-                            os.unlink(suite)
+                            os.unlink(os.path.join(clpool, suite_path))
                         except OSError:
                             pass
-                        os.link(version, suite)
+                        os.link(os.path.join(clpool, version_path), os.path.join(clpool, suite_path))
                         stats['created'] += 1
-            unpacked.cleanup()
-        except Exception as e:
-            print('make-changelog: unable to unpack %s\n%s' % (p, e))
-            stats['errors'] += 1
-
-    for root, dirs, files in os.walk(clpool, topdown=False):
-        files = [f for f in files if f != filelist]
-        if len(files):
-            if root != clpool:
-                if root.split('/')[-1] not in sources:
-                    if os.path.exists(root):
-                        stats['removed'] += len(os.listdir(root))
-                        rmtree(root)
-            for file in files:
-                if os.path.exists(os.path.join(root, file)):
-                    if os.stat(os.path.join(root, file)).st_nlink == 1:
-                        stats['removed'] += 1
-                        os.unlink(os.path.join(root, file))
-        for dir in dirs:
+                except OSError as e:
+                    print('make-changelog: unable to link %s\n%s' % (os.path.join(clpool, version_path), e))
+                    stats['errors'] += 1
+                    # the exported file itself is fine, keep it
+                    add_export_file(clfiles, p, version, version_path)
+                    continue
+                add_export_file(clfiles, p, version, version_path)
+                add_export_file(clfiles, p, s, suite_path)
+
+    old_paths = set(clpath for keys in old_clfiles.values() for clpaths in keys.values() for clpath in clpaths)
+    new_paths = set(clpath for keys in clfiles.values() for clpaths in keys.values() for clpath in clpaths)
+    for clpath in sorted(old_paths - new_paths):
+        try:
+            os.unlink(os.path.join(clpool, clpath))
+            stats['removed'] += 1
+        except FileNotFoundError:
+            pass
+    for directory in sorted(set(os.path.dirname(clpath) for clpath in old_paths - new_paths), reverse=True):
+        while directory:
             try:
-                os.rmdir(os.path.join(root, dir))
+                os.rmdir(os.path.join(clpool, directory))
             except OSError:
-                pass
-        stats['files'] += len(files)
-    stats['files'] -= stats['removed']
+                break
+            directory = os.path.dirname(directory)
+    stats['files'] = len(new_paths)
 
     print('make-changelog: file exporting finished')
     print('  * New packages unpacked: %d' % stats['unpack'])
@@ -275,26 +483,16 @@ def export_files(session, archive, clpool, progress=False):
     print('  * Unpack errors: %d' % stats['errors'])
     print('  * Files available into changelog pool: %d' % stats['files'])
 
+    return clfiles
 
-def generate_export_filelist(clpool):
-    clfiles = {}
-    for root, dirs, files in os.walk(clpool):
-        for file in [f for f in files if f != filelist]:
-            clpath = os.path.join(root, file).replace(clpool, '').strip('/')
-            source = clpath.split('/')[2]
-            elements = clpath.split('/')[3].split('_')
-            if source not in clfiles:
-                clfiles[source] = {}
-            if elements[0] == source:
-                if elements[1] not in clfiles[source]:
-                    clfiles[source][elements[1]] = []
-                clfiles[source][elements[1]].append(clpath)
-            else:
-                if elements[0] not in clfiles[source]:
-                    clfiles[source][elements[0]] = []
-                clfiles[source][elements[0]].append(clpath)
-    with open(os.path.join(clpool, filelist), 'w+') as fd:
+
+def generate_export_filelist(clpool, clfiles=None):
+    if clfiles is None:
+        clfiles = scan_export_filelist(clpool)
+    tmpname = '%s.new.%d' % (os.path.join(clpool, filelist), os.getpid())
+    with open(tmpname, 'w+') as fd:
         safe_dump(clfiles, fd, default_flow_style=False)
+    os.rename(tmpname, os.path.join(clpool, filelist))
 
 
 def main():
@@ -305,9 +503,11 @@ def main():
                  ('b', 'base-suite', 'Make-Changelog::Options::Base-Suite', 'HasArg'),
                  ('n', 'binnmu', 'Make-Changelog::Options::binNMU'),
                  ('e', 'export', 'Make-Changelog::Options::export'),
-                 ('p', 'progress', 'Make-Changelog::Options::progress')]
+                 ('p', 'progress', 'Make-Changelog::Options::progress'),
+                 ('j', 'jobs', 'Make-Changelog::Options::Jobs', 'HasArg'),
+                 ('r', 'rescan', 'Make-Changelog::Options::Rescan')]
 
-    for i in ['help', 'suite', 'base-suite', 'binnmu', 'export', 'progress']:
+    for i in ['help', 'suite', 'base-suite', 'binnmu', 'export', 'progress', 'rescan']:
         key = 'Make-Changelog::Options::%s' % i
         if key not in Cnf:
             Cnf[key] = ''
@@ -319,6 +519,7 @@ def main():
     binnmu = Cnf['Make-Changelog::Options::binNMU']
     export = Cnf['Make-Changelog::Options::export']
     progress = Cnf['Make-Changelog::Options::progress']
+    rescan = Cnf['Make-Changelog::Options::rescan']
 
     if Options['help'] or not (suite and base_suite) and not export:
         usage()
@@ -333,8 +534,9 @@ def main():
         archive = session.query(Archive).filter_by(archive_name=Options['Archive']).one()
         exportpath = archive.changelog
         if exportpath:
-            export_files(session, archive, exportpath, progress)
-            generate_export_filelist(exportpath)
+            clfiles = export_files(session, archive, exportpath, progress,
+                                   jobs=Options.find_i('Jobs') or None, rescan=rescan)
+            generate_export_filelist(exportpath, clfiles)
         else:
             utils.fubar('No changelog export path defined')
     elif binnmu:
@@ -178,12 +178,14 @@ def do_pkg(upload_id):
 
         if upload.source is not None and ('dsc', upload.source.source) in missing:
             fn = os.path.join(upload_copy.directory, upload.source.poolfile.basename)
-            outfile.write(dak.examine_package.check_dsc(distribution, fn, session))
+            outfile.write(dak.examine_package.check_dsc(distribution, fn, session,
+                                                        sha256=upload.source.poolfile.sha256sum))
         for binary in upload.binaries:
             if (binary.binarytype, binary.package) not in missing:
                 continue
             fn = os.path.join(upload_copy.directory, binary.poolfile.basename)
-            outfile.write(dak.examine_package.check_deb(distribution, fn, session))
+            outfile.write(dak.examine_package.check_deb(distribution, fn, session,
+                                                        sha256=binary.poolfile.sha256sum))
 
         outfile.write(html_footer())
 
@@ -232,7 +234,7 @@ def init(session):
     if len(changesnames) > 0:
         uploads = uploads.filter(DBChange.changesname.in_(changesnames))
 
-    return uploads
+    return uploads, queue_names, len(changesnames) > 0
 
 
 def result_callback(r):
@@ -248,11 +250,31 @@ def result_callback(r):
 
 def main():
     dak.examine_package.use_html = True
-    pool = DakProcessPool(processes=5)
 
     session = DBConn().session()
-    upload_ids = [u.id for u in init(session)]
+    uploads, queue_names, partial = init(session)
+
+    # Sections that only depend on the contents of a file are kept by
+    # its sha256sum, so a new version only processes the changed files.
+    cache_dir = cnf.get('Dir::Cache')
+    if cache_dir:
+        dak.examine_package.artifact_cache = dak.examine_package.ArtifactCache(
+            os.path.join(cache_dir, 'show-new', ','.join(sorted(queue_names))))
+
+    uploads = uploads.all()
+    upload_ids = [u.id for u in uploads]
+    sha256sums = set(f.sha256sum for u in uploads
+                     for f in [b.poolfile for b in u.binaries] + ([u.source.poolfile] if u.source else []))
+
+    # Look up the packages of the target suites once; the workers inherit
+    # the indices when the pool forks them (but not our connections).
+    for distribution in set(u.changes.distribution for u in uploads):
+        dak.examine_package.depends_indices[distribution] = \
+            dak.examine_package.DependsIndex(distribution, session)
     session.close()
+    DBConn().db_pg.dispose()
+
+    pool = DakProcessPool(processes=5)
 
     for upload_id in upload_ids:
         pool.apply_async(do_pkg, [upload_id], callback=result_callback)
@@ -272,6 +294,9 @@ def main():
     for f in to_delete:
         os.remove(os.path.join(cnf["Show-New::HTMLPath"], f))
 
+    if dak.examine_package.artifact_cache is not None and not partial:
+        dak.examine_package.artifact_cache.prune(sha256sums)
+
 ################################################################################
 
 
@@ -31,19 +31,26 @@
 
 ################################################################################
 
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
 import subprocess
 import sys
 import tempfile
 import apt_pkg
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from email.utils import mktime_tz, parsedate_tz
 from mailbox import mbox
 from os import listdir
-from os.path import isfile, join, splitext
+from os.path import abspath, basename, isfile, join, splitext
 from re import findall, DOTALL, MULTILINE
 from sys import stderr
-from yaml import safe_load, safe_dump
+from yaml import safe_load, safe_dump, YAMLError
 
 from daklib import utils
 from daklib.dbconn import DBConn, get_suite_architectures, Suite, Architecture
@@ -65,6 +72,9 @@ old_ACTIONS = (r'(?:lisa|process-new)\|program start\|(.*?)\|'
                r'(?:lisa|process-new)\|program end')
 old_ACTION = r'^(\d{14})\|(?:lisa|process-new)\|(Accepting changes|rejected)\|'
 
+# bytes before a checkpoint whose digest is remembered
+LOG_TAIL = 4096
+
 ################################################################################
 
 
@@ -208,12 +218,14 @@ def number_of_packages():
 ################################################################################
 
 
-def parse_new_uploads(data):
+def parse_new_uploads(data, since=None):
     global stats
     latest_timestamp = stats['timestamp']
+    if since is None:
+        since = stats['timestamp']
     for entry in findall(NEW, data, MULTILINE):
         timestamp = entry[0]
-        if stats['timestamp'] >= timestamp:
+        if since >= timestamp:
             continue
         date = parse_timestamp(timestamp)
         if date not in stats:
@@ -225,9 +237,11 @@ def parse_new_uploads(data):
     return latest_timestamp
 
 
-def parse_actions(data, logdate):
+def parse_actions(data, logdate, since=None):
     global stats
     latest_timestamp = stats['timestamp']
+    if since is None:
+        since = stats['timestamp']
     if logdate <= FORMAT_SWITCH:
         for batch in findall(old_ACTIONS, data, DOTALL):
             who = batch.split()[0]
@@ -240,7 +254,7 @@ def parse_actions(data, logdate):
                 elif action.startswith('rejected'):
                     action = 'REJECT'
                 timestamp = entry[0]
-                if stats['timestamp'] >= timestamp:
+                if since >= timestamp:
                     continue
                 date = parse_timestamp(entry[0])
                 if date not in stats:
@@ -262,7 +276,7 @@ def parse_actions(data, logdate):
         for entry in findall(new_ACTIONS, data, MULTILINE):
             action = entry[2]
             timestamp = entry[0]
-            if stats['timestamp'] >= timestamp:
+            if since >= timestamp:
                 continue
             date = parse_timestamp(timestamp)
             if date not in stats:
@@ -330,6 +344,172 @@ def parse_timestamp(timestamp):
     return '%d-%02d' % (y, m)
 
 
+@contextmanager
+def open_log(logfile):
+    if logfile.endswith('.bz2'):
+        with bz2.open(logfile, 'rb') as fh:
+            yield fh
+    elif logfile.endswith('.xz'):
+        with lzma.open(logfile, 'rb') as fh:
+            yield fh
+    elif logfile.endswith('.gz'):
+        with gzip.open(logfile, 'rb') as fh:
+            yield fh
+    elif logfile.endswith('.zst'):
+        # There is no zstd support in the standard library
+        with subprocess.Popen(['zstdcat', logfile], stdout=subprocess.PIPE) as process:
+            yield process.stdout
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    else:
+        with open(logfile, 'rb') as fh:
+            yield fh
+
+
+def read_log(logfile, checkpoint=None):
+    """
+    Read the complete lines of a log file after `checkpoint`, the
+    (decompressed) offset and digest of the data parsed by a previous run.
+
+    Returns the data (None if the file did not change), the new checkpoint
+    and whether the data starts at the checkpoint.  The checkpoint is only
+    trusted if the bytes before its offset still have the recorded digest,
+    so it survives the log being compressed when the month is over.
+    """
+    st = os.stat(logfile)
+    if checkpoint is not None and checkpoint['file'] == basename(logfile) \
+            and checkpoint['size'] == st.st_size and checkpoint['mtime'] == st.st_mtime_ns:
+        return None, checkpoint, True
+
+    compressed = logfile.endswith(('.bz2', '.xz', '.gz', '.zst'))
+    offset = 0
+    tail = b''
+    data = None
+    if checkpoint is not None:
+        with open_log(logfile) as fh:
+            if compressed:
+                # only the end of the skipped data is needed for the digest
+                skipped = b''
+                position = 0
+                while position < checkpoint['offset'] and \
+                        (chunk := fh.read(min(checkpoint['offset'] - position, 1024 * 1024))):
+                    position += len(chunk)
+                    skipped = (skipped + chunk[-LOG_TAIL:])[-LOG_TAIL:]
+            else:
+                fh.seek(max(0, checkpoint['offset'] - LOG_TAIL))
+                skipped = fh.read(checkpoint['offset'] - fh.tell())
+                position = fh.tell()
+            if position == checkpoint['offset'] and \
+                    hashlib.sha256(skipped).hexdigest() == checkpoint['digest']:
+                offset = position
+                tail = skipped
+                data = fh.read()
+            elif compressed:
+                # let the decompressor finish before reading the log again
+                while fh.read(1024 * 1024):
+                    pass
+    if data is None:
+        with open_log(logfile) as fh:
+            data = fh.read()
+
+    # a line that is still being written is read again by the next run
+    end = data.rfind(b'\n') + 1
+    data = data[:end]
+    tail = (tail + data[-LOG_TAIL:])[-LOG_TAIL:]
+    checkpoint = {'file': basename(logfile), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                  'offset': offset + end, 'digest': hashlib.sha256(tail).hexdigest()}
+    try:
+        data = data.decode()
+    except UnicodeDecodeError:
+        data = data.decode('latin1')
+    return data, checkpoint, offset > 0
+
+
+def empty_stats(timestamp):
+    return {'history': {'stats': {'NEW': 0, 'ACCEPT': 0,
+            'REJECT': 0, 'PROD': 0}, 'members': {}},
+            'timestamp': timestamp}
+
+
+def scan_log(logfile, log, checkpoint, timestamp, members):
+    """
+    Count the entries of a log file newer than `timestamp`, or after
+    `checkpoint`.  Runs in a worker process, so only the counters are
+    sent back instead of the log.
+
+    Returns the counters (in the format of the stats file), the new
+    checkpoint and the timestamp of the latest entry.
+    """
+    global stats
+    global users
+    stats = empty_stats(timestamp)
+    users = members
+    data, checkpoint, resumed = read_log(logfile, checkpoint)
+    latest_timestamp = timestamp
+    if data:
+        # everything after a checkpoint is new, whatever its timestamp
+        since = '' if resumed else None
+        latest_timestamp = max(latest_timestamp, parse_new_uploads(data, since),
+                               parse_actions(data, log, since))
+    return stats, checkpoint, latest_timestamp
+
+
+def merge_stats(counts):
+    """Add the counters returned by scan_log() to stats"""
+    for date, entry in counts.items():
+        if date == 'timestamp':
+            continue
+        if date not in stats:
+            stats[date] = {'stats': {'NEW': 0, 'ACCEPT': 0,
+                           'REJECT': 0, 'PROD': 0}, 'members': {}}
+        for action, count in entry['stats'].items():
+            stats[date]['stats'][action] += count
+        for member, actions in entry['members'].items():
+            if member not in stats[date]['members']:
+                stats[date]['members'][member] = {'ACCEPT': 0, 'REJECT': 0,
+                                                  'PROD': 0}
+            for action, count in actions.items():
+                stats[date]['members'][member][action] += count
+
+
+def checkpoints_path():
+    cache_dir = Cnf.get('Dir::Cache')
+    if not cache_dir:
+        return None
+    return join(cache_dir, 'stats-new.yaml')
+
+
+def load_checkpoints(yaml):
+    """
+    Returns the checkpoints of the log files, if they were stored together
+    with the stats currently in `yaml`.
+    """
+    path = checkpoints_path()
+    if path is None:
+        return {}
+    try:
+        with open(path, 'r') as fd:
+            data = safe_load(fd)
+    except (OSError, YAMLError):
+        return {}
+    if not isinstance(data, dict) or data.get('output') != abspath(yaml) \
+            or data.get('timestamp') != stats['timestamp']:
+        return {}
+    return data.get('logs') or {}
+
+
+def save_checkpoints(yaml, checkpoints):
+    path = checkpoints_path()
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.new.%d" % (path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        safe_dump({'output': abspath(yaml), 'timestamp': stats['timestamp'],
+                   'logs': checkpoints}, fd)
+    os.rename(tmp_path, path)
+
+
 def new_stats(logdir, yaml):
     global Cnf
     global stats
@@ -339,10 +519,10 @@ def new_stats(logdir, yaml):
     except OSError:
         pass
     if not stats:
-        stats = {'history': {'stats': {'NEW': 0, 'ACCEPT': 0,
-                 'REJECT': 0, 'PROD': 0}, 'members': {}},
-                 'timestamp': '19700101000000'}
+        stats = empty_stats('19700101000000')
     latest_timestamp = stats['timestamp']
+    checkpoints = load_checkpoints(yaml)
+    logs = []
     for fn in sorted(listdir(logdir)):
         if fn == 'current':
             continue
@@ -351,28 +531,16 @@ def new_stats(logdir, yaml):
             continue
         logfile = join(logdir, fn)
         if isfile(logfile):
-            if fn.endswith('.bz2'):
-                # This hack is required becaue python2 does not support
-                # multi-stream files (http://bugs.python.org/issue1625)
-                with open(logfile, 'rb') as fh:
-                    data = subprocess.check_output(['bzcat'], stdin=fh)
-            elif fn.endswith('.xz'):
-                with open(logfile, 'rb') as fh:
-                    data = subprocess.check_output(['xzcat'], stdin=fh)
-            elif fn.endswith('.zst'):
-                with open(logfile, 'rb') as fh:
-                    data = subprocess.check_output(['zstdcat'], stdin=fh)
-            else:
-                with open(logfile, 'rb') as fd:
-                    data = fd.read()
-            try:
-                data = data.decode()
-            except UnicodeDecodeError:
-                data = data.decode('latin1')
-            ts = parse_new_uploads(data)
-            if ts > latest_timestamp:
-                latest_timestamp = ts
-            ts = parse_actions(data, log)
+            logs.append((log, logfile))
+    new_checkpoints = {}
+    with ProcessPoolExecutor() as executor:
+        n = len(logs)
+        results = executor.map(scan_log, [logfile for log, logfile in logs], [log for log, logfile in logs],
+                               [checkpoints.get(log) for log, logfile in logs],
+                               [stats['timestamp']] * n, [users] * n)
+        for (log, logfile), (counts, checkpoint, ts) in zip(logs, results):
+            new_checkpoints[log] = checkpoint
+            merge_stats(counts)
             if ts > latest_timestamp:
                 latest_timestamp = ts
             stderr.write('.')
@@ -382,6 +550,7 @@ def new_stats(logdir, yaml):
     stats['timestamp'] = latest_timestamp
     with open(yaml, 'w') as fd:
         safe_dump(stats, fd)
+    save_checkpoints(yaml, new_checkpoints)
 
 ################################################################################
 
@@ -28,14 +28,16 @@ from daklib.dbconn import *
 from daklib.config import Config
 from daklib.filewriter import BinaryContentsFileWriter, SourceContentsFileWriter
 
-from .dakmultiprocessing import DakProcessPool
+from .dakmultiprocessing import DakProcessPool, PROC_STATUS_SUCCESS
 from shutil import rmtree
 from tempfile import mkdtemp
 from collections.abc import Iterable
 from typing import Optional
 
+import io
 import subprocess
 import os.path
+import time
 import sqlalchemy.sql as sql
 
 
@@ -73,20 +75,7 @@ class BinaryContentsWriter:
             sql_arch_part = '(architecture = :arch_all or architecture = :arch)'
             params['arch_all'] = get_architecture('all', self.session).arch_id
 
-        sql_create_temp = '''
-create temp table newest_binaries (
-    id integer primary key,
-    package text);
-
-create index newest_binaries_by_package on newest_binaries (package);
-
-insert into newest_binaries (id, package)
-    select distinct on (package) id, package from binaries
-        where type = :type and
-            %s and
-            id in (select bin from bin_associations where suite = :suite)
-        order by package, version desc;''' % sql_arch_part
-        self.session.execute(sql_create_temp, params=params)
+        self.refresh_index(params, sql_arch_part)
 
         query = sql.text('''
 with
@@ -97,14 +86,68 @@ unique_override as
         where o.suite = :overridesuite and o.type = :type_id and o.section = s.id and
         o.component = :component)
 
-select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package) as pkglist
-    from newest_binaries b, bin_contents bc, unique_override o
-    where b.id = bc.binary_id and o.package = b.package
-    group by bc.file''')
+select sc.file, string_agg(o.section || '/' || sc.package, ',' order by sc.package) as pkglist
+    from suite_contents sc, unique_override o
+    where sc.suite_id = :suite and sc.architecture_id = :arch and sc.type = :type and
+        o.package = sc.package
+    group by sc.file
+    order by sc.file''')
 
         return self.session.query(sql.column("file"), sql.column("pkglist")) \
             .from_statement(query).params(params)
 
+    def refresh_index(self, params, sql_arch_part: str) -> None:
+        '''
+        Brings the suite_contents index for this suite, architecture and
+        type up to date with the newest binaries in the suite.
+
+        Only the contents of binaries that entered or left the set of
+        newest binaries since the last run are added or removed.  Binaries
+        that have not been scanned yet are picked up by a later run.  The
+        writers for the different components of a Contents-$arch file
+        share the index; the first one to get here refreshes it.
+        '''
+        sql_create_temp = '''
+create temp table newest_binaries (
+    id integer primary key,
+    package text) on commit drop;
+
+insert into newest_binaries (id, package)
+    select distinct on (package) id, package from binaries
+        where type = :type and
+            %s and
+            id in (select bin from bin_associations where suite = :suite)
+        order by package, version desc;''' % sql_arch_part
+        self.session.execute(sql_create_temp, params=params)
+
+        self.session.execute(
+            "select pg_advisory_xact_lock(hashtext('suite_contents:' || :suite || ':' || :arch || ':' || :type))",
+            params)
+
+        # the contents of the binaries go with them (ON DELETE CASCADE), also
+        # when a binary is deleted from the database between two runs
+        self.session.execute('''
+delete from suite_contents_binaries scb
+    where scb.suite_id = :suite and scb.architecture_id = :arch and scb.type = :type and
+        not exists (select 1 from newest_binaries b where b.id = scb.binary_id)''', params)
+
+        self.session.execute('''
+with added as
+    (insert into suite_contents_binaries (suite_id, architecture_id, type, binary_id)
+        select :suite, :arch, :type, b.id from newest_binaries b
+            where not exists
+                (select 1 from suite_contents_binaries scb
+                    where scb.suite_id = :suite and scb.architecture_id = :arch and
+                        scb.type = :type and scb.binary_id = b.id) and
+                exists (select 1 from bin_contents bc where bc.binary_id = b.id)
+        returning binary_id)
+insert into suite_contents (suite_id, architecture_id, type, binary_id, package, file)
+    select :suite, :arch, :type, b.id, b.package, bc.file
+        from added, newest_binaries b, bin_contents bc
+        where b.id = added.binary_id and bc.binary_id = b.id''', params)
+
+        self.session.commit()
+
     def formatline(self, filename, package_list) -> str:
         '''
         Returns a formatted string for the filename argument.
@@ -136,6 +179,8 @@ select bc.file, string_agg(o.section || '/' || b.package, ',' order by b.package
             'component':    self.component.component_name,
             'debtype':      self.overridetype.overridetype,
             'architecture': self.architecture.arch_string,
+            'compression_threads': Config().find_i('Dinstall::CompressionThreads', 0) or None,
+            'staging_dir': Config().get('Dir::IndexStaging'),
         }
         return BinaryContentsFileWriter(**values)
 
@@ -220,7 +265,9 @@ select sc.file, string_agg(s.source, ',' order by s.source) as pkglist
         values = {
             'archive':   self.suite.archive.path,
             'suite':     self.suite.suite_name,
-            'component': self.component.component_name
+            'component': self.component.component_name,
+            'compression_threads': Config().find_i('Dinstall::CompressionThreads', 0) or None,
+            'staging_dir': Config().get('Dir::IndexStaging'),
         }
         return SourceContentsFileWriter(**values)
 
@@ -333,6 +380,36 @@ class ContentsWriter:
         session.close()
 
 
+def _copy_escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def format_copy_rows(rows: Iterable[tuple]) -> str:
+    '''
+    Returns rows in the text format read by COPY.  Raises
+    UnicodeEncodeError if a value cannot be sent to the database, like a
+    file name that is not valid UTF-8.
+    '''
+    data = ''.join('\t'.join(_copy_escape(str(value)) for value in row) + '\n' for row in rows)
+    data.encode('utf-8')
+    return data
+
+
+def copy_data(session, table: str, columns: Iterable[str], data: str) -> None:
+    '''
+    COPY data (see format_copy_rows) into table.
+    '''
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(columns)), io.StringIO(data))
+
+
+def copy_rows(session, table: str, columns: Iterable[str], rows: Iterable[tuple]) -> None:
+    '''
+    Bulk insert rows into table using COPY instead of one INSERT per row.
+    '''
+    copy_data(session, table, columns, format_copy_rows(rows))
+
+
 class BinaryContentsScanner:
     '''
     BinaryContentsScanner provides a threadsafe method scan() to scan the
@@ -346,6 +423,16 @@ class BinaryContentsScanner:
         '''
         self.binary_id: int = binary_id
 
+    def rows(self, session) -> list[tuple[str, int]]:
+        '''
+        Returns the bin_contents rows for the DBBinary object.
+        '''
+        binary = session.query(DBBinary).get(self.binary_id)
+        fileset = set(binary.scan_contents())
+        if len(fileset) == 0:
+            fileset.add('EMPTY_PACKAGE')
+        return [(filename, self.binary_id) for filename in sorted(fileset)]
+
     def scan(self) -> None:
         '''
         This method does the actual scan and fills in the associated BinContents
@@ -353,48 +440,96 @@ class BinaryContentsScanner:
         is ignored but needed by our threadpool implementation.
         '''
         session = DBConn().session()
-        binary = session.query(DBBinary).get(self.binary_id)
-        fileset = set(binary.scan_contents())
-        if len(fileset) == 0:
-            fileset.add('EMPTY_PACKAGE')
-        for filename in fileset:
-            binary.contents.append(BinContents(file=filename))
+        copy_rows(session, 'bin_contents', ('file', 'binary_id'), self.rows(session))
         session.commit()
         session.close()
 
     @classmethod
-    def scan_all(class_, limit=None):
+    def scan_batch(class_, binary_ids: list[int]) -> int:
         '''
-        The class method scan_all() scans all binaries using multiple threads.
-        The number of binaries to be scanned can be limited with the limit
-        argument. Returns the number of processed and remaining packages as a
-        dict.
+        Scans several binaries using a single session and stores all results
+        in one transaction. Binaries that cannot be scanned are skipped.
+        Returns the number of scanned binaries.
+        '''
+        return _scan_batch(class_, 'bin_contents', ('file', 'binary_id'), binary_ids)
+
+    @classmethod
+    def scan_all(class_, limit=None, batch_size: int = 100):
+        '''
+        The class method scan_all() scans all binaries using multiple processes,
+        handing out batch_size binaries at a time. The number of binaries to be
+        scanned can be limited with the limit argument. Returns the number of
+        processed and remaining packages and the throughput as a dict.
         '''
-        pool = DakProcessPool()
         session = DBConn().session()
-        query = session.query(DBBinary).filter(DBBinary.contents == None) # noqa:E711
-        remaining = query.count
-        if limit is not None:
-            query = query.limit(limit)
-        processed = query.count()
-        for binary in query.yield_per(100):
-            pool.apply_async(binary_scan_helper, (binary.binary_id, ))
-        pool.close()
-        pool.join()
-        remaining = remaining()
-        session.close()
-        return {'processed': processed, 'remaining': remaining}
+        query = session.query(DBBinary.binary_id).filter(DBBinary.contents == None) # noqa:E711
+        return _scan_all(class_, session, query, limit, batch_size)
+
+
+def _scan_batch(scanner_class, table: str, columns: tuple[str, str], ids: list[int]) -> int:
+    session = DBConn().session()
+    data = {}
+    for package_id in ids:
+        try:
+            data[package_id] = format_copy_rows(scanner_class(package_id).rows(session))
+        except Exception as e:
+            print("%s: scanning %d raised an exception: %s" % (scanner_class.__name__, package_id, e))
+    try:
+        copy_data(session, table, columns, ''.join(data.values()))
+        session.commit()
+        scanned = len(data)
+    except Exception as e:
+        # do not lose the whole batch to a single package
+        session.rollback()
+        print("%s: storing a batch raised an exception, storing packages one by one: %s" % (scanner_class.__name__, e))
+        scanned = 0
+        for package_id, rows in data.items():
+            try:
+                copy_data(session, table, columns, rows)
+                session.commit()
+                scanned += 1
+            except Exception as e:
+                session.rollback()
+                print("%s: storing %d raised an exception: %s" % (scanner_class.__name__, package_id, e))
+    session.close()
+    return scanned
+
+
+def _scan_all(scanner_class, session, query, limit: Optional[int], batch_size: int) -> dict:
+    pool = DakProcessPool()
+    remaining = query.count
+    if limit is not None:
+        query = query.limit(limit)
+    ids = [package_id for (package_id,) in query]
+    session.rollback()
+    start = time.monotonic()
+    scanned = [0]
+
+    def progress(result):
+        status, count = result
+        if status != PROC_STATUS_SUCCESS:
+            print("%s: %s" % (scanner_class.__name__, count))
+            return
+        scanned[0] += count
+        elapsed = time.monotonic() - start
+        print("%d/%d packages scanned, %.1f packages/s" % (scanned[0], len(ids), scanned[0] / elapsed if elapsed else 0.0))
+
+    for i in range(0, len(ids), batch_size):
+        pool.apply_async(scan_batch_helper, (scanner_class, ids[i:i + batch_size]), callback=progress)
+    pool.close()
+    pool.join()
+    elapsed = time.monotonic() - start
+    remaining = remaining()
+    session.close()
+    return {'processed': len(ids), 'scanned': scanned[0], 'remaining': remaining,
+            'rate': scanned[0] / elapsed if elapsed else 0.0}
 
 
-def binary_scan_helper(binary_id: int) -> None:
+def scan_batch_helper(scanner_class, ids: list[int]):
     '''
     This function runs in a subprocess.
     '''
-    try:
-        scanner = BinaryContentsScanner(binary_id)
-        scanner.scan()
-    except Exception as e:
-        print("binary_scan_helper raised an exception: %s" % (e))
+    return (PROC_STATUS_SUCCESS, scanner_class.scan_batch(ids))
 
 
 class UnpackedSource:
@@ -467,43 +602,35 @@ class SourceContentsScanner:
         property. It commits any changes to the database.
         '''
         session = DBConn().session()
-        source = session.query(DBSource).get(self.source_id)
-        fileset = set(source.scan_contents())
-        for filename in fileset:
-            source.contents.append(SrcContents(file=filename))
+        copy_rows(session, 'src_contents', ('file', 'source_id'), self.rows(session))
         session.commit()
         session.close()
 
-    @classmethod
-    def scan_all(class_, limit=None):
+    def rows(self, session) -> list[tuple[str, int]]:
         '''
-        The class method scan_all() scans all source using multiple processes.
-        The number of sources to be scanned can be limited with the limit
-        argument. Returns the number of processed and remaining packages as a
-        dict.
+        Returns the src_contents rows for the DBSource object.
         '''
-        pool = DakProcessPool()
-        session = DBConn().session()
-        query = session.query(DBSource).filter(DBSource.contents == None) # noqa:E711
-        remaining = query.count
-        if limit is not None:
-            query = query.limit(limit)
-        processed = query.count()
-        for source in query.yield_per(100):
-            pool.apply_async(source_scan_helper, (source.source_id, ))
-        pool.close()
-        pool.join()
-        remaining = remaining()
-        session.close()
-        return {'processed': processed, 'remaining': remaining}
+        source = session.query(DBSource).get(self.source_id)
+        fileset = set(source.scan_contents())
+        return [(filename, self.source_id) for filename in sorted(fileset)]
 
+    @classmethod
+    def scan_batch(class_, source_ids: list[int]) -> int:
+        '''
+        Scans several sources using a single session and stores all results
+        in one transaction. Sources that cannot be scanned are skipped.
+        Returns the number of scanned sources.
+        '''
+        return _scan_batch(class_, 'src_contents', ('file', 'source_id'), source_ids)
 
-def source_scan_helper(source_id: int) -> None:
-    '''
-    This function runs in a subprocess.
-    '''
-    try:
-        scanner = SourceContentsScanner(source_id)
-        scanner.scan()
-    except Exception as e:
-        print("source_scan_helper raised an exception: %s" % (e))
+    @classmethod
+    def scan_all(class_, limit=None, batch_size: int = 100):
+        '''
+        The class method scan_all() scans all source using multiple processes,
+        handing out batch_size sources at a time. The number of sources to be
+        scanned can be limited with the limit argument. Returns the number of
+        processed and remaining packages and the throughput as a dict.
+        '''
+        session = DBConn().session()
+        query = session.query(DBSource.source_id).filter(DBSource.contents == None) # noqa:E711
+        return _scan_all(class_, session, query, limit, batch_size)
@@ -21,10 +21,62 @@ helper functions for cruft-report
 
 ################################################################################
 
+import functools
+from typing import Optional
+
+import apt_pkg
+
 from daklib.dbconn import *
 
-from sqlalchemy import func
-from sqlalchemy.orm import object_session, aliased
+from sqlalchemy.orm import object_session
+
+
+class SuiteSnapshot:
+    '''
+    The newest versions of the source and binary packages of a suite, as
+    needed to compare suites with newer_version().
+    '''
+
+    def __init__(self, suite_id: int, session):
+        #: (source, newest version) sorted by source name
+        self.sources = sorted(tuple(row) for row in session.execute("""
+            SELECT s.source, MAX(s.version)
+              FROM source s
+              JOIN src_associations sa ON sa.source = s.id
+             WHERE sa.suite = :suite_id
+             GROUP BY s.source""", {'suite_id': suite_id}))
+
+        #: source -> (package, architecture) -> (newest source version, newest binary version)
+        self.binaries = {}
+        for package, source, version, arch, binversion in session.execute("""
+            SELECT b.package, s.source, MAX(s.version), a.arch_string, MAX(b.version)
+              FROM binaries b
+              JOIN bin_associations ba ON ba.bin = b.id
+              JOIN source s ON s.id = b.source
+              JOIN architecture a ON a.id = b.architecture
+             WHERE ba.suite = :suite_id
+             GROUP BY b.package, s.source, a.arch_string""", {'suite_id': suite_id}):
+            self.binaries.setdefault(source, {})[(package, arch)] = (version, binversion)
+
+
+def _merge_sources(highsources, lowsources):
+    '''
+    Yields (source, higherversion, lowerversion) for sources in both sorted
+    lists of (source, version).
+    '''
+    high = iter(highsources)
+    low = iter(lowsources)
+    h = next(high, None)
+    lo = next(low, None)
+    while h is not None and lo is not None:
+        if h[0] < lo[0]:
+            h = next(high, None)
+        elif h[0] > lo[0]:
+            lo = next(low, None)
+        else:
+            yield h[0], h[1], lo[1]
+            h = next(high, None)
+            lo = next(low, None)
 
 
 def newer_version(lowersuite_name: str, highersuite_name: str, session, include_equal=False) -> list[tuple[str, str, str]]:
@@ -38,88 +90,34 @@ def newer_version(lowersuite_name: str, highersuite_name: str, session, include_
     lowersuite = get_suite(lowersuite_name, session)
     highersuite = get_suite(highersuite_name, session)
 
-    def get_suite_sources(suite):
-        q1 = session.query(DBSource.source,
-                           func.max(DBSource.version).label('version')). \
-            with_parent(suite). \
-            group_by(DBSource.source). \
-            subquery()
-
-        return aliased(q1)
-
-    def get_suite_binaries(suite):
-        q1 = session.query(DBBinary.package,
-                           DBSource.source,
-                           func.max(DBSource.version).label('version'),
-                           Architecture.arch_string,
-                           func.max(DBBinary.version).label('binversion')). \
-            filter(DBBinary.suites.contains(suite)). \
-            join(DBBinary.source). \
-            join(DBBinary.architecture). \
-            group_by(
-                DBBinary.package,
-                DBSource.source,
-                Architecture.arch_string,
-        ). \
-        subquery()
-
-        return aliased(q1)
-
-    highq = get_suite_sources(highersuite)
-    lowq = get_suite_sources(lowersuite)
-
-    query = session.query(
-            highq.c.source,
-            highq.c.version.label('higherversion'),
-            lowq.c.version.label('lowerversion')
-    ). \
-    join(lowq, highq.c.source == lowq.c.source)
-
-    if include_equal:
-        query = query.filter(highq.c.version <= lowq.c.version)
-    else:
-        query = query.filter(highq.c.version < lowq.c.version)
+    high = SuiteSnapshot(highersuite.suite_id, session)
+    low = SuiteSnapshot(lowersuite.suite_id, session)
+
+    def newer(higherversion, lowerversion):
+        result = apt_pkg.version_compare(higherversion, lowerversion)
+        return result < 0 or (include_equal and result == 0)
 
     list = []
     # get all sources that have a higher version in lowersuite than in
     # highersuite
-    for (source, higherversion, lowerversion) in query:
-        q1 = session.query(DBBinary.package,
-                           DBSource.source,
-                           DBSource.version,
-                           Architecture.arch_string
-            ). \
-            filter(DBBinary.suites.contains(highersuite)). \
-            join(DBBinary.source). \
-            join(DBBinary.architecture). \
-            filter(DBSource.source == source). \
-            subquery()
-        q2 = session.query(q1.c.arch_string).group_by(q1.c.arch_string)
-        # all architectures for which source has binaries in highersuite
-        archs_high = set(x[0] for x in q2.all())
-
-        highq = get_suite_binaries(highersuite)
-        lowq = get_suite_binaries(lowersuite)
+    for (source, higherversion, lowerversion) in _merge_sources(high.sources, low.sources):
+        if not newer(higherversion, lowerversion):
+            continue
 
-        query = session.query(highq.c.arch_string). \
-            join(lowq, highq.c.source == lowq.c.source). \
-            filter(highq.c.arch_string == lowq.c.arch_string). \
-            filter(highq.c.package == lowq.c.package). \
-            filter(highq.c.source == source)
+        high_binaries = high.binaries.get(source, {})
+        low_binaries = low.binaries.get(source, {})
 
-        if include_equal:
-            query = query. \
-                filter(highq.c.binversion <= lowq.c.binversion). \
-                filter(highq.c.version <= lowq.c.version)
-        else:
-            query = query. \
-                filter(highq.c.binversion < lowq.c.binversion). \
-                filter(highq.c.version < lowq.c.version)
-
-        query = query.group_by(highq.c.arch_string)
+        # all architectures for which source has binaries in highersuite
+        archs_high = set(arch for package, arch in high_binaries)
 
         # all architectures for which source has a newer binary in lowersuite
-        archs_newer = set(x[0] for x in query.all())
+        archs_newer = set()
+        for key, (version, binversion) in high_binaries.items():
+            if key not in low_binaries:
+                continue
+            low_version, low_binversion = low_binaries[key]
+            if newer(binversion, low_binversion) and newer(version, low_version):
+                archs_newer.add(key[1])
 
         # if has at least one binary in lowersuite which is newer than the one
         # in highersuite on each architecture for which source has binaries in
@@ -146,14 +144,16 @@ def get_package_names(suite: Suite):
 class NamedSource:
     '''
     A source package identified by its name with all of its versions in a
-    suite.
+    suite.  The versions are looked up unless given, sorted by version.
     '''
 
-    def __init__(self, suite: Suite, source: str):
+    def __init__(self, suite: Suite, source: str, versions: Optional[list[str]] = None):
         self.source = source
-        query = suite.sources.filter_by(source=source). \
-            order_by(DBSource.version)
-        self.versions = [src.version for src in query]
+        if versions is None:
+            query = suite.sources.filter_by(source=source). \
+                order_by(DBSource.version)
+            versions = [src.version for src in query]
+        self.versions = versions
 
     def __str__(self):
         return "%s(%s)" % (self.source, ", ".join(self.versions))
@@ -169,20 +169,23 @@ class DejavuBinary:
     and another source package 'foo-mipsel' builds a binary package with the
     same name 'foo' on mipsel then the binary package 'foo' will be reported as
     built from multiple source packages.
+
+    The sources are looked up unless given as a list of NamedSource.
     '''
 
-    def __init__(self, suite: Suite, package: str):
+    def __init__(self, suite: Suite, package: str, sources: Optional[list[NamedSource]] = None):
         self.package = package
-        session = object_session(suite)
-        # We need a subquery to make sure that both binary and source packages
-        # are in the right suite.
-        bin_query = suite.binaries.filter_by(package=package).subquery()
-        src_query = session.query(DBSource.source).with_parent(suite). \
-            join(bin_query).order_by(DBSource.source).group_by(DBSource.source)
-        self.sources = []
-        if src_query.count() > 1:
-            for source, in src_query:
-                self.sources.append(str(NamedSource(suite, source)))
+        if sources is None:
+            session = object_session(suite)
+            # We need a subquery to make sure that both binary and source packages
+            # are in the right suite.
+            bin_query = suite.binaries.filter_by(package=package).subquery()
+            src_query = session.query(DBSource.source).with_parent(suite). \
+                join(bin_query).order_by(DBSource.source).group_by(DBSource.source)
+            sources = []
+            if src_query.count() > 1:
+                sources = [NamedSource(suite, source) for source, in src_query]
+        self.sources = [str(source) for source in sources]
 
     def has_multiple_sources(self) -> bool:
         'Has the package been built by multiple sources?'
@@ -192,19 +195,77 @@ class DejavuBinary:
         return "%s built by: %s" % (self.package, ", ".join(self.sources))
 
 
-def report_multiple_source(suite: Suite) -> None:
+class SuiteRelations:
+    '''
+    The source -> binary -> architecture relations of a suite, loaded with
+    two queries so that the cruft checks can look at them without further
+    database access.
+    '''
+
+    def __init__(self, suite_id: int, session):
+        #: source id -> (source, version) of all sources in the suite
+        self.sources = {}
+        #: package -> list of (architecture, version, source id)
+        self.binaries = {}
+
+        for src_id, source, version in session.execute("""
+            SELECT s.id, s.source, s.version
+              FROM source s
+              JOIN src_associations sa ON sa.source = s.id
+             WHERE sa.suite = :suite_id""", {'suite_id': suite_id}):
+            self.sources[src_id] = (source, version)
+
+        for package, arch, version, src_id in session.execute("""
+            SELECT b.package, a.arch_string, b.version, b.source
+              FROM binaries b
+              JOIN bin_associations ba ON ba.bin = b.id
+              JOIN architecture a ON a.id = b.architecture
+             WHERE ba.suite = :suite_id""", {'suite_id': suite_id}):
+            self.binaries.setdefault(package, []).append((arch, version, src_id))
+
+    def has_package(self, package: str) -> bool:
+        'Is there a binary package with this name in the suite?'
+        return package in self.binaries
+
+    def versions(self, package: str) -> list[tuple[str, str]]:
+        'Returns (architecture, version) of all binaries of package in the suite'
+        return [(arch, version) for arch, version, src_id in self.binaries.get(package, ())]
+
+    def multiple_sources(self):
+        '''
+        Yields (package, sources) for binary packages built by sources with
+        different names, see DejavuBinary.  sources is a list of
+        (source, versions) sorted by name, with all versions of the
+        source in the suite.
+        '''
+        version_sort_key = functools.cmp_to_key(apt_pkg.version_compare)
+        source_versions = {}
+        for source, version in self.sources.values():
+            source_versions.setdefault(source, []).append(version)
+
+        for package in sorted(self.binaries):
+            names = set(self.sources[src_id][0] for arch, version, src_id in self.binaries[package]
+                        if src_id in self.sources)
+            if len(names) > 1:
+                yield package, [(name, sorted(source_versions[name], key=version_sort_key))
+                                for name in sorted(names)]
+
+
+def report_multiple_source(suite: Suite, relations: Optional[SuiteRelations] = None) -> None:
     '''
     Reports binary packages built from multiple source package with different
     names.
     '''
 
+    if relations is None:
+        relations = SuiteRelations(suite.suite_id, object_session(suite))
+
     print("Built from multiple source packages")
     print("-----------------------------------")
     print()
-    for package, in get_package_names(suite):
-        binary = DejavuBinary(suite, package)
-        if binary.has_multiple_sources():
-            print(binary)
+    for package, sources in relations.multiple_sources():
+        print(DejavuBinary(suite, package, [NamedSource(suite, source, versions)
+                                            for source, versions in sources]))
     print()
 
 
@@ -43,7 +43,6 @@ from collections.abc import Iterable
 from typing import Optional, TYPE_CHECKING, Union
 
 from debian.debfile import Deb822
-from tarfile import TarFile
 
 import sqlalchemy
 from sqlalchemy import create_engine, Table, desc
@@ -370,17 +369,10 @@ class DBBinary(ORMObject):
         or iso8859-1 encoding. It yields the string ' <EMPTY PACKAGE>' if the
         package does not contain any regular file.
         '''
-        fullpath = self.poolfile.fullpath
-        dpkg_cmd = ('dpkg-deb', '--fsys-tarfile', fullpath)
-        dpkg = subprocess.Popen(dpkg_cmd, stdout=subprocess.PIPE)
-        tar = TarFile.open(fileobj=dpkg.stdout, mode='r|')
-        for member in tar.getmembers():
+        from .deb import iter_data_members
+        for member in iter_data_members(self.poolfile.fullpath):
             if not member.isdir():
-                name = normpath(member.name)
-                yield name
-        tar.close()
-        dpkg.stdout.close()
-        dpkg.wait()
+                yield normpath(member.name)
 
     def read_control(self) -> bytes:
         '''
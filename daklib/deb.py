@@ -0,0 +1,285 @@
+# Copyright (C) 2026, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Streaming access to binary packages (.deb/.udeb)
+
+The functions in this module read a package sequentially: neither the
+ar archive nor the tarballs in it are extracted to disk, and tarball
+members are handled one at a time instead of loading the member list.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import signal
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import IO, Optional
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+
+class DebError(Exception):
+    pass
+
+
+class _BoundedReader(io.RawIOBase):
+    """
+    Read at most `size` bytes from an underlying file object.
+    """
+
+    def __init__(self, fh: IO[bytes], size: int):
+        self.fh = fh
+        self.remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.remaining <= 0:
+            return 0
+        n = self.fh.readinto(memoryview(b)[:min(len(b), self.remaining)])
+        if not n:
+            raise DebError('truncated ar member')
+        self.remaining -= n
+        return n
+
+    def skip(self) -> None:
+        while self.remaining > 0:
+            chunk = self.fh.read(min(self.remaining, 1024 * 1024))
+            if not chunk:
+                raise DebError('truncated ar member')
+            self.remaining -= len(chunk)
+
+
+def iter_ar_members(fh: IO[bytes]) -> Iterator[tuple[str, IO[bytes]]]:
+    """
+    Iterate over the members of an ar archive.
+
+    Yields (name, file object) for every member.  The file object is only
+    valid until the next member is requested; unread data is skipped.
+    """
+    if fh.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebError('not an ar archive')
+    while True:
+        header = fh.read(AR_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+            raise DebError('invalid ar member header')
+        name = header[0:16].decode('ascii').rstrip()
+        # GNU ar terminates names with a slash
+        if name.endswith('/') and name != '/':
+            name = name[:-1]
+        size = int(header[48:58].decode('ascii'))
+        member = _BoundedReader(fh, size)
+        yield name, io.BufferedReader(member)
+        member.skip()
+        if size % 2:
+            fh.read(1)
+
+
+@contextmanager
+def _decompress_zstd(fh: IO[bytes]):
+    # There is no zstd support in the standard library; stream the member
+    # through zstd, feeding its stdin from a thread.
+    process = subprocess.Popen(['zstd', '--decompress', '--stdout'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            with process.stdin as stdin:
+                while chunk := fh.read(1024 * 1024):
+                    stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    killed = False
+    try:
+        yield process.stdout
+    finally:
+        # Stop zstd if the caller did not read everything.  At the end of
+        # the output zstd exits by itself and its status is checked below.
+        if process.poll() is None and process.stdout.peek(1):
+            process.kill()
+            killed = True
+        process.stdout.close()
+        feeder.join()
+        process.wait()
+    # A corrupt member would otherwise just look shorter than it is
+    if process.returncode != 0 and not (killed and process.returncode == -signal.SIGKILL):
+        raise DebError('zstd exited with status {0}'.format(process.returncode))
+
+
+@contextmanager
+def open_tar_member(name: str, fh: IO[bytes]):
+    """
+    Open the (possibly compressed) tarball `name` read from `fh` as a
+    streaming tarfile.TarFile.
+    """
+    if name.endswith('.tar'):
+        decompressed = None
+    elif name.endswith('.tar.gz'):
+        decompressed = gzip.GzipFile(fileobj=fh, mode='rb')
+    elif name.endswith('.tar.xz'):
+        decompressed = lzma.LZMAFile(fh, mode='rb')
+    elif name.endswith('.tar.bz2'):
+        decompressed = bz2.BZ2File(fh, mode='rb')
+    elif name.endswith('.tar.zst'):
+        with _decompress_zstd(fh) as stdout, tarfile.open(fileobj=stdout, mode='r|') as tar:
+            yield tar
+        return
+    else:
+        raise DebError('unsupported tarball {0}'.format(name))
+    with tarfile.open(fileobj=decompressed or fh, mode='r|') as tar:
+        yield tar
+
+
+def iter_tar(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """
+    Iterate over the members of a streaming tarball without collecting
+    them in tar.members.
+    """
+    while (member := tar.next()) is not None:
+        yield member
+        tar.members = []
+
+
+def iter_data_members(path: str) -> Iterator[tarfile.TarInfo]:
+    """
+    Iterate over the members of the data tarball of the package at `path`.
+    """
+    with open(path, 'rb') as fh:
+        for name, member in iter_ar_members(fh):
+            if not name.startswith('data.tar'):
+                continue
+            with open_tar_member(name, member) as tar:
+                yield from iter_tar(tar)
+            return
+    raise DebError('{0}: no data tarball found'.format(path))
+
+
+class DebContents:
+    """
+    Everything scan_deb read from a binary package.
+    """
+
+    def __init__(self):
+        #: files of the control tarball (name without leading ./ -> data)
+        self.control_files: dict[str, bytes] = {}
+        #: members of the data tarball, in order
+        self.members: list[tarfile.TarInfo] = []
+        #: name -> data of the selected regular files of the data tarball
+        self.files: dict[str, bytes] = {}
+
+    @property
+    def control(self) -> Optional[bytes]:
+        return self.control_files.get('control')
+
+    @property
+    def md5sums(self) -> Optional[bytes]:
+        return self.control_files.get('md5sums')
+
+
+def scan_deb(path: str, select: Optional[Callable[[str], bool]] = None) -> DebContents:
+    """
+    Read the package at `path` in a single pass.
+
+    All regular files of the control tarball are kept, as is the data of
+    regular files in the data tarball whose name `select` returns true
+    for.  Member data is never spooled to disk.
+    """
+    contents = DebContents()
+    with open(path, 'rb') as fh:
+        for name, member in iter_ar_members(fh):
+            if name.startswith('control.tar'):
+                with open_tar_member(name, member) as tar:
+                    for info in iter_tar(tar):
+                        if info.isfile():
+                            contents.control_files[os.path.normpath(info.name)] = tar.extractfile(info).read()
+            elif name.startswith('data.tar'):
+                with open_tar_member(name, member) as tar:
+                    for info in iter_tar(tar):
+                        contents.members.append(info)
+                        if info.isfile() and select is not None and select(info.name):
+                            contents.files[info.name] = tar.extractfile(info).read()
+                break
+    if contents.control is None:
+        raise DebError('{0}: no control file found'.format(path))
+    return contents
+
+
+def _quote_member_name(name: str) -> str:
+    # like tar's default "escape" quoting style
+    return ''.join(c if c.isprintable() and c != '\\' else
+                   '\\\\' if c == '\\' else
+                   ''.join('\\%03o' % b for b in c.encode('utf-8', 'surrogateescape'))
+                   for c in name)
+
+
+def _member_mode(member: tarfile.TarInfo) -> str:
+    if member.isdir():
+        kind = 'd'
+    elif member.issym():
+        kind = 'l'
+    elif member.islnk():
+        kind = 'h'
+    elif member.ischr():
+        kind = 'c'
+    elif member.isblk():
+        kind = 'b'
+    elif member.isfifo():
+        kind = 'p'
+    else:
+        kind = '-'
+    return kind + stat.filemode(member.mode)[1:]
+
+
+def format_members(members: list[tarfile.TarInfo]) -> str:
+    """
+    List tarball members like `tar -tv` (and so `dpkg -c`) does.
+    """
+    lines = []
+    width = 19
+    for member in members:
+        user = member.uname or str(member.uid)
+        group = member.gname or str(member.gid)
+        name = member.name + '/' if member.isdir() else member.name
+        if member.ischr() or member.isblk():
+            size = '{0},{1}'.format(member.devmajor, member.devminor)
+        else:
+            size = str(member.size)
+        pad = len(user) + len(group) + len(size) + 2
+        width = max(width, pad)
+        mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(member.mtime))
+        line = '{0} {1}/{2} {3} {4} {5}'.format(
+            _member_mode(member), user, group,
+            size.rjust(width - pad + len(size)), mtime, _quote_member_name(name))
+        if member.issym():
+            line += ' -> ' + _quote_member_name(member.linkname)
+        elif member.islnk():
+            line += ' link to ' + _quote_member_name(member.linkname)
+        lines.append(line)
+    return ''.join(line + '\n' for line in lines)
@@ -25,9 +25,14 @@ Helper code for file writing with optional compression.
 ################################################################################
 
 import errno
+import hashlib
+import io
+import json
 import os
 import os.path
+import queue
 import subprocess
+import threading
 from dataclasses import dataclass
 from typing import Optional, TextIO
 
@@ -37,22 +42,193 @@ class CompressionMethod:
     keyword: str
     extension: str
     command: Optional[list[str]]
+    # option to use several threads, formatted with the number of threads
+    threads_option: Optional[str] = None
+
+    def command_for(self, threads: int = 1) -> Optional[list[str]]:
+        if self.command is None or threads <= 1 or self.threads_option is None:
+            return self.command
+        return self.command + [self.threads_option.format(threads)]
 
 
 _compression_methods = (
     CompressionMethod('bzip2', '.bz2', ['bzip2', '-9']),
     CompressionMethod('gzip', '.gz', ['gzip', '-9cn', '--rsyncable', '--no-name']),
-    CompressionMethod('xz', '.xz', ['xz', '-c']),
-    CompressionMethod('zstd', '.zst', ['zstd', '--compress']),
-    # 'none' must be the last compression method as BaseFileWriter
-    # handling it will remove the input file for other compressions
+    CompressionMethod('xz', '.xz', ['xz', '-c'], '--threads={0}'),
+    CompressionMethod('zstd', '.zst', ['zstd', '--compress'], '-T{0}'),
     CompressionMethod('none', '', None),
 )
 
 
+def _allocate_threads(methods, budget: Optional[int]) -> dict[str, int]:
+    '''
+    Split a budget of CPUs between the external compressors in methods.
+
+    Every compressor gets one CPU; without a budget, that is all.  With a
+    budget, the total never exceeds it: if there are more compressors
+    than CPUs, BaseFileWriter only runs `budget` of them at a time.  What
+    is left after giving every compressor one CPU is shared between the
+    compressors able to use several threads, in the order of
+    _compression_methods.
+    '''
+    external = [m for m in methods if m.command is not None]
+    threaded = [m for m in external if m.threads_option is not None]
+    allocation = {m.keyword: 1 for m in external}
+    spare = (budget or 0) - len(external)
+    for i, method in enumerate(threaded):
+        if spare <= 0:
+            break
+        share = -(-spare // (len(threaded) - i))
+        allocation[method.keyword] += share
+        spare -= share
+    return allocation
+
+
+class _CompressorFeeder:
+    '''
+    Feed a compressor's stdin from a bounded queue in its own thread, so
+    that a slow compressor does not stall the others until its queue is
+    full.
+    '''
+
+    def __init__(self, process: subprocess.Popen, maxsize: int = 64):
+        self.process = process
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        chunk = b''
+        try:
+            with self.process.stdin as stdin:
+                while (chunk := self.queue.get()) is not None:
+                    stdin.write(chunk)
+        except BaseException as e:
+            self.error = e
+            # keep draining so the writer does not block forever, unless
+            # closing stdin failed after the end was already seen
+            while chunk is not None:
+                chunk = self.queue.get()
+
+    def write(self, b) -> None:
+        self.queue.put(bytes(b))
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# hashes of the uncompressed content recorded in the hash manifest
+_manifest_hashes = ('md5', 'sha1', 'sha256')
+
+
+def hash_manifest_path(staging_dir: str, path: str) -> str:
+    '''
+    Returns the path of the manifest holding size and hashes of the
+    uncompressed content written to path.  It is kept below staging_dir,
+    next to the staged copy, so it is not published with the indices.
+    '''
+    dirname, basename = os.path.split(staging_path(staging_dir, path))
+    return os.path.join(dirname, '.{0}.hashes'.format(basename))
+
+
+def read_hash_manifest(staging_dir: Optional[str], path: str, output: str) -> Optional[dict]:
+    '''
+    Returns the size ('len') and hashes (by hashlib name) of the
+    uncompressed content written to path, provided output (the
+    uncompressed file, one of its compressed versions or the staged
+    copy) is still the file that was written together with the manifest.
+    Returns None if there is no such manifest.
+    '''
+    if not staging_dir:
+        return None
+    try:
+        with open(hash_manifest_path(staging_dir, path)) as fh:
+            manifest = json.load(fh)
+        st = os.stat(output)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('outputs', {}).get(os.path.basename(output)) != [st.st_size, st.st_mtime_ns]:
+        return None
+    return manifest['content']
+
+
+def staging_path(staging_dir: str, path: str) -> str:
+    '''
+    Returns where the uncompressed copy of the index written to path is
+    left below staging_dir.
+    '''
+    return os.path.join(staging_dir, os.path.abspath(path).lstrip('/'))
+
+
+class _HashingOutput:
+    '''
+    Output computing size and hashes of everything written to it.
+    '''
+
+    def __init__(self):
+        self.size = 0
+        self.hashes = {name: hashlib.new(name) for name in _manifest_hashes}
+
+    def write(self, b) -> None:
+        self.size += len(b)
+        for h in self.hashes.values():
+            h.update(b)
+
+    def close(self) -> None:
+        pass
+
+    def content(self) -> dict:
+        content = {name: h.hexdigest() for name, h in self.hashes.items()}
+        content['len'] = self.size
+        return content
+
+
+class _FanOutWriter(io.RawIOBase):
+    '''
+    Raw stream passing every write on to several binary file objects.
+    '''
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        for output in self.outputs:
+            output.write(b)
+        return len(b)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        error = None
+        for output in self.outputs:
+            try:
+                output.close()
+            except Exception as e:
+                error = error or e
+        super().close()
+        if error is not None:
+            raise error
+
+
 class BaseFileWriter:
     '''
     Base class for compressed and uncompressed file writing.
+
+    Everything written to the file object returned by open() is streamed
+    to all requested compressors at the same time; the uncompressed file
+    is only written when 'none' is one of the requested compressions.
+
+    With a staging directory, size and hashes of the uncompressed content
+    are recorded in a hash manifest below it (see read_hash_manifest) so
+    they do not need to be computed again by decompressing the output
+    later.
     '''
 
     def __init__(self, template, **keywords):
@@ -62,8 +238,29 @@ class BaseFileWriter:
         should be relative to the archive's root directory. The keywords
         include strings for suite, component, architecture and booleans
         uncompressed, gzip, bzip2.
+
+        The optional keyword compression_threads is the number of CPUs
+        the compressors may use in total.  Without it, or with 0, all
+        compressors run at the same time with one thread each.  With a
+        budget smaller than the number of compressors, only that many are
+        fed while the file is written; the others compress a temporary
+        uncompressed copy in close(), again at most that many at a time.
+        CPUs left over after giving every compressor one are used to run
+        xz and zstd multi-threaded (see _allocate_threads).  Their output only
+        depends on the number of threads they get, so it is reproducible
+        for a given budget.  With a budget of more than one CPU and
+        several compressors, every compressor running while the file is
+        written is fed from its own thread.
+
+        If the optional keyword staging_dir is set, the hash manifest is
+        written below it, and if no uncompressed file is requested, an
+        uncompressed copy is left at staging_path(staging_dir, path) for
+        generate-index-diffs.  The copy is listed in the hash manifest, so
+        readers can check it belongs to the compressed files.
         '''
         self.compression = keywords.get('compression', ['none'])
+        self.compression_threads = keywords.get('compression_threads') or None
+        self.staging_dir = keywords.get('staging_dir')
         self.path = template % keywords
 
     def open(self) -> TextIO:
@@ -75,32 +272,139 @@ class BaseFileWriter:
             os.makedirs(os.path.dirname(self.path))
         except:
             pass
-        self.file = open(self.path + '.new', 'w')
+        methods = [m for m in _compression_methods if m.keyword in self.compression]
+        self.threads = _allocate_threads(methods, self.compression_threads)
+        external = [m for m in methods if m.command is not None]
+        running = len(external) if self.compression_threads is None else max(self.compression_threads, 1)
+        self.deferred = external[running:]
+        concurrent = running > 1 and len(external) > 1 and self.compression_threads is not None
+        self.processes = []
+        self.content_hashes = _HashingOutput()
+        self.spool = None
+        self.staging = None
+        outputs = self.outputs = [self.content_hashes]
+        try:
+            for method in methods:
+                out_fh = open("{0}{1}.new".format(self.path, method.extension), 'wb')
+                if method.command is None:
+                    outputs.append(out_fh)
+                    self.spool = out_fh.name
+                    continue
+                if method in self.deferred:
+                    out_fh.close()
+                    continue
+                with out_fh:
+                    command = method.command_for(self.threads[method.keyword])
+                    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=out_fh, close_fds=True)
+                self.processes.append(process)
+                outputs.append(_CompressorFeeder(process) if concurrent else process.stdin)
+            if self.staging_dir and 'none' not in self.compression:
+                self.staging = staging_path(self.staging_dir, self.path)
+                os.makedirs(os.path.dirname(self.staging), exist_ok=True)
+                outputs.append(open(self.staging + '.new', 'wb'))
+                self.spool = self.spool or self.staging + '.new'
+            if self.deferred and self.spool is None:
+                # uncompressed copy for the compressors run by close()
+                self.spool = "{0}.spool.new".format(self.path)
+                outputs.append(open(self.spool, 'wb'))
+        except BaseException:
+            self._abort(outputs)
+            raise
+        self.file = io.TextIOWrapper(io.BufferedWriter(_FanOutWriter(outputs)))
         return self.file
 
+    # internal helper function
+    def _abort(self, outputs) -> None:
+        '''
+        Stops the compressors started so far and removes the files
+        written by them.
+        '''
+        for output in outputs:
+            if isinstance(output, _CompressorFeeder):
+                output = output.process.stdin
+            try:
+                output.close()
+            except Exception:
+                pass
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        for method in _compression_methods:
+            if method.keyword in self.compression:
+                self._unlink("{0}{1}.new".format(self.path, method.extension))
+        if self.spool is not None:
+            self._unlink(self.spool)
+        if self.staging is not None:
+            self._unlink(self.staging + '.new')
+
+    # internal helper function
+    def _unlink(self, filename: str) -> None:
+        try:
+            os.unlink(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    # internal helper function
+    def _wait(self, processes) -> None:
+        for process in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    # internal helper function
+    def _compress_deferred(self) -> None:
+        '''
+        Runs the compressors that did not fit into the budget on the
+        uncompressed copy, at most compression_threads at a time.
+        '''
+        if not self.deferred:
+            return
+        for i in range(0, len(self.deferred), self.compression_threads):
+            processes = []
+            for method in self.deferred[i:i + self.compression_threads]:
+                with open(self.spool, 'rb') as in_fh, \
+                        open("{0}{1}.new".format(self.path, method.extension), 'wb') as out_fh:
+                    command = method.command_for(self.threads[method.keyword])
+                    processes.append(subprocess.Popen(command, stdin=in_fh, stdout=out_fh, close_fds=True))
+            # known to _abort() if one of them fails
+            self.processes.extend(processes)
+            self._wait(processes)
+        if self.spool == "{0}.spool.new".format(self.path):
+            os.unlink(self.spool)
+
+    def output_paths(self) -> list[str]:
+        '''
+        Returns the paths of all files written by close().
+        '''
+        return ["{0}{1}".format(self.path, method.extension)
+                for method in _compression_methods
+                if method.keyword in self.compression]
+
     # internal helper function
     def rename(self, filename: str) -> None:
         tempfilename = filename + '.new'
         os.chmod(tempfilename, 0o644)
         os.rename(tempfilename, filename)
 
-    # internal helper function to compress output
-    def compress(self, cmd, suffix, path) -> None:
-        in_filename = "{0}.new".format(path)
-        out_filename = "{0}{1}.new".format(path, suffix)
-        if cmd is not None:
-            with open(in_filename, 'r') as in_fh, open(out_filename, 'w') as out_fh:
-                subprocess.check_call(cmd, stdin=in_fh, stdout=out_fh, close_fds=True)
-        self.rename("{0}{1}".format(path, suffix))
-
     def close(self) -> None:
         '''
-        Closes the file object and does the compression and rename work.
+        Closes the file object, waits for the compressors and does the
+        rename work.
         '''
-        self.file.close()
+        try:
+            self.file.close()
+            self._wait(self.processes)
+            self._compress_deferred()
+        except BaseException:
+            self._abort(self.outputs)
+            raise
+        outputs = {}
         for method in _compression_methods:
             if method.keyword in self.compression:
-                self.compress(method.command, method.extension, self.path)
+                filename = "{0}{1}".format(self.path, method.extension)
+                self.rename(filename)
+                st = os.stat(filename)
+                outputs[os.path.basename(filename)] = [st.st_size, st.st_mtime_ns]
             else:
                 # Try removing the file that would be generated.
                 # It's not an error if it does not exist.
@@ -109,8 +413,20 @@ class BaseFileWriter:
                 except OSError as e:
                     if e.errno != errno.ENOENT:
                         raise
-        else:
-            os.unlink(self.path + '.new')
+        if self.staging is not None:
+            self.rename(self.staging)
+            st = os.stat(self.staging)
+            outputs[os.path.basename(self.staging)] = [st.st_size, st.st_mtime_ns]
+        if self.staging_dir:
+            self.write_hash_manifest(outputs)
+
+    # internal helper function
+    def write_hash_manifest(self, outputs: dict) -> None:
+        manifest = hash_manifest_path(self.staging_dir, self.path)
+        os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        with open(manifest + '.new', 'w') as fh:
+            json.dump({'content': self.content_hashes.content(), 'outputs': outputs}, fh)
+        self.rename(manifest)
 
 
 class BinaryContentsFileWriter(BaseFileWriter):
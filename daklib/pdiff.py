@@ -1,6 +1,14 @@
 import asyncio
+import bz2
 import collections
+import contextlib
+import difflib
+import gzip
+import hashlib
+import lzma
 import os
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -48,55 +56,49 @@ async def asyncio_check_call(*args, **kwargs):
     return 0
 
 
-async def open_decompressed(file, named_temp_file=False):
-    async def call_decompressor(cmd, inpath):
-        fh = tempfile.NamedTemporaryFile("w+") if named_temp_file \
-            else tempfile.TemporaryFile("w+")
-        with open(inpath, "rb") as rfd:
-            await asyncio_check_call(
-                *cmd,
-                stdin=rfd,
-                stdout=fh,
-            )
-        fh.seek(0)
-        return fh
+@contextlib.contextmanager
+def _open_decompressed_binary(file):
+    """Open file or its compressed variant for reading bytes
 
+    Decompression happens in-process except for zstd, which is not
+    supported by the standard library.  Yields None if there is neither.
+    """
     if os.path.isfile(file):
-        return open(file, "r")
+        with open(file, "rb") as fh:
+            yield fh
     elif os.path.isfile("%s.gz" % file):
-        return await call_decompressor(['zcat'], '{}.gz'.format(file))
+        with gzip.open("%s.gz" % file, "rb") as fh:
+            yield fh
     elif os.path.isfile("%s.bz2" % file):
-        return await call_decompressor(['bzcat'], '{}.bz2'.format(file))
+        with bz2.open("%s.bz2" % file, "rb") as fh:
+            yield fh
     elif os.path.isfile("%s.xz" % file):
-        return await call_decompressor(['xzcat'], '{}.xz'.format(file))
+        with lzma.open("%s.xz" % file, "rb") as fh:
+            yield fh
     elif os.path.isfile(f"{file}.zst"):
-        return await call_decompressor(['zstdcat'], f'{file}.zst')
+        proc = subprocess.Popen(['zstdcat', f'{file}.zst'], stdout=subprocess.PIPE)
+        try:
+            with proc.stdout as fh:
+                yield fh
+        finally:
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
     else:
-        return None
-
+        yield None
 
-async def _merge_pdiffs(patch_a, patch_b, resulting_patch_without_extension):
-    """Merge two pdiff in to a merged pdiff
 
-    While rred support merging more than 2, we only need support for merging two.
-    In the steady state, we will have N merged patches plus 1 new patch.  Here
-    we need to do N pairwise merges (i.e. merge two patches N times).
-    Therefore, supporting merging of 3+ patches does not help at all.
-
-    The setup state looks like it could do with a bulk merging. However, if you
-    merge from "latest to earliest" then you will be building in optimal order
-    and still only need to do N-1 pairwise merges (rather than N-1 merges
-    between N, N-1, N-2, ... 3, 2 patches).
+async def open_decompressed(file, named_temp_file=False):
+    if os.path.isfile(file):
+        return open(file, "r")
 
-    Combined, supporting pairwise merges is sufficient for our use case.
-    """
-    with await open_decompressed(patch_a, named_temp_file=True) as fd_a, \
-            await open_decompressed(patch_b, named_temp_file=True) as fd_b:
-        await asyncio_check_call(
-            '/usr/lib/apt/methods/rred %s %s | gzip -9n > %s' % (fd_a.name, fd_b.name,
-                                                                 resulting_patch_without_extension + ".gz"),
-            shell=True,
-        )
+    with _open_decompressed_binary(file) as rfd:
+        if rfd is None:
+            return None
+        fh = tempfile.NamedTemporaryFile("w+") if named_temp_file \
+            else tempfile.TemporaryFile("w+")
+        shutil.copyfileobj(rfd, fh.buffer)
+    fh.seek(0)
+    return fh
 
 
 class PDiffHashes(_PDiffHashes):
@@ -108,14 +110,355 @@ class PDiffHashes(_PDiffHashes):
         return cls(size, hashes.sha1, hashes.sha256)
 
 
-async def _pdiff_hashes_from_patch(path_without_extension):
-    with await open_decompressed(path_without_extension) as difff:
-        hashes_decompressed = PDiffHashes.from_file(difff)
+class _HashingWriter:
+    """Compute size and hashes of everything written, passing it on to fh"""
+
+    def __init__(self, fh=None):
+        self.fh = fh
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+        if self.fh is not None:
+            self.fh.write(data)
+        return len(data)
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+
+    def pdiff_hashes(self):
+        return PDiffHashes(self.size, self.sha1.hexdigest(), self.sha256.hexdigest())
+
+
+def _read_lines(fh, known_hashes=None):
+    if known_hashes is not None:
+        return fh.readlines(), known_hashes
+    hashes = _HashingWriter()
+    lines = []
+    for line in fh:
+        hashes.write(line)
+        lines.append(line)
+    return lines, hashes.pdiff_hashes()
+
+
+def _split_units(lines, stanzas):
+    """Split lines into the units compared by the diff
+
+    Returns the units and the index of the first line of every unit (plus
+    the number of lines).  With stanzas, a unit is a stanza including the
+    blank line ending it; otherwise (e.g. for Contents) every line is a
+    unit of its own.
+    """
+    if not stanzas:
+        return lines, range(len(lines) + 1)
+    units = []
+    offsets = [0]
+    for i, line in enumerate(lines):
+        if line == b"\n":
+            units.append(b"".join(lines[offsets[-1]:i + 1]))
+            offsets.append(i + 1)
+    if offsets[-1] != len(lines):
+        units.append(b"".join(lines[offsets[-1]:]))
+        offsets.append(len(lines))
+    return units, offsets
+
+
+def _align_units(old, new):
+    """Yield (i1, i2, j1, j2) for every range of old units replaced by new units
+
+    Units of index files are unique (one stanza per package and version,
+    one line per file), so units are matched by identity: at a mismatch,
+    units only found on one side are deleted or inserted and if both
+    units still show up later, the side with the shorter distance to
+    resynchronisation is advanced.  This is linear in the size of the
+    files and, for files sorted the same way, yields a minimal diff.
+    Units are never moved, so the result is correct for any input.
+    """
+    old_pos = {}
+    for i, unit in enumerate(old):
+        old_pos.setdefault(unit, i)
+    new_pos = {}
+    for j, unit in enumerate(new):
+        new_pos.setdefault(unit, j)
+
+    i = j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+            continue
+        i1, j1 = i, j
+        while i < len(old) and j < len(new) and old[i] != new[j]:
+            in_new = new_pos.get(old[i], -1)
+            in_old = old_pos.get(new[j], -1)
+            if in_new < j:
+                i += 1
+            elif in_old < i:
+                j += 1
+            elif in_new - j <= in_old - i:
+                j = in_new
+            else:
+                i = in_old
+        yield i1, i, j1, j
+    if i < len(old) or j < len(new):
+        yield i, len(old), j, len(new)
+
+
+# Replaced ranges with more lines than this (old times new) are not
+# refined into line-level edits.
+_REFINE_LIMIT = 10 ** 6
+
+
+def _ed_command(a1, a2, text):
+    """Return the ed command replacing old lines a1..a2 by text"""
+    if a1 == a2:
+        command = [b"%da\n" % a1]
+    else:
+        lines = b"%d" % (a1 + 1) if a2 - a1 == 1 else b"%d,%d" % (a1 + 1, a2)
+        command = [lines + (b"c\n" if text else b"d\n")]
+    if text:
+        if b".\n" in text:
+            raise ValueError("cannot represent a line consisting of a single dot in an ed script")
+        command.extend(text)
+        command.append(b".\n")
+    return b"".join(command)
+
+
+def _ed_script(old_lines, new_lines):
+    """Yield the commands of the ed script turning old_lines into new_lines
+
+    The files are compared stanza by stanza (see _align_units); replaced
+    stanzas are then refined into line-level edits.  Like diff --ed, the
+    commands are ordered from the end of the file to the start.
+    """
+    stanzas = b"\n" in old_lines or b"\n" in new_lines
+    old_units, old_offsets = _split_units(old_lines, stanzas)
+    new_units, new_offsets = _split_units(new_lines, stanzas)
+
+    commands = []
+    for i1, i2, j1, j2 in _align_units(old_units, new_units):
+        a1, a2 = old_offsets[i1], old_offsets[i2]
+        b1, b2 = new_offsets[j1], new_offsets[j2]
+        if a1 == a2 or b1 == b2 or (a2 - a1) * (b2 - b1) > _REFINE_LIMIT:
+            commands.append((a1, a2, b1, b2))
+            continue
+        matcher = difflib.SequenceMatcher(None, old_lines[a1:a2], new_lines[b1:b2], autojunk=False)
+        for tag, c1, c2, d1, d2 in matcher.get_opcodes():
+            if tag != 'equal':
+                commands.append((a1 + c1, a1 + c2, b1 + d1, b1 + d2))
+
+    for a1, a2, b1, b2 in reversed(commands):
+        yield _ed_command(a1, a2, new_lines[b1:b2])
+
+
+def _generate_patch_file(original_file, new_file_uncompressed, patch_path,
+                         oldsizehashes=None, newsizehashes=None):
+    """Write the gzip-compressed ed script from original_file to new_file_uncompressed
+
+    Size and hashes of the files are computed while reading them unless
+    they are passed in.  Returns the size and hashes of the old and new
+    file and of the plain and compressed patch; the latter two are None
+    if the files are equal (no patch is written then).
+    """
+    if oldsizehashes is not None and oldsizehashes == newsizehashes:
+        return oldsizehashes, newsizehashes, None, None
+
+    with _open_decompressed_binary(original_file) as oldf:
+        if oldf is None:
+            raise FileNotFoundError(original_file)
+        old_lines, oldsizehashes = _read_lines(oldf, oldsizehashes)
+    with open(new_file_uncompressed, "rb") as newf:
+        new_lines, newsizehashes = _read_lines(newf, newsizehashes)
+
+    if newsizehashes == oldsizehashes:
+        return oldsizehashes, newsizehashes, None, None
+
+    os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+    difsizehashes, difgzsizehashes = _write_patch(patch_path, _ed_script(old_lines, new_lines))
 
-    with open(path_without_extension + ".gz", "r") as difffgz:
-        hashes_compressed = PDiffHashes.from_file(difffgz)
+    return oldsizehashes, newsizehashes, difsizehashes, difgzsizehashes
 
-    return hashes_decompressed, hashes_compressed
+
+def _write_patch(patch_path, commands):
+    """Write the ed commands gzip-compressed to patch_path + ".gz"
+
+    Returns the size and hashes of the plain and the compressed patch.
+    """
+    plain = _HashingWriter()
+    with open("{}.gz".format(patch_path), "wb") as fh:
+        compressed = _HashingWriter(fh)
+        with gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=compressed, mtime=0) as gz:
+            for command in commands:
+                plain.write(command)
+                gz.write(command)
+    return plain.pdiff_hashes(), compressed.pdiff_hashes()
+
+
+_re_ed_command = re.compile(rb"^(\d+)(?:,(\d+))?([acd])\n$")
+
+
+def _parse_ed_script(lines):
+    """Parse an ed script as written by diff --ed
+
+    Returns the edits as (start, end, text) tuples in file order: lines
+    start..end (counted from zero, end excluded) of the old file are
+    replaced by text.
+    """
+    edits = []
+    lines = iter(lines)
+    for line in lines:
+        match = _re_ed_command.match(line)
+        if match is None:
+            raise ValueError("unsupported ed command {!r}".format(line))
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        op = match.group(3)
+        text = []
+        if op in (b"a", b"c"):
+            for line in lines:
+                if line == b".\n":
+                    break
+                text.append(line)
+            else:
+                raise ValueError("unterminated text in ed script")
+        if op == b"a":
+            edits.append((start, start, text))
+        else:
+            edits.append((start - 1, end, text))
+    edits.reverse()
+    for (_, end, _), (start, _, _) in zip(edits, edits[1:]):
+        if start < end:
+            raise ValueError("ed script with overlapping or unordered commands")
+    return edits
+
+
+def _edits_to_pieces(edits):
+    """Describe the file resulting from edits as a list of pieces
+
+    A piece is either a tuple (start, end) of lines copied from the old
+    file (end is None for "up to the end of the file") or a list of new
+    lines.
+    """
+    pieces = []
+    pos = 0
+    for start, end, text in edits:
+        if start > pos:
+            pieces.append((pos, start))
+        if text:
+            pieces.append(text)
+        pos = end
+    pieces.append((pos, None))
+    return pieces
+
+
+def _piece_length(piece):
+    if isinstance(piece, tuple):
+        return float("inf") if piece[1] is None else piece[1] - piece[0]
+    return len(piece)
+
+
+def _split_piece(piece, n):
+    if isinstance(piece, tuple):
+        return (piece[0], piece[0] + n), (piece[0] + n, piece[1])
+    return piece[:n], piece[n:]
+
+
+def _move_pieces(pieces, pos, target, out):
+    """Take the pieces up to line target from the deque pieces (whose
+    first piece starts at line pos) and append them to out unless it is
+    None"""
+    while pos < target:
+        if not pieces:
+            raise ValueError("ed script refers to lines beyond the end of the file")
+        piece = pieces.popleft()
+        n = _piece_length(piece)
+        if pos + n > target:
+            piece, rest = _split_piece(piece, target - pos)
+            pieces.appendleft(rest)
+            n = target - pos
+        if out is not None:
+            out.append(piece)
+        pos += n
+    return pos
+
+
+def _compose_edits(edits_a, edits_b):
+    """Compose two ed scripts
+
+    Given the edits (see _parse_ed_script) of a patch from file A to B
+    and of a patch from file B to C, returns the edits of a patch from A
+    to C.  The files themselves are not needed: file B is described as
+    pieces of A and new lines from the first patch, the second patch is
+    applied to those and the pieces copied from A are turned back into
+    edits.
+    """
+    pieces = collections.deque(_edits_to_pieces(edits_a))
+    result = []
+    pos = 0
+    for start, end, text in edits_b:
+        pos = _move_pieces(pieces, pos, start, result)
+        pos = _move_pieces(pieces, pos, end, None)
+        if text:
+            result.append(text)
+    result.extend(pieces)
+
+    edits = []
+    pos = 0
+    text = []
+    for piece in result:
+        if isinstance(piece, list):
+            text.extend(piece)
+            continue
+        start, end = piece
+        if start > pos or text:
+            edits.append((pos, start, text))
+            text = []
+        pos = end
+    return edits
+
+
+def _read_patch(patch_path):
+    with _open_decompressed_binary(patch_path) as fh:
+        if fh is None:
+            raise FileNotFoundError(patch_path)
+        return _parse_ed_script(fh)
+
+
+def _merge_patch_files(merges):
+    """Merge pairs of patches
+
+    merges is a list of (patch_a, patch_b, resulting_patch) paths (without
+    extension); patch_a and patch_b are merged into a single patch doing
+    the work of both.  The merges are done in order, so a resulting patch
+    can be used by later merges.  Every patch is parsed only once, which
+    matters as all merged patches are usually merged with the same new
+    patch.  Returns the size and hashes of the plain and compressed
+    resulting patches.
+    """
+    parsed = {}
+
+    def edits(path):
+        if path not in parsed:
+            parsed[path] = _read_patch(path)
+        return parsed[path]
+
+    result = []
+    for patch_a, patch_b, resulting_patch in merges:
+        merged = _compose_edits(edits(patch_a), edits(patch_b))
+        parsed[resulting_patch] = merged
+        commands = (_ed_command(start, end, text) for start, end, text in reversed(merged))
+        result.append(_write_patch(resulting_patch, commands))
+    return result
+
+
+def stat_key(st):
+    """Identify a file by inode, size and modification time"""
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
 
 
 def _prune_history(order, history, maximum):
@@ -180,7 +523,13 @@ def _read_hashes(history, history_order, ind, hashind, lines):
 
 
 class PDiffIndex:
-    def __init__(self, patches_dir, max=56, merge_pdiffs=False):
+    def __init__(self, patches_dir, max=56, merge_pdiffs=False, executor=None):
+        """
+        The patches are computed in executor (a concurrent.futures
+        executor; the event loop's default executor if None).  As that is
+        CPU bound, a process pool lets several patches be computed in
+        parallel.
+        """
         self.can_path = None
         self._history = {}
         self._history_order = []
@@ -193,33 +542,20 @@ class PDiffIndex:
         self.wants_merged_pdiffs = merge_pdiffs
         self.has_merged_pdiffs = False
         self.index_path = os.path.join(patches_dir, 'Index')
+        self.executor = executor
         self.read_index_file(self.index_path)
 
-    async def generate_and_add_patch_file(self, original_file, new_file_uncompressed, patch_name):
-
-        with await open_decompressed(original_file) as oldf:
-            oldsizehashes = PDiffHashes.from_file(oldf)
+    async def generate_and_add_patch_file(self, original_file, new_file_uncompressed, patch_name,
+                                          oldsizehashes=None, newsizehashes=None):
 
-            with open(new_file_uncompressed, "r") as newf:
-                newsizehashes = PDiffHashes.from_file(newf)
+        patch_path = os.path.join(self.patches_dir, patch_name)
+        loop = asyncio.get_running_loop()
+        oldsizehashes, newsizehashes, difsizehashes, difgzsizehashes = await loop.run_in_executor(
+            self.executor, _generate_patch_file, original_file, new_file_uncompressed, patch_path,
+            oldsizehashes, newsizehashes)
 
-            if newsizehashes == oldsizehashes:
-                return
-
-            if not os.path.isdir(self.patches_dir):
-                os.mkdir(self.patches_dir)
-
-            oldf.seek(0)
-            patch_path = os.path.join(self.patches_dir, patch_name)
-            with open("{}.gz".format(patch_path), "wb") as fh:
-                await asyncio_check_call(
-                    "diff --ed - {} | gzip --rsyncable  --no-name -c -9".format(new_file_uncompressed),
-                    shell=True,
-                    stdin=oldf,
-                    stdout=fh
-                )
-
-            difsizehashes, difgzsizehashes = await _pdiff_hashes_from_patch(patch_path)
+        if difsizehashes is None:
+            return
 
         self.filesizehashes = newsizehashes
         self._unmerged_history[patch_name] = [oldsizehashes,
@@ -259,7 +595,7 @@ class PDiffIndex:
         target_path = os.path.join(self.patches_dir, target_name)
 
         new_merged_order = []
-        new_merged_history = {}
+        merges = []
         for old_merged_patch_name in self._history_order:
             try:
                 old_orig_name = old_merged_patch_name.split("-F-", 1)[1]
@@ -268,15 +604,19 @@ class PDiffIndex:
             new_merged_patch_name = "T-%s-F-%s" % (target_name, old_orig_name)
             old_merged_patch_path = os.path.join(self.patches_dir, old_merged_patch_name)
             new_merged_patch_path = os.path.join(self.patches_dir, new_merged_patch_name)
-            await _merge_pdiffs(old_merged_patch_path, target_path, new_merged_patch_path)
+            merges.append((old_merged_patch_path, target_path, new_merged_patch_path))
+            new_merged_order.append(new_merged_patch_name)
 
-            hashes_decompressed, hashes_compressed = await _pdiff_hashes_from_patch(new_merged_patch_path)
+        loop = asyncio.get_running_loop()
+        merged_hashes = await loop.run_in_executor(self.executor, _merge_patch_files, merges)
 
+        new_merged_history = {}
+        for old_merged_patch_name, new_merged_patch_name, (hashes_decompressed, hashes_compressed) \
+                in zip(self._history_order, new_merged_order, merged_hashes):
             new_merged_history[new_merged_patch_name] = [self._history[old_merged_patch_name][0],
                                                          hashes_decompressed,
                                                          hashes_compressed,
                                                          ]
-            new_merged_order.append(new_merged_patch_name)
 
         self._history_order = new_merged_order
         self._history = new_merged_history
@@ -330,6 +670,7 @@ class PDiffIndex:
         # sense that we need to update N-1 patches to preserve the
         # entire history).
         #
+        merges = []
         for patch_name in reversed(self._unmerged_history_order):
             merged_patch = "T-%s-F-%s" % (target_name, patch_name)
             merged_patch_path = os.path.join(self.patches_dir, merged_patch)
@@ -337,14 +678,7 @@ class PDiffIndex:
             if new_patches:
                 oldest_patch = os.path.join(self.patches_dir, patch_name)
                 previous_merged_patch = os.path.join(self.patches_dir, new_patches[-1])
-                await _merge_pdiffs(oldest_patch, previous_merged_patch, merged_patch_path)
-
-                hashes_decompressed, hashes_compressed = await _pdiff_hashes_from_patch(merged_patch_path)
-
-                self._history[merged_patch] = [self._unmerged_history[patch_name][0],
-                                               hashes_decompressed,
-                                               hashes_compressed,
-                                               ]
+                merges.append((oldest_patch, previous_merged_patch, merged_patch_path))
             else:
                 # Special_case; the latest patch is its own "merged" variant.
                 os.link(os.path.join(self.patches_dir, patch_name + ".gz"), merged_patch_path + ".gz")
@@ -352,6 +686,16 @@ class PDiffIndex:
 
             new_patches.append(merged_patch)
 
+        loop = asyncio.get_running_loop()
+        merged_hashes = await loop.run_in_executor(self.executor, _merge_patch_files, merges)
+
+        for patch_name, merged_patch, (hashes_decompressed, hashes_compressed) \
+                in zip(reversed(self._unmerged_history_order[:-1]), new_patches[1:], merged_hashes):
+            self._history[merged_patch] = [self._unmerged_history[patch_name][0],
+                                           hashes_decompressed,
+                                           hashes_compressed,
+                                           ]
+
         self._history_order = list(reversed(new_patches))
         self._old_merged_patches_prefix.append(target_name)
         self.has_merged_pdiffs = True
@@ -425,6 +769,21 @@ class PDiffIndex:
             # But it is self-healing providing that we generate valid files from here on.
             pass
 
+    def current_hashes(self, recorded_stat, stored_stat):
+        """Return size and hashes of the stored copy of the file
+
+        recorded_stat is the stat_key() recorded for the stored copy when
+        the Index was last updated, stored_stat the os.stat() result of
+        the stored copy now.  Returns None unless it is still the copy
+        filesizehashes were recorded for.
+        """
+        if recorded_stat is None or self.filesizehashes is None \
+                or self.filesizehashes.sha1 is None or self.filesizehashes.sha256 is None:
+            return None
+        if recorded_stat != stat_key(stored_stat):
+            return None
+        return self.filesizehashes
+
     def prune_patch_history(self):
         # Truncate our history if necessary
         hs = self._history
@@ -42,6 +42,9 @@
 import apt_pkg
 import fcntl
 import functools
+import json
+import os
+import sys
 import sqlalchemy.sql as sql
 import email.utils
 from re import sub
@@ -49,6 +52,7 @@ from collections import defaultdict
 from .regexes import re_build_dep_arch
 from typing import Optional, Union
 
+from daklib.config import Config
 from daklib.dbconn import *
 from daklib import utils
 from daklib.regexes import re_bin_only_nmu
@@ -57,6 +61,160 @@ import debianbts as bts
 ################################################################################
 
 
+def _parse_relations(package: str, relations: str, parse) -> tuple:
+    try:
+        return tuple(frozenset(sys.intern(d[0]) for d in dep) for dep in parse(relations))
+    except ValueError as e:
+        print("Error for package %s: %s" % (package, e))
+        return ()
+
+
+class DependencyGraph:
+    """Parsed Depends/Provides and Build-Depends of the packages in a suite
+
+    The relations are kept by binary and source id, so the graph can be
+    stored on disk and brought up to date by only parsing the packages
+    that entered the suite since it was stored.  Package names are
+    interned and shared; on disk they are stored once in a name table
+    that the relations refer to by index.
+    """
+
+    _format = 2
+
+    def __init__(self):
+        #: binary id -> (package, architecture id, depends, provides)
+        self.binaries = {}
+        #: source id -> (source, build-depends)
+        self.sources = {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "DependencyGraph":
+        """Load the graph stored at path; returns an empty graph if there is none"""
+        graph = cls()
+        if path is None:
+            return graph
+        try:
+            with open(path, 'r') as fh:
+                data = json.load(fh)
+            if data.get('format') != cls._format:
+                return graph
+            names = [sys.intern(name) for name in data['names']]
+
+            def relations(clauses):
+                return tuple(frozenset(names[i] for i in clause) for clause in clauses)
+
+            binaries = {bin_id: (names[package], arch_id, relations(depends), tuple(names[i] for i in provides))
+                        for bin_id, package, arch_id, depends, provides in data['binaries']}
+            sources = {src_id: (names[source], relations(build_depends))
+                       for src_id, source, build_depends in data['sources']}
+        except (OSError, ValueError, TypeError, KeyError, IndexError, AttributeError):
+            return graph
+        graph.binaries = binaries
+        graph.sources = sources
+        return graph
+
+    def save(self, path: str) -> None:
+        """Store the graph at path; as it is only a cache, failing to do so just gives a warning"""
+        index = {}
+
+        def name(n):
+            return index.setdefault(n, len(index))
+
+        def relations(clauses):
+            return [sorted(name(n) for n in clause) for clause in clauses]
+
+        data = {
+            'format': self._format,
+            'binaries': [[bin_id, name(package), arch_id, relations(depends), [name(n) for n in provides]]
+                         for bin_id, (package, arch_id, depends, provides) in self.binaries.items()],
+            'sources': [[src_id, name(source), relations(build_depends)]
+                        for src_id, (source, build_depends) in self.sources.items()],
+        }
+        data['names'] = list(index)
+        tmp_path = "%s.new.%d" % (path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as fh:
+                json.dump(data, fh, separators=(',', ':'))
+            os.rename(tmp_path, path)
+        except OSError as e:
+            utils.warn("Cannot store the dependency graph in {0}: {1}".format(path, e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def update(self, session, suite_id: int) -> None:
+        """Add the packages that entered the suite and drop those that left it"""
+        current = {bin_id for bin_id, in session.execute(
+            'SELECT bin FROM bin_associations WHERE suite = :suite_id', {'suite_id': suite_id})}
+        self._drop(self.binaries, current)
+        added = list(current - self.binaries.keys())
+        if added:
+            params = {
+                'ids':          added,
+                'metakey_d_id': get_or_set_metadatakey("Depends", session).key_id,
+                'metakey_p_id': get_or_set_metadatakey("Provides", session).key_id,
+            }
+            query = session.execute('''
+                SELECT b.id, b.package, b.architecture,
+                    (SELECT bmd.value FROM binaries_metadata bmd WHERE bmd.bin_id = b.id AND bmd.key_id = :metakey_d_id) AS depends,
+                    (SELECT bmp.value FROM binaries_metadata bmp WHERE bmp.bin_id = b.id AND bmp.key_id = :metakey_p_id) AS provides
+                    FROM binaries b
+                    WHERE b.id = ANY(:ids)''', params)
+            for bin_id, package, arch_id, depends, provides in query:
+                package = sys.intern(package)
+                parsed_dep = ()
+                if depends is not None:
+                    parsed_dep = _parse_relations(package, depends, apt_pkg.parse_depends)
+                virtual_pkgs = ()
+                if provides is not None:
+                    virtual_pkgs = tuple(sys.intern(v.strip()) for v in provides.split(","))
+                self.binaries[bin_id] = (package, arch_id, parsed_dep, virtual_pkgs)
+            self.changed = True
+
+        current = {src_id for src_id, in session.execute(
+            'SELECT src FROM newest_src_association WHERE suite = :suite_id', {'suite_id': suite_id})}
+        self._drop(self.sources, current)
+        added = list(current - self.sources.keys())
+        if added:
+            params = {
+                'ids':         added,
+                'metakey_ids': (get_or_set_metadatakey("Build-Depends", session).key_id,
+                                get_or_set_metadatakey("Build-Depends-Indep", session).key_id),
+            }
+            query = session.execute('''
+                SELECT s.id, s.source, string_agg(sm.value, ', ') as build_dep
+                   FROM source s
+                   LEFT JOIN source_metadata sm ON s.id = sm.src_id AND sm.key_id in :metakey_ids
+                   WHERE s.id = ANY(:ids)
+                   GROUP BY s.id, s.source''', params)
+            for src_id, source, build_dep in query:
+                parsed_dep = ()
+                if build_dep is not None:
+                    # Remove [arch] information since we want to see breakage on all arches
+                    build_dep = re_build_dep_arch.sub("", build_dep)
+                    parsed_dep = _parse_relations(source, build_dep, apt_pkg.parse_src_depends)
+                self.sources[src_id] = (sys.intern(source), parsed_dep)
+            self.changed = True
+
+    def _drop(self, packages: dict, current: set) -> None:
+        removed = [x for x in packages if x not in current]
+        for x in removed:
+            del packages[x]
+        if removed:
+            self.changed = True
+
+
+def dependency_graph_path(suite_name: str) -> Optional[str]:
+    """Where the dependency graph of a suite is stored (None if not configured)"""
+    cache_dir = Config().get('Dir::Cache')
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, 'dependency-graph', suite_name)
+
+
 class ReverseDependencyChecker:
     """A bulk tester for reverse dependency checks
 
@@ -70,7 +228,9 @@ class ReverseDependencyChecker:
     def __init__(self, session, suite: str):
         """Creates a new ReverseDependencyChecker instance
 
-        This will spend a significant amount of time caching data.
+        This will spend a significant amount of time caching data, unless
+        Dir::Cache is set: the parsed relations are then stored there and
+        only the changes to the suite since the last run are parsed.
 
         :param session: The database session in use
         :param suite: The name of the suite that is used as basis for removal tests.
@@ -80,31 +240,36 @@ class ReverseDependencyChecker:
         suite_archs2id = dict((x.arch_string, x.arch_id) for x in get_suite_architectures(suite))
         package_dependencies, arch_providers_of, arch_provided_by = self._load_package_information(session,
                                                                                                    dbsuite.suite_id,
-                                                                                                   suite_archs2id)
+                                                                                                   suite_archs2id,
+                                                                                                   dependency_graph_path(dbsuite.suite_name))
         self._package_dependencies = package_dependencies
         self._arch_providers_of = arch_providers_of
         self._arch_provided_by = arch_provided_by
         self._archs_in_suite = set(suite_archs2id)
 
     @staticmethod
-    def _load_package_information(session, suite_id, suite_archs2id):
+    def _load_package_information(session, suite_id, suite_archs2id, graph_path=None):
+        graph = DependencyGraph.load(graph_path)
+        graph.update(session, suite_id)
+        if graph_path is not None and graph.changed:
+            graph.save(graph_path)
+        return ReverseDependencyChecker._package_information(graph, suite_archs2id)
+
+    @staticmethod
+    def _package_information(graph: DependencyGraph, suite_archs2id: dict):
         package_dependencies = defaultdict(lambda: defaultdict(set))
         arch_providers_of = defaultdict(lambda: defaultdict(set))
         arch_provided_by = defaultdict(lambda: defaultdict(set))
         source_deps = defaultdict(set)
-        metakey_d = get_or_set_metadatakey("Depends", session)
-        metakey_p = get_or_set_metadatakey("Provides", session)
-        params = {
-            'suite_id':     suite_id,
-            'arch_all_id':  suite_archs2id['all'],
-            'metakey_d_id': metakey_d.key_id,
-            'metakey_p_id': metakey_p.key_id,
-        }
         all_arches = set(suite_archs2id)
         all_arches.discard('source')
 
         package_dependencies['source'] = source_deps
 
+        binaries_by_arch = defaultdict(list)
+        for binary in graph.binaries.values():
+            binaries_by_arch[binary[1]].append(binary)
+
         for architecture in all_arches:
             deps = defaultdict(set)
             providers_of = defaultdict(set)
@@ -113,70 +278,27 @@ class ReverseDependencyChecker:
             arch_provided_by[architecture] = provided_by
             package_dependencies[architecture] = deps
 
-            params['arch_id'] = suite_archs2id[architecture]
-
-            statement = sql.text('''
-                    SELECT b.package,
-                        (SELECT bmd.value FROM binaries_metadata bmd WHERE bmd.bin_id = b.id AND bmd.key_id = :metakey_d_id) AS depends,
-                        (SELECT bmp.value FROM binaries_metadata bmp WHERE bmp.bin_id = b.id AND bmp.key_id = :metakey_p_id) AS provides
-                        FROM binaries b
-                        JOIN bin_associations ba ON b.id = ba.bin AND ba.suite = :suite_id
-                        WHERE b.architecture = :arch_id OR b.architecture = :arch_all_id''')
-            query = session.query(sql.column('package'), sql.column('depends'), sql.column('provides')). \
-                from_statement(statement).params(params)
-            for package, depends, provides in query:
-
-                if depends is not None:
-                    try:
-                        parsed_dep = []
-                        for dep in apt_pkg.parse_depends(depends):
-                            parsed_dep.append(frozenset(d[0] for d in dep))
+            arch_ids = {suite_archs2id[architecture], suite_archs2id['all']}
+            for arch_id in arch_ids:
+                for package, _, parsed_dep, virtual_pkgs in binaries_by_arch[arch_id]:
+                    if parsed_dep:
                         deps[package].update(parsed_dep)
-                    except ValueError as e:
-                        print("Error for package %s: %s" % (package, e))
-                # Maintain a counter for each virtual package.  If a
-                # Provides: exists, set the counter to 0 and count all
-                # provides by a package not in the list for removal.
-                # If the counter stays 0 at the end, we know that only
-                # the to-be-removed packages provided this virtual
-                # package.
-                if provides is not None:
-                    for virtual_pkg in provides.split(","):
-                        virtual_pkg = virtual_pkg.strip()
+                    # Maintain a counter for each virtual package.  If a
+                    # Provides: exists, set the counter to 0 and count all
+                    # provides by a package not in the list for removal.
+                    # If the counter stays 0 at the end, we know that only
+                    # the to-be-removed packages provided this virtual
+                    # package.
+                    for virtual_pkg in virtual_pkgs:
                         if virtual_pkg == package:
                             continue
                         provided_by[virtual_pkg].add(package)
                         providers_of[package].add(virtual_pkg)
 
         # Check source dependencies (Build-Depends and Build-Depends-Indep)
-        metakey_bd = get_or_set_metadatakey("Build-Depends", session)
-        metakey_bdi = get_or_set_metadatakey("Build-Depends-Indep", session)
-        params = {
-            'suite_id':    suite_id,
-            'metakey_ids': (metakey_bd.key_id, metakey_bdi.key_id),
-        }
-        statement = sql.text('''
-            SELECT s.source, string_agg(sm.value, ', ') as build_dep
-               FROM source s
-               JOIN source_metadata sm ON s.id = sm.src_id
-               WHERE s.id in
-                   (SELECT src FROM newest_src_association
-                       WHERE suite = :suite_id)
-                   AND sm.key_id in :metakey_ids
-               GROUP BY s.id, s.source''')
-        query = session.query(sql.column('source'), sql.column('build_dep')) \
-            .from_statement(statement).params(params)
-        for source, build_dep in query:
-            if build_dep is not None:
-                # Remove [arch] information since we want to see breakage on all arches
-                build_dep = re_build_dep_arch.sub("", build_dep)
-                try:
-                    parsed_dep = []
-                    for dep in apt_pkg.parse_src_depends(build_dep):
-                        parsed_dep.append(frozenset(d[0] for d in dep))
-                    source_deps[source].update(parsed_dep)
-                except ValueError as e:
-                    print("Error for package %s: %s" % (source, e))
+        for source, parsed_dep in graph.sources.values():
+            if parsed_dep:
+                source_deps[source].update(parsed_dep)
 
         return package_dependencies, arch_providers_of, arch_provided_by
 
@@ -293,6 +415,185 @@ class ReverseDependencyChecker:
         return dep_problems
 
 
+class _ArchRemovalState:
+    """The clauses of one architecture and how many of their packages are removed"""
+
+    def __init__(self, deps, src_deps, providers_of, provided_by, source_removed):
+        self.providers_of = providers_of
+        self.provided_by = provided_by
+        #: group name by removed package
+        self.removers = defaultdict(set)
+        self.removed_providers = defaultdict(set)
+        #: (dependant, clause) for every clause
+        self.clauses = []
+        self.missing = []
+        self.by_member = defaultdict(list)
+        self.by_dependant = defaultdict(list)
+        self.by_source = defaultdict(list)
+        self.broken = set()
+        for dependants, index in ((deps, self.by_dependant), (src_deps, self.by_source)):
+            for dependant, clauses in dependants.items():
+                for clause in clauses:
+                    clause_id = len(self.clauses)
+                    self.clauses.append((dependant, clause))
+                    self.missing.append(0)
+                    index[dependant].append(clause_id)
+                    for member in clause:
+                        self.by_member[member].append(clause_id)
+        self.source_clauses = frozenset(i for ids in self.by_source.values() for i in ids)
+        self._source_removed = source_removed
+
+    def virtual_removed(self, name: str) -> bool:
+        providers = self.provided_by.get(name)
+        return bool(providers) and len(self.removed_providers[name]) == len(providers)
+
+    def is_removed(self, name: str) -> bool:
+        return bool(self.removers.get(name)) or self.virtual_removed(name)
+
+    def blame(self, name: str) -> str:
+        if self.virtual_removed(name):
+            # Pick one to take the blame for the removal
+            return sorted(self.removed_providers[name])[0]
+        return name
+
+    def _update_broken(self, clause_id: int) -> None:
+        dependant, clause = self.clauses[clause_id]
+        if clause_id in self.source_clauses:
+            excluded = self._source_removed(dependant)
+        else:
+            excluded = self.is_removed(dependant)
+        if self.missing[clause_id] == len(clause) and not excluded:
+            self.broken.add(clause_id)
+        else:
+            self.broken.discard(clause_id)
+
+    def _flip(self, name: str, removed: bool) -> None:
+        delta = 1 if removed else -1
+        for clause_id in self.by_member.get(name, ()):
+            self.missing[clause_id] += delta
+            self._update_broken(clause_id)
+        for clause_id in self.by_dependant.get(name, ()):
+            self._update_broken(clause_id)
+
+    def set_removed(self, package: str, group: str, removed: bool) -> None:
+        affected = {package}
+        affected.update(self.providers_of.get(package, ()))
+        before = {name: self.is_removed(name) for name in affected}
+        if removed:
+            self.removers[package].add(group)
+        else:
+            self.removers[package].discard(group)
+        for virtual_pkg in self.providers_of.get(package, ()):
+            if self.removers[package]:
+                self.removed_providers[virtual_pkg].add(package)
+            else:
+                self.removed_providers[virtual_pkg].discard(package)
+        for name in affected:
+            after = self.is_removed(name)
+            if after != before[name]:
+                self._flip(name, after)
+
+    def source_changed(self, source: str) -> None:
+        for clause_id in self.by_source.get(source, ()):
+            self._update_broken(clause_id)
+
+
+class RemovalSimulator:
+    """Simulate the removal of groups of packages from a suite
+
+    Unlike ReverseDependencyChecker.check_reverse_depends, which checks
+    all packages of the suite for every request, the simulator keeps
+    track of which dependency clauses are broken by the groups removed so
+    far.  Removing or restoring a group only revisits the clauses
+    mentioning its packages, so a large set of candidate groups can be
+    checked and shrunk until nothing breaks without checking the suite
+    again and again.  breakage() answers the same as check_reverse_depends
+    for the combined removal requests of all removed groups.
+    """
+
+    def __init__(self, rdc: ReverseDependencyChecker):
+        self._rdc = rdc
+        self._archs = {}
+        self._groups = {}
+        self._source_removers = defaultdict(set)
+
+    def _arch_state(self, arch: str) -> _ArchRemovalState:
+        state = self._archs.get(arch)
+        if state is None:
+            rdc = self._rdc
+            state = _ArchRemovalState(rdc._package_dependencies[arch], rdc._package_dependencies['source'],
+                                      rdc._arch_providers_of[arch], rdc._arch_provided_by[arch],
+                                      lambda source: bool(self._source_removers.get(source)))
+            self._archs[arch] = state
+        return state
+
+    def _removals(self, removal_request):
+        """Yield the (package, architecture) pairs removed by a removal request"""
+        archs_in_suite = self._rdc._archs_in_suite
+        if isinstance(removal_request, dict):
+            removal_request = removal_request.items()
+        for pkg, arch_list in removal_request:
+            if not arch_list:
+                arch_list = archs_in_suite
+            for arch in arch_list:
+                if arch == 'all':
+                    for suite_arch in archs_in_suite:
+                        if suite_arch not in ('all', 'source'):
+                            yield pkg, suite_arch
+                else:
+                    yield pkg, arch
+
+    def _set_removed(self, name: str, removed: bool) -> None:
+        for pkg, arch in self._removals(self._groups[name]):
+            if arch == 'source':
+                if removed:
+                    self._source_removers[pkg].add(name)
+                else:
+                    self._source_removers[pkg].discard(name)
+                for state in self._archs.values():
+                    state.source_changed(pkg)
+            else:
+                self._arch_state(arch).set_removed(pkg, name, removed)
+
+    def remove_group(self, name: str, removal_request) -> None:
+        """Remove a group of packages (see check_reverse_depends for removal_request)"""
+        self._groups[name] = removal_request
+        self._set_removed(name, True)
+
+    def restore_group(self, name: str) -> None:
+        """Undo the removal of a group"""
+        self._set_removed(name, False)
+        del self._groups[name]
+
+    def breakage(self) -> dict:
+        """The breakage caused by the removed groups
+
+        :return: A mapping of "removed package" (as a "(pkg, arch)"-tuple) to a set of broken
+          packages, like ReverseDependencyChecker.check_reverse_depends.
+        """
+        dep_problems = defaultdict(set)
+        for arch, state in self._archs.items():
+            for clause_id in state.broken:
+                dependant, clause = state.clauses[clause_id]
+                broken = (dependant, 'source') if clause_id in state.source_clauses else (dependant, arch)
+                for dep_package in clause:
+                    dep_problems[(state.blame(dep_package), arch)].add(broken)
+        return dep_problems
+
+    def group_costs(self) -> dict:
+        """The number of packages broken by each removed group
+
+        A broken package is counted for every group removing a package
+        blamed for breaking it.
+        """
+        costs = dict.fromkeys(self._groups, 0)
+        for (package, arch), broken in self.breakage().items():
+            state = self._archs[arch]
+            for group in state.removers.get(package, ()):
+                costs[group] += len(broken)
+        return costs
+
+
 def remove(session, reason: str, suites: list, removals: list,
            whoami: Optional[str] = None, partial: bool = False,
            components: Optional[list] = None, done_bugs: Optional[list] = None,
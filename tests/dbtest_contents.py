@@ -4,7 +4,7 @@ from db_test import DBDakTestCase, fixture
 
 from daklib.dbconn import *
 from daklib.contents import BinaryContentsWriter, BinaryContentsScanner, \
-    UnpackedSource, SourceContentsScanner, SourceContentsWriter
+    UnpackedSource, SourceContentsScanner, SourceContentsWriter, format_copy_rows
 
 from os.path import normpath
 from sqlalchemy.exc import IntegrityError
@@ -167,6 +167,37 @@ class ContentsTestCase(DBDakTestCase):
             BinContents(file='\xc3\xb6'))
         self.session.flush()
 
+    def test_binarycontentswriter_removed_binary(self):
+        '''
+        Test that the contents of a binary deleted from the database between
+        two runs of the BinaryContentsWriter are dropped.
+        '''
+        self.setup_binaries()
+        self.setup_overrides()
+        binary = self.binary['hello_2.2-1_i386']
+        binary.contents.append(BinContents(file='/usr/bin/hello'))
+        self.session.flush()
+        cw = BinaryContentsWriter(self.suite['squeeze'], self.arch['i386'],
+                                  self.otype['deb'], self.comp['main'])
+        self.assertEqual(
+            ['/usr/bin/hello                                          python/hello\n'],
+            cw.get_list())
+        self.session.execute('DELETE FROM bin_associations WHERE bin = :id', {'id': binary.binary_id})
+        self.session.execute('DELETE FROM binaries WHERE id = :id', {'id': binary.binary_id})
+        self.session.commit()
+        self.session.expunge(binary)
+        self.assertEqual([], cw.get_list())
+
+    def test_format_copy_rows(self):
+        '''
+        Test the COPY formatting of scanned rows.
+        '''
+        self.assertEqual('usr/bin/a\\tb\t1\nusr/\xf6\t2\n',
+                         format_copy_rows([('usr/bin/a\tb', 1), ('usr/\xf6', 2)]))
+        # file names that are not UTF-8 are rejected before the COPY
+        self.assertRaises(UnicodeEncodeError, format_copy_rows,
+                          [(b'usr/\xff'.decode('utf-8', 'surrogateescape'), 1)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -41,6 +41,14 @@ class CruftTestCase(DBDakTestCase):
         list = newer_version('squeeze', 'sid', self.session)
         self.assertEqual([('sl', '3.03-16', '3.03-17')], list)
 
+    def test_suite_snapshot(self):
+        'tests class SuiteSnapshot'
+
+        suite = get_suite('sid', self.session)
+        snapshot = SuiteSnapshot(suite.suite_id, self.session)
+        self.assertIn('hello', dict(snapshot.sources))
+        self.assertEqual([row[0] for row in snapshot.sources], sorted(row[0] for row in snapshot.sources))
+
     def test_multiple_source(self):
         'tests functions related to report_multiple_source()'
 
@@ -79,6 +87,42 @@ class CruftTestCase(DBDakTestCase):
         self.assertEqual(True, bin.has_multiple_sources())
         self.assertEqual('hello built by: hello(2.2-1, 2.2-2), sl(3.03-16)',
                          str(bin))
+        # the report builds the same from the suite's relations
+        self.session.flush()
+        relations = SuiteRelations(suite.suite_id, self.session)
+        self.assertEqual([str(bin)], [str(DejavuBinary(suite, package, [NamedSource(suite, *source) for source in sources]))
+                                      for package, sources in relations.multiple_sources()])
+
+    def test_suite_relations(self):
+        'tests class SuiteRelations'
+
+        suite = get_suite('sid', self.session)
+        relations = SuiteRelations(suite.suite_id, self.session)
+        self.assertTrue(relations.has_package('hello'))
+        self.assertTrue(relations.has_package('gnome-hello'))
+        self.assertFalse(relations.has_package('sl'))
+        self.assertEqual([], relations.versions('sl'))
+        self.assertEqual([], list(relations.multiple_sources()))
+        # add a binary built by another source to suite sid
+        self.file[
+            'hello_2.2-3'] = PoolFile(filename='main/s/sl/hello_2.2-3_i386.deb',
+                                      filesize=0, md5sum='')
+        self.file['hello_2.2-3'].sha1sum = 'sha1sum'
+        self.file['hello_2.2-3'].sha256sum = 'sha256sum'
+        self.binary['hello_2.2-3_i386'] = DBBinary(package='hello',
+                                                   source=self.source[
+                                                       'sl_3.03-16'], version='2.2-3',
+                                                   maintainer=self.maintainer[
+                                                       'maintainer'],
+                                                   architecture=self.arch[
+                                                       'i386'],
+                                                   poolfile=self.file['hello_2.2-3'])
+        self.binary['hello_2.2-3_i386'].suites.append(self.suite['sid'])
+        self.session.flush()
+        relations = SuiteRelations(suite.suite_id, self.session)
+        self.assertIn(('i386', '2.2-3'), relations.versions('hello'))
+        self.assertEqual([('hello', [('hello', ['2.2-1', '2.2-2']), ('sl', ['3.03-16'])])],
+                         list(relations.multiple_sources()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2026, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from db_test import DBDakTestCase
+
+from daklib.dbconn import *
+from dak import dominate
+
+from sqlalchemy.sql import text
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+
+class DominateTestCase(DBDakTestCase):
+
+    """
+    This class checks the incremental mode of dominate against the full
+    query.
+    """
+
+    def setUp(self):
+        super(DominateTestCase, self).setUp()
+        self.setup_binaries()
+        self.session.flush()
+        self.suites = [self.suite['sid']]
+
+    def full(self):
+        return set(tuple(a) for a in dominate.retrieve_associations(self.suites, self.session))
+
+    def incremental(self):
+        changes, queue_ids = dominate.queued_changes(self.suites, self.session)
+        return set(tuple(a) for a in dominate.retrieve_associations_incremental(self.suites, changes, self.session))
+
+    def run_dominate(self):
+        changes, queue_ids = dominate.queued_changes(self.suites, self.session)
+        assocs = dominate.retrieve_associations_incremental(self.suites, changes, self.session)
+        with mock.patch.object(dominate, 'Logger'):
+            dominate.delete_associations(assocs, self.session)
+        dominate.update_dominate_state(self.suites, queue_ids, self.session)
+
+    def queued(self, suite_name='sid'):
+        return [tuple(row) for row in self.session.execute(text('''
+            SELECT source, package FROM dominate_queue WHERE suite_id = :suite_id
+             ORDER BY source, package NULLS FIRST
+        '''), {'suite_id': self.suite[suite_name].suite_id})]
+
+    def add_hello(self, version):
+        'adds source and i386 binary of hello to sid'
+        dsc = self.file['hello_%s.dsc' % version]
+        deb = PoolFile(filename='main/h/hello/hello_%s_i386.deb' % version, filesize=0, md5sum='')
+        deb.sha1sum = 'sha1sum'
+        deb.sha256sum = 'sha256sum'
+        source = DBSource(source='hello', version=version,
+                          maintainer=self.maintainer['maintainer'],
+                          changedby=self.maintainer['uploader'],
+                          poolfile=dsc, install_date=self.now())
+        source.suites.append(self.suite['sid'])
+        binary = DBBinary(package='hello', source=source, version=version,
+                          maintainer=self.maintainer['maintainer'],
+                          architecture=self.arch['i386'], poolfile=deb)
+        binary.suites.append(self.suite['sid'])
+        self.session.add_all([deb, source, binary])
+        self.session.flush()
+        return binary
+
+    def test_incremental(self):
+        'tests retrieve_associations_incremental() and the queue trigger'
+
+        # without a recorded state the suite is looked at in full
+        full = self.full()
+        self.assertEqual(1, len(full))
+        self.assertEqual(full, self.incremental())
+        self.run_dominate()
+        self.assertEqual(set(), self.full())
+        # dominate's own removals are not queued
+        self.assertEqual([], self.queued())
+        self.assertEqual(set(), self.incremental())
+
+        # a new version of hello dominates its older sources and binary
+        binary = self.add_hello('2.2-3')
+        self.assertEqual([('hello', None), ('hello', 'hello')], self.queued())
+        full = self.full()
+        self.assertEqual(3, len(full))
+        self.assertEqual(full, self.incremental())
+        self.run_dominate()
+        self.assertEqual(set(), self.full())
+        self.assertEqual([], self.queued())
+
+        # removals by anything else are queued
+        self.session.execute(text('''
+            DELETE FROM bin_associations WHERE bin = :bin_id AND suite = :suite_id
+        '''), {'bin_id': binary.binary_id, 'suite_id': self.suite['sid'].suite_id})
+        self.assertEqual([('hello', 'hello')], self.queued())
+        self.assertEqual(self.full(), self.incremental())
+
+    def test_verify(self):
+        'tests verify_associations()'
+
+        changes, queue_ids = dominate.queued_changes(self.suites, self.session)
+        dominate.update_dominate_state(self.suites, queue_ids, self.session)
+        # the incremental run misses what was already there
+        self.assertEqual(set(), self.incremental())
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            with self.assertRaises(SystemExit):
+                dominate.verify_associations(self.incremental(), self.suites, self.session)
+        self.assertIn('Missed by incremental domination', output.getvalue())
+
+        dominate.verify_associations(self.full(), self.suites, self.session)
+
+    def test_prune(self):
+        'tests prune_dominate_state()'
+
+        dominate.update_dominate_state([self.suite['sid'], self.suite['squeeze']], [], self.session)
+        self.source['hello_2.2-2'].suites.append(self.suite['squeeze'])
+        self.session.flush()
+        self.assertEqual([('hello', None)], self.queued('squeeze'))
+
+        dominate.prune_dominate_state(self.suites, self.session)
+        self.assertEqual([self.suite['sid'].suite_id],
+                         [suite_id for suite_id, in self.session.execute(text('SELECT suite_id FROM dominate_state'))])
+        self.assertEqual([], self.queued('squeeze'))
+
+
+if __name__ == '__main__':
+    unittest.main()
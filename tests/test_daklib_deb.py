@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from base_test import DakTestCase, fixture
+from daklib.deb import DebError, format_members, iter_ar_members, iter_data_members, iter_tar, open_tar_member, scan_deb
+
+from unittest import main
+
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+CONTROL = """Package: example
+Version: 1.0
+Architecture: all
+Maintainer: Example Maintainer <example@example.org>
+Description: example package
+"""
+
+
+class DebTestCase(DakTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        root = os.path.join(self.tmpdir, 'root')
+        os.makedirs(os.path.join(root, 'DEBIAN'))
+        os.makedirs(os.path.join(root, 'usr', 'share', 'doc', 'example'))
+        with open(os.path.join(root, 'DEBIAN', 'control'), 'w') as fh:
+            fh.write(CONTROL)
+        with open(os.path.join(root, 'usr', 'share', 'doc', 'example', 'copyright'), 'w') as fh:
+            fh.write('Copyright\n')
+        os.symlink('copyright', os.path.join(root, 'usr', 'share', 'doc', 'example', 'link'))
+        self.root = root
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, compression):
+        path = os.path.join(self.tmpdir, 'example_{0}.deb'.format(compression))
+        subprocess.check_call(['dpkg-deb', '--root-owner-group', '-Z' + compression, '--build', self.root, path],
+                              stdout=subprocess.DEVNULL)
+        return path
+
+    def test_ar_members(self):
+        path = fixture('ftp/pool/main/h/hello/hello_2.2-1_i386.deb')
+        with open(path, 'rb') as fh:
+            names = [name for name, member in iter_ar_members(fh)]
+        self.assertEqual(names, ['debian-binary', 'control.tar.gz', 'data.tar.gz'])
+
+        with open(path, 'rb') as fh:
+            for name, member in iter_ar_members(fh):
+                if name == 'debian-binary':
+                    self.assertEqual(member.read(), b'2.0\n')
+
+    def test_ar_padding(self):
+        def header(name, size):
+            return '{0:<16}{1:<12}{2:<6}{3:<6}{4:<8}{5:<10}`\n'.format(name, 0, 0, 0, 100644, size).encode('ascii')
+        data = b'!<arch>\n' + header('odd/', 3) + b'abc\n' + header('even', 2) + b'de'
+        members = [(name, member.read()) for name, member in iter_ar_members(io.BytesIO(data))]
+        self.assertEqual(members, [('odd', b'abc'), ('even', b'de')])
+
+        # members that are not read are skipped
+        names = [name for name, member in iter_ar_members(io.BytesIO(data))]
+        self.assertEqual(names, ['odd', 'even'])
+
+        with self.assertRaises(DebError):
+            list(iter_ar_members(io.BytesIO(b'!<arch>\n' + header('short', 10) + b'abc')))
+
+    def test_not_ar(self):
+        with self.assertRaises(DebError):
+            list(iter_ar_members(io.BytesIO(b'something else')))
+
+    def test_data_members(self):
+        for compression in ('none', 'gzip', 'xz', 'zstd'):
+            path = self.build(compression)
+            files = sorted(m.name for m in iter_data_members(path) if not m.isdir())
+            self.assertEqual(files, ['./usr/share/doc/example/copyright',
+                                     './usr/share/doc/example/link'], compression)
+
+    def test_corrupt_zstd(self):
+        tarball = os.path.join(self.tmpdir, 'root.tar')
+        subprocess.check_call(['tar', '-C', self.root, '-cf', tarball, 'usr'])
+        with open(tarball, 'rb') as fh:
+            data = fh.read()
+        # a complete frame holding the first member, then a truncated one
+        first = subprocess.check_output(['zstd', '--stdout', '-q'], input=data[:1024])
+        rest = subprocess.check_output(['zstd', '--stdout', '-q'], input=data[1024:])
+        with self.assertRaises(DebError):
+            with open_tar_member('data.tar.zst', io.BytesIO(first + rest[:len(rest) // 2])) as tar:
+                list(iter_tar(tar))
+
+    def test_scan_deb(self):
+        for compression in ('gzip', 'xz', 'zstd'):
+            path = self.build(compression)
+            contents = scan_deb(path, select=lambda name: name.endswith('/copyright'))
+            self.assertEqual(contents.control, CONTROL.encode(), compression)
+            self.assertEqual(contents.files, {'./usr/share/doc/example/copyright': b'Copyright\n'}, compression)
+            listing = subprocess.check_output(['dpkg', '-c', path], text=True)
+            self.assertEqual(format_members(contents.members), listing, compression)
+
+
+if __name__ == '__main__':
+    main()
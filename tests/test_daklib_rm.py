@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2026, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import random
+import shutil
+import tempfile
+from unittest import main
+
+from base_test import DakTestCase
+
+from daklib.rm import DependencyGraph, RemovalSimulator, ReverseDependencyChecker
+
+ARCHS = {'source': 1, 'all': 2, 'amd64': 3, 'i386': 4}
+
+
+def deps(*clauses):
+    return tuple(frozenset(clause.split('|')) for clause in clauses)
+
+
+def make_graph():
+    graph = DependencyGraph()
+    binaries = [
+        # package, architectures, depends, provides
+        ('libfoo1', ('amd64', 'i386'), (), ('libfoo-abi',)),
+        ('libfoo1-compat', ('amd64',), (), ('libfoo-abi',)),
+        ('postfix', ('amd64', 'i386'), deps('libfoo1'), ('mta',)),
+        ('exim4', ('all',), (), ('mta',)),
+        ('app', ('amd64', 'i386'), deps('libfoo-abi', 'mta|sendmail'), ()),
+        ('app-data', ('all',), (), ()),
+        ('app-tools', ('all',), deps('app-data', 'app'), ()),
+        ('frontend', ('i386',), deps('app-tools|app'), ()),
+        ('debhelper', ('all',), (), ('dh-sequence',)),
+        ('orphan', ('amd64',), deps('missing'), ()),
+    ]
+    for package, archs, depends, provides in binaries:
+        for arch in archs:
+            graph.binaries[len(graph.binaries)] = (package, ARCHS[arch], depends, provides)
+    sources = [
+        ('app', deps('debhelper|dh-sequence', 'libfoo1')),
+        ('postfix', deps('debhelper')),
+        ('frontend', deps('app-tools')),
+        ('exim4', ()),
+    ]
+    for source, build_depends in sources:
+        graph.sources[len(graph.sources)] = (source, build_depends)
+    return graph
+
+
+def make_checker(graph):
+    checker = ReverseDependencyChecker.__new__(ReverseDependencyChecker)
+    checker._package_dependencies, checker._arch_providers_of, checker._arch_provided_by = \
+        ReverseDependencyChecker._package_information(graph, ARCHS)
+    checker._archs_in_suite = set(ARCHS)
+    return checker
+
+
+GROUPS = {
+    'libfoo': [('libfoo1', ['amd64', 'i386'])],
+    'libfoo-compat': [('libfoo1-compat', ['amd64'])],
+    'postfix': [('postfix', None)],
+    'exim4': [('exim4', ['all', 'source'])],
+    'app-data': [('app-data', ['all'])],
+    'app-tools': [('app-tools', ['all'])],
+    'app-src': [('app', ['source'])],
+    'frontend': [('frontend', ['i386']), ('frontend', ['source'])],
+    'debhelper': [('debhelper', ['all'])],
+    'orphan': [('orphan', ['amd64'])],
+}
+
+
+def normalize(breakage):
+    return {key: set(value) for key, value in breakage.items() if value}
+
+
+class DependencyGraphTestCase(DakTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'dependency-graph', 'unstable')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_load(self):
+        graph = make_graph()
+        graph.save(self.path)
+        loaded = DependencyGraph.load(self.path)
+        self.assertEqual(loaded.binaries, graph.binaries)
+        self.assertEqual(loaded.sources, graph.sources)
+        self.assertFalse(loaded.changed)
+
+    def test_load_invalid(self):
+        self.assertEqual(DependencyGraph.load(self.path).binaries, {})
+        os.makedirs(os.path.dirname(self.path))
+        for data in ('garbage', '{"format": 2}', '{"format": 2, "names": [], "binaries": [[1, 0, 1, [], []]], "sources": []}'):
+            with open(self.path, 'w') as fh:
+                fh.write(data)
+            graph = DependencyGraph.load(self.path)
+            self.assertEqual((graph.binaries, graph.sources), ({}, {}), data)
+
+
+class RemovalSimulatorTestCase(DakTestCase):
+
+    def assertSameBreakage(self, checker, simulator, removed):
+        requests = [request for name in sorted(removed) for request in GROUPS[name]]
+        self.assertEqual(normalize(checker.check_reverse_depends(requests)),
+                         normalize(simulator.breakage()),
+                         'removed groups: %s' % ', '.join(sorted(removed)))
+
+    def test_virtual_packages(self):
+        checker = make_checker(make_graph())
+        simulator = RemovalSimulator(checker)
+        # libfoo-abi is still provided by libfoo1-compat on amd64
+        simulator.remove_group('libfoo', GROUPS['libfoo'])
+        breakage = normalize(simulator.breakage())
+        self.assertEqual(breakage[('libfoo1', 'i386')], {('app', 'i386'), ('postfix', 'i386'), ('app', 'source')})
+        self.assertEqual(breakage[('libfoo1', 'amd64')], {('postfix', 'amd64'), ('app', 'source')})
+        self.assertNotIn(('app', 'amd64'), breakage[('libfoo1', 'amd64')])
+        self.assertSameBreakage(checker, simulator, {'libfoo'})
+        # now the last provider of libfoo-abi is gone on amd64 as well
+        simulator.remove_group('libfoo-compat', GROUPS['libfoo-compat'])
+        self.assertIn(('app', 'amd64'), normalize(simulator.breakage())[('libfoo1', 'amd64')])
+        self.assertSameBreakage(checker, simulator, {'libfoo', 'libfoo-compat'})
+        simulator.restore_group('libfoo')
+        self.assertSameBreakage(checker, simulator, {'libfoo-compat'})
+
+    def test_alternatives(self):
+        checker = make_checker(make_graph())
+        simulator = RemovalSimulator(checker)
+        # exim4 still provides mta
+        simulator.remove_group('postfix', GROUPS['postfix'])
+        self.assertEqual(normalize(simulator.breakage()), {})
+        self.assertSameBreakage(checker, simulator, {'postfix'})
+        simulator.remove_group('exim4', GROUPS['exim4'])
+        self.assertSameBreakage(checker, simulator, {'postfix', 'exim4'})
+        simulator.restore_group('postfix')
+        self.assertEqual(normalize(simulator.breakage()), {})
+        self.assertSameBreakage(checker, simulator, {'exim4'})
+
+    def test_arch_all(self):
+        checker = make_checker(make_graph())
+        simulator = RemovalSimulator(checker)
+        simulator.remove_group('app-data', GROUPS['app-data'])
+        breakage = normalize(simulator.breakage())
+        self.assertEqual(breakage[('app-data', 'amd64')], {('app-tools', 'amd64')})
+        self.assertEqual(breakage[('app-data', 'i386')], {('app-tools', 'i386')})
+        self.assertSameBreakage(checker, simulator, {'app-data'})
+        # frontend can still use app directly
+        simulator.remove_group('app-tools', GROUPS['app-tools'])
+        self.assertSameBreakage(checker, simulator, {'app-data', 'app-tools'})
+
+    def test_source_removals(self):
+        checker = make_checker(make_graph())
+        simulator = RemovalSimulator(checker)
+        simulator.remove_group('debhelper', GROUPS['debhelper'])
+        breakage = normalize(simulator.breakage())
+        # dh-sequence goes away with its only provider
+        self.assertEqual(breakage[('debhelper', 'amd64')], {('postfix', 'source'), ('app', 'source')})
+        self.assertSameBreakage(checker, simulator, {'debhelper'})
+        # removing just the source of app does not break anything
+        simulator.remove_group('app-src', GROUPS['app-src'])
+        self.assertSameBreakage(checker, simulator, {'debhelper', 'app-src'})
+        simulator.remove_group('libfoo', GROUPS['libfoo'])
+        simulator.remove_group('libfoo-compat', GROUPS['libfoo-compat'])
+        self.assertNotIn(('app', 'source'), set.union(*normalize(simulator.breakage()).values()))
+        self.assertSameBreakage(checker, simulator, {'debhelper', 'app-src', 'libfoo', 'libfoo-compat'})
+        simulator.restore_group('app-src')
+        self.assertSameBreakage(checker, simulator, {'debhelper', 'libfoo', 'libfoo-compat'})
+
+    def test_random_sequences(self):
+        checker = make_checker(make_graph())
+        rng = random.Random(4711)
+        for _ in range(50):
+            simulator = RemovalSimulator(checker)
+            removed = set()
+            for _ in range(30):
+                name = rng.choice(sorted(GROUPS))
+                if name in removed:
+                    simulator.restore_group(name)
+                    removed.discard(name)
+                else:
+                    simulator.remove_group(name, GROUPS[name])
+                    removed.add(name)
+                self.assertSameBreakage(checker, simulator, removed)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import subprocess
 import tempfile
 import shutil
 from base_test import DakTestCase
@@ -24,7 +30,12 @@ from daklib.filewriter import (BinaryContentsFileWriter,
                                SourceContentsFileWriter,
                                SourcesFileWriter,
                                PackagesFileWriter,
-                               TranslationFileWriter)
+                               TranslationFileWriter,
+                               read_hash_manifest,
+                               staging_path,
+                               _allocate_threads,
+                               _compression_methods,
+                               _CompressorFeeder)
 
 SUITE = 'unstable'
 COMPONENT = 'main'
@@ -84,3 +95,217 @@ class FileWriterTest(DakTestCase):
                 # (currently we just test it does not crash).
         finally:
             shutil.rmtree(tmpdir)
+
+    def test_compressed_outputs(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = SourcesFileWriter(archive=tmpdir,
+                                       suite=SUITE,
+                                       component=COMPONENT,
+                                       compression=['none', 'gzip', 'bzip2', 'xz'])
+            fd = writer.open()
+            for i in range(10000):
+                fd.write('Package: hallo-%d\n\n' % i)
+            writer.close()
+
+            with open(writer.path, 'rb') as fh:
+                expected = fh.read()
+            self.assertEqual(len(expected.splitlines()), 20000)
+            with gzip.open(writer.path + '.gz') as fh:
+                self.assertEqual(fh.read(), expected)
+            with bz2.open(writer.path + '.bz2') as fh:
+                self.assertEqual(fh.read(), expected)
+            with lzma.open(writer.path + '.xz') as fh:
+                self.assertEqual(fh.read(), expected)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(writer.path))),
+                             ['Sources', 'Sources.bz2', 'Sources.gz', 'Sources.xz'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_allocate_threads(self):
+        methods = [m for m in _compression_methods if m.keyword in ('gzip', 'xz', 'zstd', 'none')]
+        self.assertEqual(_allocate_threads(methods, 1), {'gzip': 1, 'xz': 1, 'zstd': 1})
+        self.assertEqual(_allocate_threads(methods, 4), {'gzip': 1, 'xz': 2, 'zstd': 1})
+        self.assertEqual(_allocate_threads(methods, 8), {'gzip': 1, 'xz': 4, 'zstd': 3})
+        self.assertEqual(_allocate_threads(methods, None), {'gzip': 1, 'xz': 1, 'zstd': 1})
+
+    def test_compression_budget(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = PackagesFileWriter(archive=tmpdir,
+                                        suite=SUITE,
+                                        component=COMPONENT,
+                                        architecture=ARCH,
+                                        debtype='deb',
+                                        compression=['gzip', 'bzip2', 'xz'],
+                                        compression_threads=2)
+            fd = writer.open()
+            # only two compressors run while the file is written
+            self.assertEqual(len(writer.processes), 2)
+            for i in range(10000):
+                fd.write('Package: hallo-%d\n\n' % i)
+            writer.close()
+
+            expected = ''.join('Package: hallo-%d\n\n' % i for i in range(10000)).encode()
+            with gzip.open(writer.path + '.gz') as fh:
+                self.assertEqual(fh.read(), expected)
+            with bz2.open(writer.path + '.bz2') as fh:
+                self.assertEqual(fh.read(), expected)
+            with lzma.open(writer.path + '.xz') as fh:
+                self.assertEqual(fh.read(), expected)
+            self.assertEqual(sorted(f for f in os.listdir(os.path.dirname(writer.path)) if not f.startswith('.')),
+                             ['Packages.bz2', 'Packages.gz', 'Packages.xz'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_open_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # the staging directory cannot be created
+            staging_dir = os.path.join(tmpdir, 'staging')
+            with open(staging_dir, 'w'):
+                pass
+            writer = SourcesFileWriter(archive=tmpdir,
+                                       suite=SUITE,
+                                       component=COMPONENT,
+                                       compression=['gzip', 'xz'],
+                                       staging_dir=staging_dir)
+            with self.assertRaises(OSError):
+                writer.open()
+            self.assertEqual(len(writer.processes), 2)
+            for process in writer.processes:
+                self.assertIsNotNone(process.returncode)
+            self.assertEqual(os.listdir(os.path.dirname(writer.path)), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compressor_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = SourcesFileWriter(archive=tmpdir,
+                                       suite=SUITE,
+                                       component=COMPONENT,
+                                       compression=['gzip', 'bzip2', 'xz'],
+                                       compression_threads=2)
+            fd = writer.open()
+            fd.write('Package: hallo\n\n')
+            writer.processes[0].kill()
+            with self.assertRaises((subprocess.CalledProcessError, OSError)):
+                writer.close()
+            for process in writer.processes:
+                self.assertIsNotNone(process.returncode)
+            self.assertEqual(os.listdir(os.path.dirname(writer.path)), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_feeder_close_failure(self):
+        # the data is still buffered when the compressor is gone, so only
+        # closing its stdin fails
+        process = subprocess.Popen(['true'], stdin=subprocess.PIPE)
+        process.wait()
+        feeder = _CompressorFeeder(process)
+        feeder.write(b'Package: hallo\n\n')
+        with self.assertRaises(BrokenPipeError):
+            feeder.close()
+
+    def test_no_compression_budget(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = SourcesFileWriter(archive=tmpdir,
+                                       suite=SUITE,
+                                       component=COMPONENT,
+                                       compression=['gzip', 'xz'],
+                                       compression_threads=0)
+            fd = writer.open()
+            self.assertEqual(len(writer.processes), 2)
+            fd.write('Package: hallo\n\n')
+            writer.close()
+            with lzma.open(writer.path + '.xz') as fh:
+                self.assertEqual(fh.read(), b'Package: hallo\n\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_concurrent_compression(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = PackagesFileWriter(archive=tmpdir,
+                                        suite=SUITE,
+                                        component=COMPONENT,
+                                        architecture=ARCH,
+                                        debtype='deb',
+                                        compression=['gzip', 'bzip2', 'xz'],
+                                        compression_threads=6)
+            fd = writer.open()
+            for i in range(10000):
+                fd.write('Package: hallo-%d\n\n' % i)
+            writer.close()
+
+            expected = ''.join('Package: hallo-%d\n\n' % i for i in range(10000)).encode()
+            with gzip.open(writer.path + '.gz') as fh:
+                self.assertEqual(fh.read(), expected)
+            with bz2.open(writer.path + '.bz2') as fh:
+                self.assertEqual(fh.read(), expected)
+            with lzma.open(writer.path + '.xz') as fh:
+                self.assertEqual(fh.read(), expected)
+            self.assertFalse(os.path.exists(writer.path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_hash_manifest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            staging_dir = os.path.join(tmpdir, 'staging')
+            writer = TranslationFileWriter(archive=tmpdir,
+                                           suite=SUITE,
+                                           component=COMPONENT,
+                                           compression=['bzip2', 'xz'],
+                                           staging_dir=staging_dir)
+            fd = writer.open()
+            fd.write('Package: hallo\n')
+            writer.close()
+
+            content = b'Package: hallo\n'
+            expected = {
+                'len': len(content),
+                'md5': hashlib.md5(content).hexdigest(),
+                'sha1': hashlib.sha1(content).hexdigest(),
+                'sha256': hashlib.sha256(content).hexdigest(),
+            }
+            self.assertEqual(read_hash_manifest(staging_dir, writer.path, writer.path + '.xz'), expected)
+            self.assertEqual(read_hash_manifest(staging_dir, writer.path, writer.path + '.bz2'), expected)
+            # the uncompressed file was not written
+            self.assertIsNone(read_hash_manifest(staging_dir, writer.path, writer.path))
+
+            # nothing but the indices is written to dists/
+            self.assertEqual(sorted(os.listdir(os.path.dirname(writer.path))),
+                             ['Translation-en.bz2', 'Translation-en.xz'])
+            self.assertIsNone(read_hash_manifest(None, writer.path, writer.path + '.xz'))
+
+            # a manifest is not used for files changed after it was written
+            with lzma.open(writer.path + '.xz', 'wb') as fh:
+                fh.write(b'Package: changed\n')
+            self.assertIsNone(read_hash_manifest(staging_dir, writer.path, writer.path + '.xz'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_staging(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            staging_dir = os.path.join(tmpdir, 'staging')
+            writer = SourcesFileWriter(archive=tmpdir,
+                                       suite=SUITE,
+                                       component=COMPONENT,
+                                       staging_dir=staging_dir)
+            fd = writer.open()
+            fd.write('Package: hallo\n')
+            writer.close()
+
+            staged = staging_path(staging_dir, writer.path)
+            self.assertTrue(staged.startswith(staging_dir + '/'))
+            with open(staged, 'rb') as fh:
+                self.assertEqual(fh.read(), b'Package: hallo\n')
+            self.assertFalse(os.path.exists(writer.path))
+            self.assertEqual(read_hash_manifest(staging_dir, writer.path, staged),
+                             read_hash_manifest(staging_dir, writer.path, writer.path + '.xz'))
+        finally:
+            shutil.rmtree(tmpdir)
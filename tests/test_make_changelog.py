@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2026, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from base_test import DakTestCase, fixture
+
+from dak.make_changelog import export_files, generate_export_filelist, read_debian_diff, read_debian_files, read_debian_tarball
+
+from unittest import main
+
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+
+ADD_CHANGELOG = b"""\
+--- hello-2.10.orig/debian/changelog
++++ hello-2.10/debian/changelog
+@@ -0,0 +1,2 @@
++hello (2.10-1) unstable; urgency=low
++
+"""
+
+ADD_NEWS_NO_NEWLINE = b"""\
+--- hello-2.10.orig/debian/NEWS
++++ hello-2.10/debian/NEWS
+@@ -0,0 +1,2 @@
++first
++last
+\\ No newline at end of file
+"""
+
+MODIFY_UPSTREAM = b"""\
+--- hello-2.10.orig/src/hello.c
++++ hello-2.10/src/hello.c
+@@ -1,3 +1,3 @@
+ context
+-old
++new
+ context
+"""
+
+MODIFY_COPYRIGHT = b"""\
+--- hello-2.10.orig/debian/copyright
++++ hello-2.10/debian/copyright
+@@ -1 +1 @@
+-old
++new
+"""
+
+
+class MakeChangelogTestCase(DakTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_diff(self, name, *parts):
+        path = os.path.join(self.tmpdir, name)
+        with gzip.open(path, 'wb') as fh:
+            fh.write(b''.join(parts))
+        return path
+
+    def write_tarball(self, name, members):
+        """members: list of (name, data), data None for a symlink"""
+        path = os.path.join(self.tmpdir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            for member, data in members:
+                info = tarfile.TarInfo(member)
+                if data is None:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = '/etc/passwd'
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+        return path
+
+    def test_diff_add(self):
+        path = self.write_diff('add.diff.gz', MODIFY_UPSTREAM, ADD_CHANGELOG)
+        self.assertEqual(read_debian_diff(path),
+                         {'changelog': b'hello (2.10-1) unstable; urgency=low\n\n'})
+
+    def test_diff_no_newline(self):
+        path = self.write_diff('nonl.diff.gz', ADD_NEWS_NO_NEWLINE, ADD_CHANGELOG)
+        found = read_debian_diff(path)
+        self.assertEqual(found['NEWS'], b'first\nlast')
+        self.assertEqual(found['changelog'], b'hello (2.10-1) unstable; urgency=low\n\n')
+
+    def test_diff_modify(self):
+        path = self.write_diff('modify.diff.gz', ADD_CHANGELOG, MODIFY_COPYRIGHT)
+        self.assertIsNone(read_debian_diff(path))
+
+    def test_tarball(self):
+        path = self.write_tarball('hello_2.10.tar.gz', [
+            ('hello-2.10/src/hello.c', b'int main;\n'),
+            ('hello-2.10/debian/changelog', b'changelog\n'),
+            ('hello-2.10/debian/copyright', b'copyright\n'),
+            ('hello-2.10/debian/rules', b'rules\n'),
+            ('hello-2.10/debian/patches/README.Debian', b'nested\n'),
+        ])
+        self.assertEqual(read_debian_tarball(path, 1),
+                         {'changelog': b'changelog\n', 'copyright': b'copyright\n'})
+        self.assertEqual(read_debian_tarball(path, 0), {})
+
+    def test_tarball_not_regular(self):
+        path = self.write_tarball('hello_2.10.tar.gz', [
+            ('hello-2.10/debian/changelog', b'changelog\n'),
+            ('hello-2.10/debian/copyright', None),
+        ])
+        self.assertIsNone(read_debian_tarball(path, 1))
+
+    def test_files_from_orig_tarball(self):
+        # a 1.0 source package with amaya_3.2.1.orig.tar.gz and amaya_3.2.1-1.diff.gz
+        dscfilename = os.path.join(self.tmpdir, 'amaya_3.2.1-1.dsc')
+        shutil.copy(fixture('dsc/1.dsc'), dscfilename)
+        self.write_tarball('amaya_3.2.1.orig.tar.gz', [
+            ('hello-2.10/src/hello.c', b'int main;\n'),
+            ('hello-2.10/debian/copyright', b'upstream copyright\n'),
+        ])
+        self.write_diff('amaya_3.2.1-1.diff.gz', ADD_CHANGELOG)
+        self.assertEqual(read_debian_files(dscfilename),
+                         {'changelog': b'hello (2.10-1) unstable; urgency=low\n\n',
+                          'copyright': b'upstream copyright\n'})
+
+        self.write_diff('amaya_3.2.1-1.diff.gz', ADD_CHANGELOG, MODIFY_COPYRIGHT)
+        self.assertIsNone(read_debian_files(dscfilename))
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params):
+        return self.rows
+
+
+class FakeArchive:
+    archive_id = 1
+
+    def __init__(self, path):
+        self.path = path
+
+
+class ExportFilesTestCase(DakTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = FakeArchive(os.path.join(self.tmpdir, 'archive'))
+        self.clpool = os.path.join(self.tmpdir, 'changelogs')
+        directory = os.path.join(self.archive.path, 'pool', 'main', 'a', 'amaya')
+        os.makedirs(directory)
+        # two versions of a 1.0 source package sharing orig tarball and diff
+        for version in ('3.2.1-1', '3.2.1-2'):
+            shutil.copy(fixture('dsc/1.dsc'), os.path.join(directory, 'amaya_%s.dsc' % version))
+        with tarfile.open(os.path.join(directory, 'amaya_3.2.1.orig.tar.gz'), 'w:gz') as tar:
+            info = tarfile.TarInfo('amaya-3.2.1/debian/copyright')
+            info.size = 10
+            tar.addfile(info, io.BytesIO(b'copyright\n'))
+        with gzip.open(os.path.join(directory, 'amaya_3.2.1-1.diff.gz'), 'wb') as fh:
+            fh.write(ADD_CHANGELOG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, suites, rescan=False):
+        rows = [('amaya', suite, version, 'main/a/amaya/amaya_%s.dsc' % version)
+                for suite, version in sorted(suites.items())]
+        clfiles = export_files(FakeSession(rows), self.archive, self.clpool, jobs=1, rescan=rescan)
+        generate_export_filelist(self.clpool, clfiles)
+        return clfiles
+
+    def path(self, name):
+        return os.path.join(self.clpool, 'main', 'a', 'amaya', name)
+
+    def listing(self):
+        return sorted(os.path.relpath(os.path.join(root, f), self.clpool)
+                      for root, dirs, files in os.walk(self.clpool) for f in files if f != 'filelist.yaml')
+
+    def test_export_files(self):
+        clfiles = self.export({'unstable': '3.2.1-1', 'testing': '3.2.1-1'})
+        names = ['amaya_3.2.1-1_changelog', 'amaya_3.2.1-1_copyright',
+                 'testing_changelog', 'testing_copyright', 'unstable_changelog', 'unstable_copyright']
+        self.assertEqual(self.listing(), ['main/a/amaya/' + name for name in names])
+        self.assertEqual(sorted(clfiles['amaya']), ['3.2.1-1', 'testing', 'unstable'])
+        self.assertTrue(os.path.samefile(self.path('amaya_3.2.1-1_copyright'), self.path('testing_copyright')))
+        with open(self.path('unstable_copyright'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'copyright\n')
+
+        # a new version in unstable, and an exported file lost from the pool
+        os.unlink(self.path('amaya_3.2.1-1_copyright'))
+        clfiles = self.export({'unstable': '3.2.1-2', 'testing': '3.2.1-1'})
+        names = ['amaya_3.2.1-1_changelog', 'amaya_3.2.1-1_copyright',
+                 'amaya_3.2.1-2_changelog', 'amaya_3.2.1-2_copyright',
+                 'testing_changelog', 'testing_copyright', 'unstable_changelog', 'unstable_copyright']
+        self.assertEqual(self.listing(), ['main/a/amaya/' + name for name in names])
+        self.assertTrue(os.path.samefile(self.path('amaya_3.2.1-2_changelog'), self.path('unstable_changelog')))
+        self.assertTrue(os.path.samefile(self.path('amaya_3.2.1-1_copyright'), self.path('testing_copyright')))
+
+        # files of versions in no suite anymore are removed
+        clfiles = self.export({'unstable': '3.2.1-2'})
+        names = ['amaya_3.2.1-2_changelog', 'amaya_3.2.1-2_copyright', 'unstable_changelog', 'unstable_copyright']
+        self.assertEqual(self.listing(), ['main/a/amaya/' + name for name in names])
+        self.assertEqual(sorted(clfiles['amaya']), ['3.2.1-2', 'unstable'])
+
+        # files the file list does not know about are only removed by a rescan
+        stale = os.path.join(self.clpool, 'main', 'z', 'zz', 'zz_1.0_changelog')
+        os.makedirs(os.path.dirname(stale))
+        open(stale, 'w').close()
+        self.export({'unstable': '3.2.1-2'})
+        self.assertTrue(os.path.exists(stale))
+        self.export({'unstable': '3.2.1-2'}, rescan=True)
+        self.assertEqual(self.listing(), ['main/a/amaya/' + name for name in names])
+        self.assertFalse(os.path.exists(os.path.join(self.clpool, 'main', 'z')))
+
+    def test_link_failure(self):
+        os.makedirs(self.path('unstable_changelog'))
+        clfiles = self.export({'unstable': '3.2.1-1'})
+        # the exported file stays even though its suite link is missing
+        self.assertIn('main/a/amaya/amaya_3.2.1-1_changelog', clfiles['amaya']['3.2.1-1'])
+        self.assertNotIn('main/a/amaya/unstable_changelog', clfiles['amaya']['unstable'])
+        self.assertTrue(os.path.exists(self.path('amaya_3.2.1-1_changelog')))
+
+        os.rmdir(self.path('unstable_changelog'))
+        self.export({'unstable': '3.2.1-1'})
+        self.assertTrue(os.path.samefile(self.path('amaya_3.2.1-1_changelog'), self.path('unstable_changelog')))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ import shutil
 import tempfile
 import unittest
 
-from daklib.pdiff import PDiffIndex
+from daklib.pdiff import PDiffIndex, stat_key, _compose_edits, _ed_command, _ed_script, _parse_ed_script
 
 try:
     from unittest import IsolatedAsyncioTestCase
@@ -89,6 +89,36 @@ def reload_and_compare_pdiff_indices(index):
     return reloaded_index
 
 
+def apply_ed_script(lines, script):
+    lines = list(lines)
+    commands = iter(b"".join(script).splitlines(keepends=True))
+    for command in commands:
+        command = command.rstrip(b"\n")
+        op, lines_range = command[-1:], command[:-1].split(b",")
+        start, end = int(lines_range[0]), int(lines_range[-1])
+        text = []
+        if op in (b"a", b"c"):
+            for line in commands:
+                if line == b".\n":
+                    break
+                text.append(line)
+        if op == b"a":
+            lines[start:start] = text
+        else:
+            lines[start - 1:end] = text
+    return lines
+
+
+def packages_stanza(package, version):
+    return [
+        b"Package: %s\n" % package,
+        b"Version: %s\n" % version,
+        b"Architecture: all\n",
+        b"Filename: pool/main/%s_%s_all.deb\n" % (package, version),
+        b"\n",
+    ]
+
+
 @contextlib.contextmanager
 def tempdir():
     tmpdir = tempfile.mkdtemp()
@@ -199,6 +229,60 @@ SHA256-Download:
  acf2997c8ddc7e9e935154ee9807f8777d25c81fa3eb35c53ec0d94d8fb0f21d     271 T-2020-12-12-0800.11-F-2020-12-12-0800.11.gz
 """
 
+
+class TestEdScript(unittest.TestCase):
+
+    def assert_script(self, old, new, expected=None):
+        script = list(_ed_script(old, new))
+        self.assertEqual(apply_ed_script(old, script), new)
+        if expected is not None:
+            self.assertEqual(b"".join(script), expected)
+
+    def test_stanzas(self):
+        packages = {b"a": b"1", b"b": b"1", b"c": b"1", b"d": b"1"}
+        old = [line for p, v in sorted(packages.items()) for line in packages_stanza(p, v)]
+        packages[b"b"] = b"2"
+        del packages[b"c"]
+        packages[b"e"] = b"1"
+        new = [line for p, v in sorted(packages.items()) for line in packages_stanza(p, v)]
+        # stanzas are diffed as a whole, changed ones line by line
+        self.assert_script(old, new,
+                           b"20a\n" + b"".join(packages_stanza(b"e", b"1")) + b".\n"
+                           b"11,15d\n"
+                           b"9c\nFilename: pool/main/b_2_all.deb\n.\n"
+                           b"7c\nVersion: 2\n.\n")
+
+    def test_lines(self):
+        old = [b"/usr/bin/%d  admin/p%d\n" % (i, i) for i in range(0, 100, 3)]
+        new = [b"/usr/bin/%d  admin/p%d\n" % (i, i) for i in range(0, 100, 2)]
+        self.assert_script(old, new)
+        self.assert_script(old, [])
+        self.assert_script([], new)
+        self.assertEqual(list(_ed_script(old, old)), [])
+
+    def test_compose(self):
+        versions = [
+            [b"%d\n" % i for i in range(10)],
+            [b"0\n", b"1\n", b"new\n", b"2\n", b"5\n", b"6\n", b"7\n", b"8\n", b"9\n"],
+            [b"new\n", b"2\n", b"5\n", b"changed\n", b"7\n", b"8\n", b"9\n", b"10\n"],
+            [b"first\n", b"new\n", b"2\n", b"changed\n", b"9\n", b"10\n"],
+        ]
+        patches = [_parse_ed_script(b"".join(_ed_script(old, new)).splitlines(keepends=True))
+                   for old, new in zip(versions, versions[1:])]
+        merged = patches[0]
+        for patch in patches[1:]:
+            merged = _compose_edits(merged, patch)
+        script = [_ed_command(start, end, text) for start, end, text in reversed(merged)]
+        self.assertEqual(apply_ed_script(versions[0], script), versions[-1])
+
+        with self.assertRaises(ValueError):
+            _parse_ed_script([b"1s/.//\n"])
+
+    def test_unrepresentable(self):
+        with self.assertRaises(ValueError):
+            list(_ed_script([b"a\n"], [b"a\n", b".\n"]))
+
+
 if IsolatedAsyncioTestCase is not None:
     class TestPDiffs(IsolatedAsyncioTestCase):
 
@@ -224,6 +308,26 @@ if IsolatedAsyncioTestCase is not None:
                 assert index._history_order == []
                 assert index._unmerged_history_order == []
 
+        async def test_current_hashes(self):
+            with tempdir() as tmpdir:
+                pdiff_dir = os.path.join(tmpdir, "pdiffs")
+                index = PDiffIndex(pdiff_dir, 3, False)
+                generate_orig(tmpdir, ['Version 0', 'data'])
+                os.mkdir(pdiff_dir)
+                await generate_patch(index, 'patch-1', tmpdir, ['Version 1', 'data'])
+                index.update_index()
+
+                # the stat of the stored copy is not published in the Index
+                with open(os.path.join(pdiff_dir, 'Index')) as fd:
+                    assert 'X-DAK' not in fd.read()
+
+                index = PDiffIndex(pdiff_dir, 3, False)
+                st = os.stat(os.path.join(tmpdir, "data-current"))
+                assert index.current_hashes(stat_key(st), st) == index.filesizehashes
+                assert index.filesizehashes.size == st.st_size
+                assert index.current_hashes(None, st) is None
+                assert index.current_hashes((st.st_ino, st.st_size, st.st_mtime_ns + 1), st) is None
+
         async def test_pdiff_index_unmerged(self):
             with tempdir() as tmpdir:
                 pdiff_dir = os.path.join(tmpdir, "pdiffs")
@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2026, Debian FTP Masters <ftpmaster@debian.org>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from base_test import DakTestCase
+
+from dak import stats
+
+from unittest import main
+
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import tempfile
+
+
+def log_lines(first, count):
+    return ''.join('20260101%06d|process-new|user|NEW ACCEPT: package%d_1.0_source.changes\n' % (i, i)
+                   for i in range(first, first + count))
+
+
+class ReadLogTestCase(DakTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir, '2026-01')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data, filename=None, opener=open):
+        with opener(filename or self.logfile, 'wt') as fh:
+            fh.write(data)
+
+    def test_plain(self):
+        # long enough for the digest to only cover the end of the data read
+        lines = log_lines(0, 100)
+        self.write(lines + '20260101999999|partial')
+        data, checkpoint, resumed = stats.read_log(self.logfile)
+        self.assertEqual(data, lines)
+        self.assertFalse(resumed)
+        self.assertEqual(checkpoint['offset'], len(lines))
+
+        # nothing changed
+        self.assertEqual(stats.read_log(self.logfile, checkpoint), (None, checkpoint, True))
+
+        # the partial line is read once it is complete
+        self.write(lines + '20260101999999|partial line\n' + log_lines(100, 2))
+        data, checkpoint, resumed = stats.read_log(self.logfile, checkpoint)
+        self.assertEqual(data, '20260101999999|partial line\n' + log_lines(100, 2))
+        self.assertTrue(resumed)
+        self.assertEqual(checkpoint['offset'], os.path.getsize(self.logfile))
+
+    def test_compressed_since_last_run(self):
+        lines = log_lines(0, 100)
+        for suffix, opener in (('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)):
+            self.write(lines)
+            data, checkpoint, resumed = stats.read_log(self.logfile)
+            self.assertEqual(data, lines, suffix)
+
+            # the month is over: the log got its last lines and was compressed
+            compressed = self.logfile + suffix
+            self.write(lines + log_lines(100, 3), compressed, opener)
+            data, new_checkpoint, resumed = stats.read_log(compressed, checkpoint)
+            self.assertEqual(data, log_lines(100, 3), suffix)
+            self.assertTrue(resumed, suffix)
+            self.assertEqual(new_checkpoint['offset'], len(lines + log_lines(100, 3)), suffix)
+            self.assertEqual(new_checkpoint['file'], os.path.basename(compressed), suffix)
+            self.assertEqual(stats.read_log(compressed, new_checkpoint), (None, new_checkpoint, True), suffix)
+            os.unlink(compressed)
+
+    def test_digest_mismatch(self):
+        self.write(log_lines(0, 100))
+        data, checkpoint, resumed = stats.read_log(self.logfile)
+
+        # a different log under the same name is read from its start
+        lines = log_lines(1000, 120)
+        self.write(lines)
+        self.assertEqual(stats.read_log(self.logfile, checkpoint)[0:3:2], (lines, False))
+
+        compressed = self.logfile + '.xz'
+        self.write(lines, compressed, lzma.open)
+        self.assertEqual(stats.read_log(compressed, checkpoint)[0:3:2], (lines, False))
+
+    def test_truncated(self):
+        self.write(log_lines(0, 100))
+        data, checkpoint, resumed = stats.read_log(self.logfile)
+
+        lines = log_lines(0, 10)
+        self.write(lines)
+        data, checkpoint, resumed = stats.read_log(self.logfile, checkpoint)
+        self.assertEqual(data, lines)
+        self.assertFalse(resumed)
+        self.assertEqual(checkpoint['offset'], len(lines))
+
+    def test_large_compressed(self):
+        # more than one chunk is skipped before the checkpoint
+        lines = log_lines(0, 20000)
+        self.write(lines)
+        checkpoint = stats.read_log(self.logfile)[1]
+        compressed = self.logfile + '.gz'
+        self.write(lines + log_lines(20000, 1), compressed, gzip.open)
+        self.assertEqual(stats.read_log(compressed, checkpoint)[0:3:2], (log_lines(20000, 1), True))
+
+    def test_scan_log(self):
+        self.write(log_lines(0, 100))
+        counts, checkpoint, timestamp = stats.scan_log(self.logfile, '2026-01', None, '20260101000049', {})
+        # entries up to the timestamp of the stats file were counted before
+        self.assertEqual(counts['2026-01']['stats'], {'NEW': 0, 'ACCEPT': 50, 'REJECT': 0, 'PROD': 0})
+        self.assertEqual(counts['2026-01']['members'], {'user': {'ACCEPT': 50, 'REJECT': 0, 'PROD': 0}})
+        self.assertEqual(counts['history']['stats']['ACCEPT'], 50)
+        self.assertEqual(timestamp, '20260101000099')
+
+        # after a checkpoint, only the new entries are counted
+        self.write(log_lines(0, 103))
+        counts2, checkpoint, timestamp = stats.scan_log(self.logfile, '2026-01', checkpoint, timestamp, {})
+        self.assertEqual(counts2['2026-01']['stats']['ACCEPT'], 3)
+        self.assertEqual(timestamp, '20260101000102')
+
+        stats.stats = stats.empty_stats('20260101000049')
+        try:
+            stats.merge_stats(counts)
+            stats.merge_stats(counts2)
+            self.assertEqual(stats.stats['2026-01']['members']['user']['ACCEPT'], 53)
+            self.assertEqual(stats.stats['history']['stats']['ACCEPT'], 53)
+            self.assertEqual(stats.stats['history']['members']['user']['ACCEPT'], 53)
+            self.assertEqual(stats.stats['timestamp'], '20260101000049')
+        finally:
+            stats.stats = {}
+
+    def test_checkpoints(self):
+        yaml = os.path.join(self.tmpdir, 'stats.yaml')
+        stats.Cnf = {'Dir::Cache': os.path.join(self.tmpdir, 'cache')}
+        stats.stats = {'timestamp': '20260101000099'}
+        try:
+            self.assertEqual(stats.load_checkpoints(yaml), {})
+            self.write(log_lines(0, 100))
+            checkpoints = {'2026-01': stats.read_log(self.logfile)[1]}
+            stats.save_checkpoints(yaml, checkpoints)
+            self.assertEqual(stats.load_checkpoints(yaml), checkpoints)
+
+            # checkpoints are only valid for the stats they were saved with
+            self.assertEqual(stats.load_checkpoints(os.path.join(self.tmpdir, 'other.yaml')), {})
+            stats.stats = {'timestamp': '20260101000100'}
+            self.assertEqual(stats.load_checkpoints(yaml), {})
+        finally:
+            stats.Cnf = None
+            stats.stats = {}
+
+
+if __name__ == '__main__':
+    main()